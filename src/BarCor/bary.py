@@ -14,6 +14,8 @@ except:
 path = os.path.dirname(__file__)
 if path=='': path='.'
 
+instnums = {'HARPS':14, 'HARPN':17,  'HPF':18, 'CARM_VIS':16, 'CARM_NIR':16, 'FIES':16}
+
 def bary_harps(file, ra=None, dec=None, epoch=2000, pma=0.0, pmd=0.0):
    ''' compute barycentric correction for HARPS spctrum using coordinates from
     input or fits header
@@ -49,7 +51,7 @@ def bary(dateobs, rammss, demmss, inst, epoch=2000, exptime=0.0, pma=0.0, pmd=0.
    rammss - (ra,mm,ss) or 'ra:mm:ss' or ra
    demmss - (de,mm,ss)
    '''
-   instnum = {'HARPS':14, 'HARPN':17,  'HPF':18, 'CARM_VIS':16, 'CARM_NIR':16, 'FIES':16}[inst]
+   instnum = instnums[inst]
 
    if type(rammss) is str:
       if ':' in rammss:
@@ -80,6 +82,35 @@ def bary(dateobs, rammss, demmss, inst, epoch=2000, exptime=0.0, pma=0.0, pmd=0.
    result[-2] = result[-2] + 2400000.
    return result[-2:]
 
+def barylib(dateobs, rammss, demmss, inst, epoch=2000, exptime=0.0, pma=0.0, pmd=0.0):
+   ''' baricentric correction with BarCor in-process (no temporary files and subprocess)
+   dateobs - 'YYYY-MM-DDThh:mm:ss.ss' or a list of them
+   exptime - scalar or list
+   other parameters as in bary
+
+   requires the f2py module barcor:
+      python -m numpy.f2py -c -m barcor barcor.f only: baryv
+   '''
+   import barcor
+   instnum = instnums[inst]
+
+   if type(rammss) is str:
+      if ':' in rammss:
+         rammss = tuple(map(float,rammss.split(':')))
+   if type(demmss) is str:
+      if ':' in demmss:
+         demmss = tuple(map(float,demmss.split(':')))
+
+   scalar = isinstance(dateobs, str)
+   dateobs = [dateobs] if scalar else dateobs
+   dates = [map(float, d.replace(':',' ').replace('-',' ').replace('T',' ').split()) for d in dateobs]
+   exptime = np.zeros(len(dates)) + exptime
+
+   jdbar, vrbcor = barcor.baryv(*(tuple(rammss)+tuple(demmss)), leq=epoch, k=instnum, mualp=pma, mudel=pmd,
+                      dates=np.transpose(dates), expt=exptime, dir=path+'/')
+   jdbar = jdbar + 2400000.
+   return (jdbar[0], vrbcor[0]) if scalar else (jdbar, vrbcor)
+
 def main(files, **kwargs):
    for file in files:
       print file, fmt % tuple(bary_harps(file,**kwargs))
@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+'''
+Startup time of serval.py without display.
+
+Measures in fresh interpreters the import of serval and the call
+serval.py -h, and lists the heavy modules which were loaded at import.
+gnuplot must not be started (DISPLAY is unset, GNUTERM=dumb).
+
+Usage:
+   python bench_startup.py [-n 5]
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+servalsrc = os.path.dirname(os.path.realpath(__file__)) + os.sep
+
+heavy = ['gplot', 'scipy.interpolate', 'scipy.optimize', 'scipy.linalg', 'pyfits', 'astropy', 'astropy.io.fits',
+         'urllib2', 'targ', 'brv_we14idl', 'brv_we14html', 'brv_we14py', 'barycorrpy', 'phoenix_as_RVmodel', 'chi2map']
+
+probe = '''
+import sys, time
+t0 = time.time()
+import serval
+dt = time.time() - t0
+print dt, " ".join(name for name in %r if name in sys.modules and sys.modules[name] is not None)
+''' % heavy
+
+def run(cmd, env):
+   t0 = time.time()
+   out = subprocess.check_output(cmd, env=env, cwd=servalsrc, stderr=subprocess.STDOUT)
+   return time.time() - t0, out
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description='Startup time of serval.py without display.')
+   parser.add_argument('-n', help='number of repetitions (default: %(default)s)', type=int, default=5)
+   args = parser.parse_args()
+
+   env = dict(os.environ, GNUTERM='dumb')
+   env.pop('DISPLAY', None)
+
+   timp, th = [], []
+   for i in range(args.n):
+      dt, out = run([sys.executable, '-c', probe], env)
+      line = out.strip().splitlines()[-1].split()   # the last line is from the probe
+      timp.append(float(line[0]))
+      loaded = line[1:]
+      th.append(run([sys.executable, servalsrc+'serval.py', '-h'], env)[0])
+
+   print 'import serval:  min %.3f s  median %.3f s' % (min(timp), sorted(timp)[len(timp)//2])
+   print 'serval.py -h:   min %.3f s  median %.3f s' % (min(th), sorted(th)[len(th)//2])
+   print 'heavy modules loaded at import:', ' '.join(loaded) or 'none'
+   if 'gplot' in loaded:
+      print 'WARNING: gplot (gnuplot) is started at import'
@@ -0,0 +1,382 @@
+#! /usr/bin/env python
+'''
+Benchmark with synthetic spectra.
+
+Generates echelle spectra of a synthetic star in the HARPS (DRS e2ds) and
+CARM_VIS formats, which are read by inst_HARPS and inst_CARM_VIS like real
+data. The rest frame spectrum is a cspline of random absorption lines. It
+is Doppler shifted with a known RV curve and the barycentric motion (given
+as DRS BERV in the header), multiplied with a blaze function and disturbed
+with photon noise.
+
+Times the kernels (polyreg, spl_evf, Tpl.shifted, Tpl(ucbspl), ucbspl_fit, CCF, Chi2Map.mlcrx) on
+one order and the full pipeline (serval.py in a subprocess), and checks
+that the injected RVs are recovered, that -vsolver newton reproduces
+v and e_v of the grid on one order, and that the SSR curve from the
+downdated grid moments (chi2 map) matches polyreg_grid. The exit code
+is 1, if not.
+
+Usage:
+   python bench_synth.py [-inst HARPS] [-nspec 12] [-nproc 1] [-skip pipeline]
+'''
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from read_spec import pyfits, airtovac
+from calcspec import c, redshift
+import cubicSpline
+import cspline as spl
+
+servalsrc = os.path.dirname(os.path.realpath(__file__)) + os.sep
+
+npix = 4096
+insts = {
+   # number of orders, echelle order number of the first order, grating constant m*lambda [A], pixel size [km/s]
+   'HARPS': dict(nord=72, m0=161, mlam=6.08e5, dv=0.82),
+   'CARM_VIS': dict(nord=61, m0=118, mlam=6.10e5, dv=1.25),
+}
+vpad = 100.   # [km/s] margin of the template around the orders for berv and rv shifts
+
+
+class Star(object):
+   """
+   Synthetic stellar spectrum of random absorption lines.
+
+   The rest frame spectrum of each order is a cspline (uniform cubic
+   B-spline) fitted to the line profiles on a fine ln(lambda) grid.
+
+   lnw : ((nord x npix)) ln(wavelength) of the orders.
+   dvline : [km/s] Mean line distance.
+
+   """
+   def __init__(self, lnw, dvline=10., seed=0):
+      rnd = np.random.RandomState(seed)
+      lnwmin, lnwmax = lnw.min() - vpad/c, lnw.max() + vpad/c
+      nline = int((lnwmax-lnwmin) * c / dvline)
+      self.lnwl = np.sort(rnd.uniform(lnwmin, lnwmax, nline))   # line centres
+      self.depth = rnd.uniform(0.05, 0.7, nline)
+      self.sig = rnd.uniform(2., 4., nline) / c
+      dx = 0.25 / c   # fine grid
+      self.spl = []
+      for lnwo in lnw:
+         x = np.arange(lnwo.min()-vpad/c, lnwo.max()+vpad/c, dx)
+         self.spl.append(spl.ucbspl_fit(x, self.profile(x), K=x.size/2))
+
+   def profile(self, x):
+      '''Normalised flux at ln(lambda) x.'''
+      f = np.ones_like(x)
+      i0, i1 = np.searchsorted(self.lnwl, [x[0]-20/c, x[-1]+20/c])   # 5 sigma of the widest lines
+      for l, d, s in zip(self.lnwl[i0:i1], self.depth[i0:i1], self.sig[i0:i1]):
+         j0, j1 = np.searchsorted(x, [l-5*s, l+5*s])
+         f[j0:j1] *= 1 - d*np.exp(-0.5*((x[j0:j1]-l)/s)**2)
+      return f
+
+   def __call__(self, o, x):
+      '''Rest frame flux of order o at ln(lambda) x.'''
+      return self.spl[o](x)
+
+   def mask(self, x, hw=2.):
+      '''CCF box mask (edges, weights) for the lines in the range of x.'''
+      i0, i1 = np.searchsorted(self.lnwl, [x.min(), x.max()])
+      l, d = self.lnwl[i0:i1], self.depth[i0:i1]
+      wt = np.dstack((l-hw/c, l-hw/c, l+hw/c, l+hw/c)).ravel()
+      ft = np.dstack((0*d, d, d, 0*d)).ravel()
+      # sentinels to keep the searchsorted indices in range
+      return np.r_[x.min()-vpad/c, wt, x.max()+vpad/c], np.r_[0, ft, 0]
+
+def wavesol(inst):
+   '''Returns the air wavelength polynomials ((nord x 4)) and the vacuum wavelengths ((nord x npix)).'''
+   p = insts[inst]
+   xpix = np.arange(npix)
+   lamc = p['mlam'] / (p['m0'] - np.arange(p['nord']))   # order centres
+   lam = lamc[:,np.newaxis] * np.exp((xpix-npix/2) * p['dv']/c)
+   A = np.array([np.polyfit(xpix, lamo, 3)[::-1] for lamo in lam])
+   return A, airtovac(np.dot(A, xpix**np.arange(4)[:,np.newaxis]))
+
+def blaze(nord):
+   xpix = np.arange(npix)
+   o = np.arange(nord)[:,np.newaxis]
+   return np.sinc(1.4*(xpix-npix/2.)/npix)**2 * np.exp(-0.5*((o-nord/2.)/(nord/2.5))**2)
+
+def utc(mjd):
+   return datetime.datetime(1858, 11, 17) + datetime.timedelta(days=mjd)
+
+def write_harps(dirname, obj, bjd, berv, sn55, f, A):
+   dateobs = utc(bjd-2400000.5).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+   hdr = pyfits.Header()
+   hdr['INSTRUME'] = 'HARPS'
+   hdr['OBJECT'] = obj
+   hdr['DATE-OBS'] = dateobs
+   hdr['MJD-OBS'] = (bjd-2400000.5, 'MJD start (%s)' % dateobs)   # timeid from the comment
+   hdr['EXPTIME'] = 900.
+   hdr['RA'] = 0.
+   hdr['DEC'] = 0.
+   ESO = 'HIERARCH ESO '
+   hdr[ESO+'INS DET1 TMMEAN'] = 0.5
+   hdr[ESO+'DPR TYPE'] = 'STAR,WAVE'
+   hdr[ESO+'DPR TECH'] = 'ECHELLE'
+   hdr[ESO+'INS MODE'] = 'HARPS'
+   hdr[ESO+'OBS TARG NAME'] = obj
+   hdr[ESO+'DRS BJD'] = bjd
+   hdr[ESO+'DRS BERV'] = berv
+   hdr[ESO+'DRS SPE EXT SN55'] = sn55
+   hdr[ESO+'DRS BLAZE FILE'] = 'synthetic'
+   hdr[ESO+'DRS DRIFT RV USED'] = 0.
+   hdr[ESO+'DRS CAL TH DEG LL'] = A.shape[1] - 1
+   hdr[ESO+'DRS CAL LOC NBO'] = A.shape[0]
+   for i, a in enumerate(A.ravel()):
+      hdr[ESO+'DRS CAL TH COEFF LL%s' % i] = a
+   filename = dirname + 'HARPS.%s_e2ds_A.fits' % dateobs
+   pyfits.PrimaryHDU(f.astype(np.float32), hdr).writeto(filename, clobber=True)
+   return filename
+
+def write_carm_vis(dirname, obj, bjd, berv, sn55, f, w):
+   t = utc(bjd-2400000.5)
+   fileid = 'car-%s-sci-gtoc-vis' % t.strftime('%Y%m%dT%Hh%Mm%Ss')
+   hdr = pyfits.Header()
+   hdr['INSTRUME'] = 'CARMENES'
+   hdr['OBJECT'] = obj
+   hdr['DATE-OBS'] = t.strftime('%Y-%m-%dT%H:%M:%S')
+   hdr['FILENAME'] = fileid + '.fits'
+   hdr['EXPTIME'] = 900.
+   hdr['RA'] = 0.
+   hdr['DEC'] = 0.
+   CAR = 'HIERARCH CARACAL '
+   hdr[CAR+'MJD-OBS'] = bjd - 2400000.5
+   hdr[CAR+'BJD'] = bjd - 2400000
+   hdr[CAR+'BERV'] = berv
+   hdr[CAR+'TMEAN'] = 450.
+   hdr[CAR+'FIB'] = 'A'
+   hdr[CAR+'DRIFT FP RV'] = 0.
+   hdr[CAR+'DRIFT FP E_RV'] = 0.
+   hdr[CAR+'FOX XWD'] = 8
+   hdr[CAR+'FOX SNR 36'] = sn55
+   # fox flux and errors are scaled by 10 in inst_CARM_VIS
+   hdus = pyfits.HDUList([pyfits.PrimaryHDU(header=hdr),
+                          pyfits.ImageHDU(f/10., name='SPEC'),
+                          pyfits.ImageHDU(np.sqrt(np.abs(f)+5.*10)/10., name='SIG'),
+                          pyfits.ImageHDU(w, name='WAVE')])
+   filename = dirname + fileid + '_A.fits'
+   hdus.writeto(filename, clobber=True)
+   return filename
+
+def rvcurve(bjd, K=10., P=3.7, bjd0=2458000.):
+   '''[m/s] Injected RV curve.'''
+   return K * np.sin(2*np.pi*(bjd-bjd0)/P)
+
+def bervcurve(bjd):
+   '''[km/s] Barycentric motion.'''
+   return 25. * np.sin(2*np.pi*(bjd-2451545.)/365.25)
+
+def generate(inst, dirname, obj, nspec, snr=150., seed=1):
+   '''Write the synthetic spectra and the injected values (<obj>.inj.dat). Returns the star and the first spectrum.'''
+   rnd = np.random.RandomState(seed)
+   A, w = wavesol(inst)
+   star = Star(np.log(w))
+   blz = blaze(len(w))
+   bjd = 2458000. + np.sort(rnd.uniform(0, 300, nspec))
+   rv = rvcurve(bjd)
+   berv = bervcurve(bjd)
+   if not os.path.exists(dirname): os.makedirs(dirname)
+   with open(dirname+obj+'.inj.dat', 'w') as finj:
+      for i in range(nspec):
+         sn = snr * rnd.uniform(0.7, 1.3)
+         # emitted wavelength of the observed pixels
+         x = redshift(np.log(w), vo=berv[i], ve=rv[i]/1000.)
+         fexp = np.array([star(o, xo) for o, xo in enumerate(x)]) * blz * sn**2
+         f = rnd.poisson(fexp).astype(float)
+         sn55 = sn * np.sqrt(blz[min(55, len(w)-1)].max())
+         if inst == 'HARPS':
+            filename = write_harps(dirname, obj, bjd[i], berv[i], sn55, f, A)
+         else:
+            filename = write_carm_vis(dirname, obj, bjd[i], berv[i], sn55, f, w)
+         print >>finj, bjd[i], rv[i], berv[i], os.path.basename(filename)
+         if not i: spec0 = w, f, np.sqrt(fexp+5.*10), berv[i], rv[i]
+   return star, spec0
+
+def timeit(func, *args, **kwargs):
+   '''Mean time per call, repeated for at least 1 s.'''
+   n, t0 = 0, time.time()
+   while True:
+      func(*args, **kwargs)
+      n += 1
+      dt = time.time() - t0
+      if dt > 1: return dt / n
+
+def kernels(star, spec0):
+   '''Times the kernels on the central order of the first spectrum.'''
+   import serval
+   from serval import Tpl, polyreg, CCF
+   from calcspec import calcspec
+   from chi2map import Chi2Map
+   # module globals otherwise set in the main of serval.py
+   serval.v_lo, serval.v_hi, serval.v_step = v_lo, v_hi, v_step = -5.5, 5.6, 0.1
+
+   w, f, e, berv, rv = spec0
+   o = len(w) / 2
+   x2, y2, e2 = np.log(w[o]), f[o], e[o]
+   xk = np.linspace(x2[0]-vpad/c, x2[-1]+vpad/c, 4*x2.size)
+   tpl = Tpl(xk, star(o, xk), cubicSpline.spl_cf, cubicSpline.spl_evf)
+   smod = spl.ucbspl_fit(xk, star(o, xk), K=xk.size/4)
+   tplb = Tpl(smod.xk, smod(), bspl=smod)   # as from coadding
+   calcspec.wcen = np.mean(x2)
+   calcspec.tpl = tpl
+   wt, ft = star.mask(x2)
+
+   # chi2 maps with a chromatic trend (crx) for mlcrx
+   nord = len(w)
+   xo = np.log(w).mean(axis=1)
+   xc = xo.mean()
+   vgrid = v_lo + v_step * np.arange(int((v_hi-v_lo)/v_step))
+   crx, e_rvo = 0.05, 0.005   # [km/s/Np], [km/s]
+   rvo = crx * (xo-xc)
+   chi2map = npix + ((vgrid-rvo[:,np.newaxis]) / e_rvo)**2
+   oo = np.ones(nord, dtype=bool)
+   rchi = np.ones(nord)
+   gg = Chi2Map(chi2map, (v_lo, v_step), 0., e_rvo, rvo, e_rvo+0*rvo, orders=oo, keytitle='synth', rchi=rchi, No=npix+0*rchi)
+
+   calls = [
+      ('polyreg', polyreg, (x2, y2, e2, 0.), dict(deg=3)),
+      ('spl_evf', tpl, (x2,), {}),
+      ('Tpl.shifted', tpl.shifted, (x2, np.arange(v_lo, v_hi, v_step)), {}),
+      ('Tpl(ucbspl)', tplb, (x2,), {}),
+      ('Tpl(ucbspl).shifted', tplb.shifted, (x2, np.arange(v_lo, v_hi, v_step)), {}),
+      ('ucbspl_fit', spl.ucbspl_fit, (x2, y2, 1/e2**2), dict(K=x2.size/2, lam=0.00001, e_yk=True, retfit=True)),
+      ('CCF', CCF, (wt, ft, x2, y2, v_lo, v_hi), dict(e_y2=e2, ccfmode='box')),
+      ('Chi2Map.mlcrx', gg.mlcrx, (xo, xc, oo), {}),
+   ]
+   print 'kernels (order %s, %s pixels):' % (o, x2.size)
+   res = {}
+   for name, func, args, kwargs in calls:
+      try:
+         dt = timeit(func, *args, **kwargs)
+      except Exception as exc:
+         print '   %-20s FAILED: %r' % (name, exc)
+         continue
+      res[name] = dt
+      print '   %-20s %10.3f ms  %10.1f calls/s' % (name, dt*1000, 1/dt)
+   if 'Chi2Map.mlcrx' in res:
+      print '   mlcrx: crx = %.2f +/- %.2f m/s/Np (injected: %.2f)' % (gg.crx, gg.e_crx, crx*1000)
+   return res
+
+def solvers(star, spec0):
+   '''Compares v and e_v of -vsolver newton and grid on the central order. Returns True if they agree.'''
+   import serval
+   from serval import Tpl, fitspec
+   serval.v_lo, serval.v_hi, serval.v_step = -5.5, 5.6, 0.1
+
+   w, f, e, berv, rv = spec0
+   o = len(w) / 2
+   x2 = redshift(np.log(w[o]), vo=berv)   # barycentric
+   xk = np.linspace(x2[0]-vpad/c, x2[-1]+vpad/c, 4*x2.size)
+   tpl = Tpl(xk, star(o, xk), cubicSpline.spl_cf, cubicSpline.spl_evf)
+   res = {}
+   for vsolver in ('grid', 'newton'):
+      par = fitspec(tpl, x2, f[o], e[o], v=0., clip=5., nclip=2, vsolver=vsolver)[0]
+      res[vsolver] = v, e_v = par.params[0]*1000, par.perror[0]*1000
+      print '   %-8s v = %8.3f +/- %.3f m/s' % (vsolver, v, e_v)
+   (vg, e_vg), (vn, e_vn) = res['grid'], res['newton']
+   ok = abs(vn-vg) < 0.2*e_vg and abs(e_vn/e_vg-1) < 0.1
+   print 'vsolver: newton - grid = %.3f m/s (injected v = %.3f m/s)  %s' % (vn-vg, rv, 'ok' if ok else 'FAILED')
+   return ok
+
+def moments(star, spec0):
+   '''Compares the SSR curve of polymom_grid+polysolve_grid (with a downdate as in the clipping) with polyreg_grid. Returns True if they agree.'''
+   from serval import Tpl, polyreg_grid, polymom_grid, polysolve_grid
+   from calcspec import calcspec
+
+   w, f, e, berv, rv = spec0
+   o = len(w) / 2
+   x2, y2, e2 = redshift(np.log(w[o]), vo=berv), f[o], e[o]
+   xk = np.linspace(x2[0]-vpad/c, x2[-1]+vpad/c, 4*x2.size)
+   calcspec.tpl = Tpl(xk, star(o, xk), cubicSpline.spl_cf, cubicSpline.spl_evf)
+   calcspec.wcen = np.mean(x2)
+   vgrid = np.arange(-5.5, 5.6, 0.1)
+   deg = 4
+   keep = np.arange(x2.size)
+   drop = keep[::10]   # e.g. clipped pixels
+   keep = np.setdiff1d(keep, drop)
+   mom = polymom_grid(x2, y2, e2, vgrid, deg)
+   mom = polymom_grid(x2[drop], y2[drop], e2[drop], vgrid, deg, mom=mom, sign=-1.)
+   SSRm = polysolve_grid(mom, deg)[1]
+   SSRg = polyreg_grid(x2[keep], y2[keep], e2[keep], vgrid, deg)[1]
+   dmax = np.abs(SSRm-SSRg).max()
+   ok = dmax < 0.01   # chi2 units, 1 sigma in v corresponds to a change of 1
+   print 'moments: max|SSR(moments) - SSR(polyreg_grid)| = %.2g (SSR min = %.1f)  %s' % (dmax, SSRg.min(), 'ok' if ok else 'FAILED')
+   return ok
+
+def pipeline(inst, dirname, obj, nproc, opts):
+   '''Runs serval.py and compares the RVs with the injected ones. Returns True for a successful recovery.'''
+   env = dict(os.environ, GNUTERM='dumb')
+   env.pop('DISPLAY', None)
+   if os.path.exists(obj): shutil.rmtree(obj)
+   cmd = [sys.executable, servalsrc+'serval.py', obj, dirname, '-inst', inst, '-brvref', 'DRS', '-tplrv', '0',
+          '-safemode', '-nproc', str(nproc)] + opts
+   print ' '.join(cmd)
+   t0 = time.time()
+   with open(dirname+'serval.out', 'w') as out:
+      ret = subprocess.call(cmd, env=env, stdout=out, stderr=subprocess.STDOUT)
+   dt = time.time() - t0
+   if ret or not os.path.exists(obj+'/'+obj+'.npz'):
+      print 'pipeline FAILED (exitcode %s), see %s' % (ret, dirname+'serval.out')
+      return False
+
+   res = np.load(obj+'/'+obj+'.npz')
+   bjd, rvinj = np.genfromtxt(dirname+obj+'.inj.dat', usecols=(0, 1), unpack=True)
+   nspec = len(res['bjd'])
+   nordok = np.isfinite(res['rv']).sum()
+   print 'pipeline: %s spectra, %s orders in %.1f s (%.3f spectra/s, %.1f orders/s)' % (nspec, nordok, dt, nspec/dt, nordok/dt)
+   if os.path.exists(obj+'/stages.json'):
+      with open(obj+'/stages.json') as f:
+         st = json.load(f)['stages']
+      for name in sorted(st, key=lambda name: -st[name]['wall']):
+         print '   %-20s %6i calls %9.2f s' % (name, st[name]['count'], st[name]['wall'])
+
+   # RVs are relative to the template, compare after removing the weighted mean offset
+   ii = np.searchsorted(bjd, res['bjd']-1e-6)
+   d = res['RVc'] - rvinj[ii]
+   w = 1. / res['e_RVc']**2
+   ok = np.isfinite(d) & np.isfinite(w)
+   d -= np.sum(d[ok]*w[ok]) / np.sum(w[ok])
+   rms = np.sqrt(np.mean(d[ok]**2))
+   e_rv = np.median(res['e_RVc'][ok])
+   recovered = ok.sum() == len(bjd) and rms < 3*e_rv
+   print 'RV recovery: %s/%s spectra, rms(RVc-injected) = %.2f m/s, median e_RVc = %.2f m/s  %s' % (ok.sum(), len(bjd), rms, e_rv, 'ok' if recovered else 'FAILED')
+   return recovered
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description='Benchmark with synthetic spectra.')
+   parser.add_argument('-inst', help='instrument format (default: %(default)s)', default='HARPS', choices=sorted(insts))
+   parser.add_argument('-nspec', help='number of spectra (default: %(default)s)', type=int, default=12)
+   parser.add_argument('-snr', help='peak S/N (default: %(default)s)', type=float, default=150.)
+   parser.add_argument('-nproc', help='serval -nproc (default: %(default)s)', type=int, default=1)
+   parser.add_argument('-dir', help='directory for the synthetic spectra (default: synth_<inst>_data/)')
+   parser.add_argument('-skip', help='parts to skip', nargs='*', default=[], choices=['kernels', 'pipeline'])
+   args, opts = parser.parse_known_args()   # all other options are passed to serval
+
+   obj = 'synth_' + args.inst.lower()
+   dirname = args.dir or obj + '_data'
+   dirname = dirname.rstrip(os.sep) + os.sep
+
+   t0 = time.time()
+   star, spec0 = generate(args.inst, dirname, obj, args.nspec, snr=args.snr)
+   print 'generated %s %s spectra in %s (%.1f s)' % (args.nspec, args.inst, dirname, time.time()-t0)
+
+   ok = True
+   if 'kernels' not in args.skip:
+      kernels(star, spec0)
+      ok = solvers(star, spec0) & ok
+      ok = moments(star, spec0) & ok
+   if 'pipeline' not in args.skip:
+      ok = pipeline(args.inst, dirname, obj, args.nproc, opts) & ok
+   sys.exit(not ok)
@@ -1,7 +1,26 @@
+import numpy as np
 import barycorrpy
 from astropy.time import Time
 from astropy import time, coordinates as coord, units as u
 
+def obsloc(obsname, lat=0., lon=0., elevation=None):
+   """Returns latitude, longitude and elevation for obsname (or the input)."""
+   # translation obsname_idl obsname_py
+   if obsname=='ca':
+      lat = 37.2236
+      lon = -2.5463
+      elevation = 2168.
+   if obsname=='eso':
+      #obsname = 'lasilla'
+      lat = -29.2584 
+      lon = -70.7345
+      elevation = 2400.
+   if obsname=='lapalma':
+       lat = 28.754000
+       lon = -17.88905555
+       elevation = 2387.2
+   return lat, lon, elevation
+
 def bjdbrv(jd_utc, ra, dec, obsname=None, lat=0., lon=0., elevation=None,
         pmra=0., pmdec=0., parallax=0., rv=0., zmeas=0.,
         epoch=2451545.0, tbase=0., **kwargs):
@@ -35,20 +54,7 @@ def bjdbrv(jd_utc, ra, dec, obsname=None, lat=0., lon=0., elevation=None,
    (2457395.247062386, -23684.54364462639)
 
    """
-   # translation obsname_idl obsname_py
-   if obsname=='ca':
-      lat = 37.2236
-      lon = -2.5463
-      elevation = 2168.
-   if obsname=='eso':
-      #obsname = 'lasilla'
-      lat = -29.2584 
-      lon = -70.7345
-      elevation = 2400.
-   if obsname=='lapalma':
-       lat = 28.754000
-       lon = -17.88905555
-       elevation = 2387.2
+   lat, lon, elevation = obsloc(obsname, lat, lon, elevation)
 
    # Barycentric Julian Date
    # adapted from http://docs.astropy.org/en/stable/time/#barycentric-and-heliocentric-light-travel-time-corrections
@@ -72,5 +78,41 @@ def bjdbrv(jd_utc, ra, dec, obsname=None, lat=0., lon=0., elevation=None,
    return (bjd.value, brv[0]) if JDUTC.isscalar else (bjd, brv)
 
 
+def bjdbrv_batch(jd_utcs, ra, dec, obsname=None, lat=0., lon=0., elevation=None,
+        pmra=0., pmdec=0., parallax=0., rv=0., zmeas=0.,
+        epoch=2451545.0, tbase=0., **kwargs):
+   """
+   Vectorised bjdbrv for many epochs of one target in a single call.
+   Target and observatory are set up only once.
+
+   :param jd_utcs: Julian dates (UTC), any shape, e.g. ((N x 3)) for start, mid and end of N spectra
+   The other parameters are as in bjdbrv.
+   :return: BJDs and barycentric corrections [m/s] with the shape of jd_utcs
+
+   Example:
+   --------
+   >>> from brv_we14py import bjdbrv_batch
+   >>> bjd, brv = bjdbrv_batch([[2457395.24563, 2457395.24663]], 4.585590721,  44.02195596, 'ca')
+
+   """
+   lat, lon, elevation = obsloc(obsname, lat, lon, elevation)
+   jd_utcs = np.asarray(jd_utcs, dtype=float)
+
+   targ = coord.SkyCoord(ra, dec, unit=(u.deg, u.deg), frame='icrs')
+   loc = coord.EarthLocation.from_geodetic(lon, lat, height=elevation)
+   JDUTC = Time(jd_utcs.ravel(), format='jd', scale='utc')
+   try:
+      bjd = (JDUTC.tdb + JDUTC.light_travel_time(targ, location=loc)).value
+   except TypeError:
+      # vectorised version fails for some numpy versions
+      # https://github.com/astropy/astropy/issues/7051
+      bjd = np.array([(jdutc.tdb + jdutc.light_travel_time(targ, location=loc)).value for jdutc in JDUTC])
+
+   brv, warning_and_error, status = barycorrpy.get_BC_vel(JDUTC, ra=ra, dec=dec, epoch=epoch, pmra=pmra,
+                   pmdec=pmdec, px=parallax, lat=lat, longi=lon, alt=elevation, **kwargs)
+
+   return bjd.reshape(jd_utcs.shape), np.reshape(brv, jd_utcs.shape)
+
+
 # print bjdbrv(2457395.24563, 4.585590721,  44.02195596, 'ca', leap_update=False)
 
@@ -1,5 +1,4 @@
 import numpy as np
-from scipy import interpolate
 
 from pause import pause
 import cubicSpline
@@ -6,7 +6,7 @@ except:
 
 import cspline as spl
 import paraboloid
-from gplot import *
+from lazyplot import *
 from pause import *
 from wstat import wsem, wmean
 
@@ -8,7 +8,7 @@ from scipy.linalg import solve_banded, solveh_banded
 import os.path
 try:
    # for debugging
-   from gplot import *
+   from lazyplot import *
    from pause import pause
    from ds9 import ds9
 except:
@@ -52,7 +52,7 @@ _cbspline.cholbnd.argtypes = [ptr_double,     # Abnd
 _cbspline.cholbnd_upper.argtypes = _cbspline.cholbnd.argtypes 
 _cbspline.bandsol.argtypes = _cbspline.cholbnd.argtypes
 
-def cbspline_Bk(x, K, xmin=None, xmax=None, fix=True):
+def cbspline_Bk(x, K, xmin=None, xmax=None, fix=True, der=0, extrapolate=False):
    '''
    Uniform cubic B-spline with direct and vectorized computation and compressed storage.
 
@@ -71,6 +71,10 @@ def cbspline_Bk(x, K, xmin=None, xmax=None, fix=True):
        Position of the last knot.
    fix : boolean
        Fixes the end to avoid dummy, recommended for regression.
+   der : integer
+       Derivative (0, 1, 2) of the B-splines (in units of knots).
+   extrapolate : boolean
+       Points outside are attributed to the edge intervals (polynomial continuation).
 
    Returns
    -------
@@ -111,13 +115,33 @@ def cbspline_Bk(x, K, xmin=None, xmax=None, fix=True):
    kk, pp = divmod(x, 1)
    G = np.empty((4, x.size), order='F')
 
-   if fix:
+   if extrapolate:
+      # the knot index by arithmetic, also for the edge knot (as fix)
+      k0 = kk.clip(0, K-2)
+      pp += kk - k0
+      kk = k0
+   elif fix:
       idx, = np.where(kk==K-1)
       if idx.size:
          kk[idx] -= 1
          pp[idx] = 1   # it should be zero before
 
-   if 0:
+   if der:
+      ### derivatives of the B-splines with respect to p
+      qq = 1 - pp
+      if der == 1:
+         G[0] = -qq**2/2
+         G[3] = pp**2/2
+         G[1] = 3*G[3] - 2*pp
+         G[2] = 3*G[0] + 2*qq
+      elif der == 2:
+         G[0] = qq
+         G[3] = pp
+         G[1] = 3*pp - 2
+         G[2] = 3*qq - 2
+      else:
+         raise Exception('Derivative %s not implemented.'%der)
+   elif 0:
       ### direct computation with p
       G[0] = (1-pp)**3/6     # = ((1-pp)-pp*(1-pp))/2
       G[1] = (3*pp**3 - 6*pp**2 + 4)/6
@@ -315,6 +339,8 @@ class ucbspl:
    array([0., 0., 0., 1., 4., 1., 0., 0., 0., 0.])
    >>> cs(5), cs([4.3,5.5])
    (array(1.), array([3.541, 0.125]))
+   >>> cs([4.3,5.5], der=1)
+   array([-2.79, -0.75])
    >>> x = np.r_[:10:0.1]
    >>> gplot(x, cs(x), 'w lp,', cs.xk, cs(), 'pt 7 lt 3')
 
@@ -339,16 +365,19 @@ class ucbspl:
       # knot positions (uniform knot grid)
       self.xk = np.linspace(xmin, self.xmax, num=K)
 
-   def __call__(self, x=None, der=0):
+   def __call__(self, x=None, der=0, border='extrapolate'):
       a = self.a
       if x is None:
          # simplified evaluation for knots only
          return 1./6 * (a[:-2] + 4*a[1:-1] + a[2:])
       else:
-         B, kk = cbspline_Bk(x, self.K, self.xmin, self.xmax)
+         B, kk = cbspline_Bk(x, self.K, self.xmin, self.xmax, der=der, extrapolate=border=='extrapolate')
          # spline evalution  y_i = sum_k a_k*B_k(x_i)
          y = 0.
          for k in [0, 1, 2, 3]: y += a[kk+k] * B[k]
+         if der:
+            # rescale dy/dx = dy/dh * dh/dx
+            y *= ((self.K-1)/(self.xmax-self.xmin))**der
          # y = np.array([np.dot(G[i],a[kki:kki+4]) for i,kki in enumerate(kk)])
          # y = np.sum(G * a.k[kk[:,np.newaxis]+np.arange(4).T], axis=1)
          # y = np.einsum('ij,ij->i', G, a.k[kk[:,np.newaxis]+np.arange(4).T])
@@ -409,6 +438,93 @@ class v_cspl:
       return v_f.reshape(kk.shape)
 
 
+class ucbspl_stream:
+   '''
+   Uniform cubic B-spline fit with normal equations accumulated chunk by chunk.
+
+   As ucbspl_fit, but the data can be added in chunks (e.g. spectrum by spectrum).
+   Only the banded normal equations are kept, i.e. the memory is O(K)
+   independent of the number of data points. The knot range must be given.
+
+   Examples
+   --------
+   >>> x = np.r_[0:100.]
+   >>> y = np.sin(0.1*x)
+   >>> s = ucbspl_stream(K=20, xmin=0, xmax=99)
+   >>> s.add(x[:50], y[:50]); s.add(x[50:], y[50:])
+   >>> np.allclose(s.solve().a, ucbspl_fit(x, y, K=20).a)
+   True
+
+   '''
+   def __init__(self, K=10, xmin=0., xmax=None, nat=True):
+      self.K = K
+      self.xmin = xmin
+      self.xmax = K-1 if xmax is None else xmax
+      self.nat = nat
+      nk = K + 2
+      self.BTy = np.zeros(nk)
+      self.BTBbnd = np.zeros((4, nk))
+      self.wa = np.zeros(nk)   # sum_i Bk(x_i) * w_i for e_yk
+      self.sw = 0.    # sum_i w_i
+      self.swy = 0.   # sum_i w_i * y_i
+
+   def add(self, x, y, w=1.):
+      '''Add data points to the normal equations.'''
+      x = np.asarray(x, dtype=float)
+      if not x.size: return
+      y = np.asarray(y, dtype=float)
+      w = np.asarray(w, dtype=float)
+      if w.size == 1: w = np.full_like(y, w)
+      nk = self.K + 2
+      G, kk = _cbspline_Bk(x, self.K, self.xmin, self.xmax)
+      for k,Gk in enumerate(G):
+         self.wa += np.bincount(kk+k, Gk*w, nk)
+      if self.nat:
+         bk2bknat(G, kk, self.K)
+      _cbspline.rhs_fill(self.BTy, G, np.ascontiguousarray(w*y), kk, kk.size)
+      _cbspline.lhsbnd_fill(self.BTBbnd, G, np.ascontiguousarray(w), kk, kk.size, nk)
+      self.sw += w.sum()
+      self.swy += np.dot(w, y)
+
+   def mean(self):
+      '''Weighted mean of the added data.'''
+      return self.swy / self.sw
+
+   def solve(self, lam=0., pord=2, mu=None, e_mu=None, e_yk=False):
+      '''
+      Solve the normal equations (the accumulated ones are kept).
+
+      Returns
+      -------
+      ucbspl
+         The spline model (with e_yk as in ucbspl_fit).
+      '''
+      K = self.K
+      BTy = 1 * self.BTy
+      BTBbnd = 1 * self.BTBbnd
+      if self.nat:
+         BTy = 1*BTy[1:K+1]
+         BTBbnd = 1*BTBbnd[:,1:K+1]
+      if lam:
+         _cbspline.add_DTD(BTBbnd, BTy.size, lam, pord)
+      wa = self.wa
+      if mu is not None and e_mu:
+         # GP like penality with mu and variance
+         BTy += mu / e_mu**2
+         BTBbnd[0] += 1. / e_mu**2
+         wa = wa + 1. / e_mu**2
+      _cbspline.cholbnd(BTBbnd, BTy, BTy.size, 3)
+
+      a = BTy
+      if self.nat:
+         a = np.r_[2*a[0]-a[1], a, 2*a[K-1]-a[K-2]]
+      mod = ucbspl(a, self.xmin, self.xmax)
+      if e_yk:
+         with np.errstate(divide='ignore'): # yet lam is not handled
+            mod.e_yk = np.sqrt(ucbspl(1./wa, self.xmin, self.xmax)())
+      return mod
+
+
 def ucbspl_fit(x, y=None, w=None, K=10, xmin=None, xmax=None, lam=0., pord=2, mu=None, e_mu=None, nat=True, retfit=False, var=False, e_yk=False, cov=False, plot=False, c=True):
    '''
    Fit a uniform cubic spline to data.
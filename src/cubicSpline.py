@@ -61,16 +61,13 @@ def spl_cf(x,y):
    if np.size(y)==n:
       return spl_int.spl_intf(x, y, n)
 
-def spl_evf(xx, xyk, der=0):
+def spl_derf(xyk, der=1):
    """
-   der : derivative
+   Coefficients of the derivative spline.
 
-   Example
+   Returns
    -------
-   >>> x = np.arange(9)
-   >>> y = x**2
-   >>> xyk = spl_cf(x, y)
-   >>> spl_evf(x, xyk)
+   xyk : tuple for spl_evf with the coefficients of the der-th derivative
 
    Notes
    -----
@@ -85,7 +82,6 @@ def spl_evf(xx, xyk, der=0):
    k_n(1) = 0
    d(1) = 6d
    """
-   xx = np.array(xx)
    x, a, b, k, d = xyk
    b_n = b[-1] + k[-2] + 3*d[-1]  # dummy endpoints
    d_n = 0
@@ -93,8 +89,8 @@ def spl_evf(xx, xyk, der=0):
       # y(x) = a + bx + cx**2 + dx**3
       pass
    elif der==1:
-      # y'(x) = b + 2cx + 3dx**2
-      a, b, k, d = np.append(b, b_n), k[:-1], 3*np.append(d,d_n), 0*d
+      # y'(x) = b + 2cx + 3dx**2 = b + kx + 3dx**2
+      a, b, k, d = np.append(b, b_n), k[:-1], 6*np.append(d,d_n), 0*d
    elif der==2:
       # y''(x) = 2c + 6dx = k + 6dx
       # c = k/2
@@ -103,7 +99,48 @@ def spl_evf(xx, xyk, der=0):
       a, b, k, d  = 6*np.append(d, d_n), 0*b, 0*k, 0*d
    else:
       raise Exception('Derivative %s not implemented.'%der)
-   return spl_int.spl_evf(x, a, b, k, d, np.size(xyk[0]), xx, np.size(xx))
+   return x, a, b, k, d
+
+def spl_evf(xx, xyk, der=0):
+   """
+   der : derivative
+
+   Example
+   -------
+   >>> x = np.arange(9)
+   >>> y = x**2
+   >>> xyk = spl_cf(x, y)
+   >>> spl_evf(x, xyk)
+
+   """
+   xx = np.array(xx)
+   if der: xyk = spl_derf(xyk, der)
+   x, a, b, k, d = xyk
+   return spl_int.spl_evf(x, a, b, k, d, np.size(x), xx, np.size(xx))
+
+def spl_evfd(xx, xyk, fa=1., fo=0.):
+   """
+   Spline and its first and second derivative at fa*xx+fo for many shifts.
+
+   xx : sorted abscissa.
+   fa, fo : Scales (> 0) and offsets of the shifts.
+
+   Returns
+   -------
+   y, dy, ddy : ((nv x nn)) value, first and second derivative
+
+   Example
+   -------
+   >>> xyk = spl_cf(np.arange(9), np.arange(9)**2)
+   >>> y, dy, ddy = spl_evfd(np.arange(8)+0.5, xyk, fo=[0, 0.1])
+
+   """
+   xx = np.asarray(xx, dtype=float)
+   fa, fo = np.broadcast_arrays(np.asarray(fa, dtype=float), np.asarray(fo, dtype=float))
+   fa, fo = fa.ravel(), fo.ravel()
+   x, a, b, k, d = xyk
+   y, dy, ddy = spl_int.spl_evfd(x, a, b, k, d, np.size(x), xx, xx.size, fa, fo, fa.size)
+   return y.T, dy.T, ddy.T
 
 
 def spl_eq_c(x,y):
@@ -0,0 +1,63 @@
+'''
+Lazy stand-ins for gplot.
+
+gplot.py starts a gnuplot process already at import. The objects here
+import gplot and start gnuplot only at their first use. So runs without
+plots (-h, -reana, safemode, workers, batch and service mode) need
+neither gnuplot nor a display.
+
+>>> from lazyplot import *   # instead of: from gplot import *
+>>> gplot(x, y, 'w lp')      # now gnuplot is started
+'''
+
+
+class LazyGplot(object):
+   """
+   Proxy for a Gplot instance, created at first use.
+
+   name : Name of the instance in gplot.py (e.g. 'gplot'). None creates a new Gplot().
+   init : Optional function applied to the instance after creation.
+
+   """
+   def __init__(self, name=None, init=None, *args, **kwargs):
+      self._name = name
+      self._init = init
+      self._args = args
+      self._kwargs = kwargs
+      self._gp = None
+
+   def _gplot(self):
+      if self._gp is None:
+         import gplot
+         if hasattr(gplot, 'gplot_set'):
+            raise ImportError('Please update new gplot.py.')
+         self._gp = getattr(gplot, self._name) if self._name else gplot.Gplot(*self._args, **self._kwargs)
+         if self._init: self._init(self._gp)
+      return self._gp
+
+   def __getattr__(self, name):
+      # only called for attributes not in the proxy, e.g. gplot.key(...)
+      return getattr(self._gplot(), name)
+
+   def __call__(self, *args, **kwargs):
+      return self._gplot()(*args, **kwargs)
+
+   # the operator syntax of gplot: gplot+(...), gplot-(...), gplot<(...), ...
+   def __add__(self, other): return self._gplot() + other
+   def __sub__(self, other): return self._gplot() - other
+   def __lt__(self, other): return self._gplot() < other
+   def __le__(self, other): return self._gplot() <= other
+   def __gt__(self, other): return self._gplot() > other
+   def __ge__(self, other): return self._gplot() >= other
+
+
+def Gplot(*args, **kwargs):
+   '''A new, lazily started Gplot instance (e.g. for a second plot window).'''
+   return LazyGplot(None, None, *args, **kwargs)
+
+def ogplot(*args, **kwargs):
+   import gplot as _gplot
+   gplot._gplot()   # start and setup the main instance
+   return _gplot.ogplot(*args, **kwargs)
+
+gplot = LazyGplot('gplot', init=lambda gp: gp.bar(0).colors('classic'))
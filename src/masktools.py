@@ -1,7 +1,28 @@
 import numpy as np
-from gplot import *
+from lazyplot import *
 from calcspec import *
 
+_maskcache = {}
+
+def loadmask(filename):
+   """
+   Read a mask file (ascii table or fits), cached by filename.
+
+   Returns a copy, since serval modifies the masks (airtovac, invert).
+   A parent process (e.g. servalbatch.py) can preload the masks, which
+   are then inherited by the forked serval runs.
+   """
+   if filename not in _maskcache:
+      if filename.endswith('.fits'):
+         try:
+            import pyfits
+         except:
+            import astropy.io.fits as pyfits
+         _maskcache[filename] = pyfits.getdata(filename)
+      else:
+         _maskcache[filename] = np.genfromtxt(filename, dtype=None)
+   return _maskcache[filename].copy()
+
 def list2mask(filename, wd=4., wl=0.01, merge=True):
    """ convert a line list to a spectrum mask """
    # wd  - [km/s] width applied to line position
@@ -37,3 +58,131 @@ def list2mask(filename, wd=4., wl=0.01, merge=True):
    maskf = np.tile([0., 1, 1, 0], len(maskl))
    mask = np.vstack((maskl.ravel(),maskf)).T
    return mask
+
+
+class IntervalSet(object):
+   """
+   Compact mask as sorted, disjoint open intervals (start, end).
+
+   A point table mask (x, y) with linear interpolation and the threshold
+   y > 0.01 is interval membership. Queries are binary searches.
+
+   Example
+   -------
+   >>> atm = IntervalSet.from_mask(lam2wave(mask[:,0]), mask[:,1])
+   >>> sky = IntervalSet([np.log(7000.)], [np.log(7000.5)])
+   >>> msk = atm | sky
+   >>> msk(sp.w)                 # boolean array for all orders
+   >>> msk.redshift(vo=sp.berv)  # the set shifted to another frame
+   >>> msk.save('mask.dat'); msk = IntervalSet.load('mask.dat')
+   """
+   def __init__(self, start=(), end=()):
+      start = np.array(start, dtype=float).ravel()
+      end = np.array(end, dtype=float).ravel()
+      ok = start < end   # drop empty intervals
+      start, end = start[ok], end[ok]
+      # sort and merge overlapping (and touching) intervals
+      i = np.argsort(start, kind='mergesort')
+      start, emax = start[i], np.maximum.accumulate(end[i])
+      new = np.r_[True, start[1:] > emax[:-1]]   # first interval of a group
+      last = np.r_[new[1:], True]                # last interval of a group
+      self.start = start[new]
+      self.end = emax[last]
+
+   @classmethod
+   def from_mask(cls, x, y, thres=0.01):
+      '''Intervals where the linearly interpolated point table is above thres (constant beyond the ends).'''
+      x = np.asarray(x, dtype=float)
+      y = np.asarray(y, dtype=float)
+      up = y > thres
+      d = np.diff(up.astype(int))
+      k, = np.nonzero(d)   # segments with a crossing
+      with np.errstate(divide='ignore', invalid='ignore'):
+         xc = x[k] + (thres-y[k]) * (x[k+1]-x[k]) / (y[k+1]-y[k])
+      start, end = xc[d[k]>0], xc[d[k]<0]
+      if up.size and up[0]: start = np.r_[-np.inf, start]
+      if up.size and up[-1]: end = np.r_[end, np.inf]
+      return cls(start, end)
+
+   @classmethod
+   def from_pixels(cls, w, msk):
+      '''Intervals for the flagged pixels (msk != 0) with wavelengths w, e.g. a pixel mask for all orders (nord x npix).'''
+      w = np.atleast_2d(w)
+      msk = np.atleast_2d(msk) != 0
+      # pixel edges halfway to the neighbours
+      we = np.hstack((1.5*w[:,:1]-0.5*w[:,1:2], 0.5*(w[:,1:]+w[:,:-1]), 1.5*w[:,-1:]-0.5*w[:,-2:-1]))
+      dm = np.diff(np.hstack((np.zeros((len(msk),1), bool), msk, np.zeros((len(msk),1), bool))).astype(int), axis=1)
+      return cls(we[dm>0], we[dm<0])
+
+   @classmethod
+   def load(cls, filename):
+      start, end = np.loadtxt(filename, ndmin=2).T
+      return cls(start, end)
+
+   def save(self, filename):
+      np.savetxt(filename, np.c_[self.start, self.end], fmt='%.17g', header='start end')
+
+   def __len__(self):
+      return self.start.size
+
+   def __call__(self, x):
+      '''Returns True for x inside the intervals (x can have any shape).'''
+      x = np.asarray(x)
+      if not len(self): return np.zeros(x.shape, dtype=bool)
+      i = np.searchsorted(self.start, x) - 1   # last start < x
+      return (i >= 0) & (x < self.end[np.maximum(i, 0)])
+
+   def union(self, *others):
+      return IntervalSet(np.concatenate([self.start] + [s.start for s in others]),
+                         np.concatenate([self.end] + [s.end for s in others]))
+
+   __or__ = union
+
+   def redshift(self, vo=0., ve=0.):
+      '''The set with the bounds mapped by calcspec.redshift, i.e. s.redshift(vo, ve)(redshift(w, vo, ve)) == s(w).'''
+      return IntervalSet(redshift(self.start, vo=vo, ve=ve), redshift(self.end, vo=vo, ve=ve))
+
+
+class MaskSet(object):
+   """
+   Several masks flagged together on whole spectra.
+
+   Each mask is an IntervalSet with flag bits. Masks with the same bits
+   and frame are merged. A mask can belong to another frame (e.g. the
+   template frame). Then either the wavelengths in this frame are passed
+   by name or the velocities (vo, ve), which shift the few interval bounds
+   instead of all pixels. The wavelengths can have any shape, e.g. all
+   orders (nord x npix).
+
+   Example
+   -------
+   >>> atm = IntervalSet.from_mask(lam2wave(mask[:,0]), mask[:,1])
+   >>> masks = MaskSet()
+   >>> masks.add(atm, flag.atm)
+   >>> masks.add(atm, flag.badT, frame='tpl')
+   >>> bpmap = sp.bpmap | masks(sp.w, tpl=(v, 0.))   # tpl frame is redshift(w, vo=v)
+   """
+   def __init__(self):
+      self.masks = []
+
+   def add(self, mask, bits, frame=None):
+      for i, (msk, b, f) in enumerate(self.masks):
+         if (b, f) == (bits, frame):
+            self.masks[i] = msk | mask, b, f
+            return
+      self.masks.append((mask, bits, frame))
+
+   def __call__(self, w, **frames):
+      '''Returns the flag bits for wavelengths w. Masks of frames not given (or None) are skipped.'''
+      b = np.zeros(np.shape(w), dtype=int)
+      for mask, bits, frame in self.masks:
+         wf = w
+         if frame:
+            wf = frames.get(frame)
+            if wf is None: continue
+            if isinstance(wf, tuple):
+               # mask(redshift(w, vo, ve)) with the inverse shift of the mask; nan velocities as zero
+               vo, ve = np.nan_to_num(wf)
+               mask, wf = mask.redshift(vo=ve, ve=vo), w
+         b[mask(wf)] |= bits
+      return b
@@ -1,7 +1,7 @@
 #from __future__ import print_function
 
 import numpy as np
-from gplot import *
+from lazyplot import *
 from pause import *
 #def pause():
 #   pass
@@ -121,6 +121,28 @@ double polyfit(double *wave, double *flux, double *ferr, double *fmod, double in
    return chisq(wave, flux, ferr, fmod, ind, n, wcen, deg, p);
 }
 
+int polyfit_grid(double *wave, double *flux, double *ferr, double *fmod, double ind, int n, int nv, double wcen, int deg, double *p, double *ssr) {
+   /* polyfit for a set of nv models, e.g. the template shifted to each velocity of a grid
+      fmod - the models ((nv x n))
+      p - polynomial coefficients for each model ((nv x deg))
+      ssr - chisq for each model ((nv)), -1 if the matrix is not positive definite
+      The results are identical to nv single calls of polyfit.
+   */
+   int j;
+   double *lhs = malloc(deg * deg * sizeof(double));
+   double *covar = malloc((2*deg-1) * sizeof(double));
+
+   if (lhs == NULL || covar == NULL) {
+      free(lhs); free(covar);
+      return 1;
+   }
+   for (j=0; j<nv; ++j)
+      ssr[j] = polyfit(wave, flux, ferr, fmod+(long)j*n, ind, n, wcen, deg, p+(long)j*deg, lhs, covar);
+
+   free(lhs); free(covar);
+   return 0;
+}
+
 
 void interpol1D(double *xn, double *yn, double *x, double *y, int nn, int n) {
    /* xn and x must be sorted */
@@ -142,4 +164,67 @@ void interpol1D(double *xn, double *yn, double *x, double *y, int nn, int n) {
    }
 }
 
+int polymom_grid(double *wave, double *flux, double *ferr, double *fmod, double ind, int n, int nv, double wcen, int deg, double *mom, double sign) {
+   /* moments of the normal equations of polyfit for a set of nv models
+      fmod - the models ((nv x n))
+      mom - moments for each model ((nv x 3*deg)): the 2*deg-1 matrix moments wi*xi^k,
+            the deg rhs moments wi*yi*xi^k and wi*yi^2
+      sign - 1 adds the n pixels, -1 removes them (downdate, e.g. for clipped pixels)
+   */
+   int i, j, k, m = 3*deg;
+   double xi, yi, wi, mo, *A, *b, *fm;
+
+   for (j=0; j<nv; ++j) {
+      A = mom + (long)j*m;
+      b = A + 2*deg-1;
+      fm = fmod + (long)j*n;
+      for (i=0; i<n; ++i) {
+         if (fm[i]>ind) {
+            xi = wave[i]-wcen;
+            yi = flux[i]/fm[i];
+            wi = fm[i]/ferr[i];
+            wi *= sign * wi;
+
+            mo = wi * yi;
+            b[0] += mo;
+            for (k=1; k<deg; ++k) b[k] += (mo *= xi);
+            b[deg] += wi * yi * yi;
+            mo = wi;
+            A[0] += mo;
+            for (k=1; k<2*deg-1; ++k) A[k] += (mo *= xi);
+         }
+      }
+   }
+   return 0;
+}
+
+int polysolve_grid(double *mom, int nv, int deg, double *p, double *ssr) {
+   /* solves the normal equations from the moments of polymom_grid
+      p - polynomial coefficients for each model ((nv x deg))
+      ssr - chisq = wi*yi^2 - p.b for each model ((nv)), -1 if the matrix is not positive definite
+   */
+   int i, j, k, m = 3*deg;
+   double *A, *b, *pj;
+   double *lhs = malloc(deg * deg * sizeof(double));
+
+   if (lhs == NULL) return 1;
+   for (j=0; j<nv; ++j) {
+      A = mom + (long)j*m;
+      b = A + 2*deg-1;
+      pj = p + (long)j*deg;
+      for (k=0; k<deg; ++k) {
+         pj[k] = b[k];
+         for (i=0; i<deg; ++i) lhs[k+deg*i] = A[k+i];
+      }
+      if (cholsol(lhs, pj, deg)) {
+         ssr[j] = -1.0;
+         continue;
+      }
+      ssr[j] = b[deg];
+      for (k=0; k<deg; ++k) ssr[j] -= pj[k] * b[k];
+   }
+   free(lhs);
+   return 0;
+}
+
 /* http://rosettacode.org/wiki/Cholesky_decomposition#C */
@@ -10,9 +10,14 @@ import sys
 import tarfile
 import time
 import warnings
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import hashlib
 
 
+try:
+   import cPickle as pickle
+except ImportError:
+   import pickle
 try:
    import pyfits
 except:
@@ -20,10 +25,8 @@ except:
 #import fitsio
 import numpy as np
 
-import brv_we14idl
-import brv_we14html
 from pause import pause, stop
-from gplot import *
+from lazyplot import *
 import sunrise
 
 class nameddict(dict):
@@ -76,7 +79,7 @@ sflag = nameddict(
 # bpmap flags
 flag_cosm = flag.sat  # @ FEROS for now use same flag as sat
 def_wlog = True
-brvref = ['DRS', 'MH', 'WEhtml', 'WEidl', 'WE']
+brvref = ['DRS', 'MH', 'MHlib', 'WEhtml', 'WEidl', 'WE']
 
 class Spectrum:
    """
@@ -91,12 +94,18 @@ class Spectrum:
 
    """
    brvref = 'MH' # can be overwritten by serval.py depending on user input
-   def __init__(self, filename, inst='HARPS', pfits=True, orders=None, wlog=def_wlog, drs=False, fib=None, targ=None, verb=False):
+   cache = None  # SpecCache, can be set by serval.py
+   def __init__(self, filename, inst='HARPS', pfits=True, orders=None, wlog=def_wlog, drs=False, fib=None, targ=None, verb=False, index=None, brvbatch=False):
       """
       pfits : fits reader
              True: pyfits (safe, e.g. to get the full header of the start refence spectrum)
              2: my own simple pure python fits reader, faster than pyfits
              It was developed for HARPS e2ds, but the advent ADP.*.tar was difficult.
+      index : ScanIndex
+             If it has a valid entry, the header scan and barycentric correction
+             are skipped. The file is then opened only when data are requested.
+      brvbatch : For brvref WE and MHlib, postpone the barycentric correction to
+             a later bjdbrv_batch call for all spectra.
 
       """
       self.filename = filename
@@ -130,6 +139,19 @@ class Spectrum:
       if '.gz' in filename: pfits=True
 
       self.ccf = type('ccf',(), dict(rvc=np.nan, err_rvc=np.nan, bis=np.nan, fwhm=np.nan, contrast=np.nan, mask=0, header=0))
+      self.pfits = pfits
+      self.restored = False
+
+      if index is not None:
+         self.scankey = repr((inst.name, self.brvref, drs, fib) + ((targ.name, targ.ra, targ.de, targ.pmra, targ.pmde) if targ else ()))
+         state = index.lookup(filename, self.scankey)
+         if state:
+            self.restore(state)
+            if verb:
+               print "scan %s:"%self.instname, self.timeid, self.obj, self.drsbjd, self.sn55, self.drsberv, self.drift, self.flag, self.calmode, '(index)'
+            if orders is not None:
+               self.read_data(orders=orders, wlog=wlog)
+            return
 
       # scan fits header for times, modes, snr, etc.
       #read_spec(self, filename, inst=inst, pfits=pfits, verb=verb)
@@ -150,12 +172,21 @@ class Spectrum:
       if targ and targ.name == 'cal':
          self.bjd, self.berv = self.drsbjd, 0.
       elif targ and targ.ra:  # unique coordinates
-         if self.brvref == 'MH':
+         if self.brvref in ('MH', 'MHlib'):
             # fastest version
             #sys.path.append(os.environ['HOME']+'/programs/BarCor/')
             sys.path.insert(1, sys.path[0]+os.sep+'BarCor')            # bary now in src/BarCor
             import bary
-            self.bjd, self.berv = bary.bary(self.dateobs, targ.ra, targ.de, inst.name, epoch=2000, exptime=self.exptime*2* self.tmmean, pma=targ.pmra, pmd=targ.pmde)
+            if self.brvref == 'MHlib' and brvbatch:
+               # postponed to bjdbrv_batch
+               self.brvargs = dict(rammss=targ.ra, demmss=targ.de, inst=inst.name, epoch=2000, pma=targ.pmra, pmd=targ.pmde)
+               self.brvtime = self.dateobs, self.exptime*2* self.tmmean
+               self.bjd, self.berv = np.nan, np.nan
+            elif self.brvref == 'MHlib':
+               # in-process BarCor
+               self.bjd, self.berv = bary.barylib(self.dateobs, targ.ra, targ.de, inst.name, epoch=2000, exptime=self.exptime*2* self.tmmean, pma=targ.pmra, pmd=targ.pmde)
+            else:
+               self.bjd, self.berv = bary.bary(self.dateobs, targ.ra, targ.de, inst.name, epoch=2000, exptime=self.exptime*2* self.tmmean, pma=targ.pmra, pmd=targ.pmde)
          if self.brvref in ('WEhtml', 'WEidl', 'WE'):
             # Wright & Eastman (2014) via online or idl request
             # cd /home/raid0/zechmeister/idl/exofast/bary
@@ -167,16 +198,23 @@ class Spectrum:
             de = (targ.de[0] + np.copysign(targ.de[1]/60. + targ.de[2]/3600., targ.de[0]))       # [deg]
             obsname = inst.obsname #{'CARM_VIS':'ca', 'CARM_NIR':'ca', 'FEROS':'eso', 'HARPS':'eso', 'HARPN':'lapalma', 'HPF':'hpf'}[inst]
             obsloc = inst.obsloc if hasattr(inst, 'obsloc') else {}
-            if self.brvref == 'WE':
+            if self.brvref == 'WE' and brvbatch:
+               # postponed to bjdbrv_batch
+               self.brvargs = dict(ra=ra, dec=de, obsname=obsname, pmra=targ.pmra, pmdec=targ.pmde, parallax=0., rv=0., zmeas=[0], **obsloc)
+               self.brvtime = jd_utcs
+               self.bjd, self.berv = np.nan, np.nan
+            elif self.brvref == 'WE':
                # pure python version
                import brv_we14py
                #self.bjd, self.berv = brv_we14py.bjdbrv(jd_utc=jd_utc[0], ra=ra, dec=de, obsname=obsname, pmra=targ.pmra, pmdec=targ.pmde, parallax=0., rv=0., zmeas=[0])
                (_, self.bjd, _), (self.berv_start, self.berv, self.berv_end) = brv_we14py.bjdbrv(jd_utc=jd_utcs, ra=ra, dec=de, obsname=obsname, pmra=targ.pmra, pmdec=targ.pmde, parallax=0., rv=0., zmeas=[0], **obsloc)
             elif self.brvref == 'WEhtml':
+               import brv_we14html
                self.bjd = brv_we14html.utc2bjd(jd_utc=jd_utc, ra=ra, dec=de)
                #self.berv = brv_we14html.bvc(jd_utc=jd_utc, ra="%s+%s+%s"%targ.ra, dec="%s+%s+%s"%targ.de, obsname='ca', pmra=targ.pmra, pmdec=targ.pmde, parallax=0., rv=0., zmeas=[0], raunits='hours', deunits='degrees')[0]
                self.berv_start, self.berv, self.berv_end = brv_we14html.bvc(jd_utc=jd_utcs, ra="%s+%s+%s"%targ.ra, dec="%s+%s+%s"%targ.de, obsname='ca', pmra=targ.pmra, pmdec=targ.pmde, parallax=0., rv=0., zmeas=[0], raunits='hours', deunits='degrees')
             else:
+               import brv_we14idl
                self.bjd, self.berv = brv_we14idl.bjdbrv(jd_utc=jd_utc[0], ra=ra, dec=de, obsname=obsname, pmra=targ.pmra, pmdec=targ.pmde, parallax=0., rv=0., zmeas=[0])
 
             self.berv /= 1000.   # m/s to km/s
@@ -216,6 +254,22 @@ class Spectrum:
          self.read_data(orders=orders, wlog=wlog)
 #         self.data(orders=orders, wlog=wlog)
 
+   def scanstate(self):
+      """Returns the plain attributes from the header scan and barycentric correction."""
+      plain = (bool, int, long, float, str, unicode, type(None), datetime.datetime, np.number)
+      state = dict((key, val) for key, val in self.__dict__.items() if isinstance(val, plain))
+      state['ccf'] = dict((key, getattr(self.ccf, key)) for key in ('rvc', 'err_rvc', 'bis', 'fwhm', 'contrast', 'mask') if hasattr(self.ccf, key))
+      state['obs'] = dict(lat=self.obs.lat, lon=self.obs.lon)
+      return state
+
+   def restore(self, state):
+      """Set the attributes from scanstate, header and data are read on demand."""
+      self.__dict__.update(state)
+      self.ccf = type('ccf', (), state['ccf'])
+      self.obs = type('specdata', (object,), state['obs'])
+      self.header = None
+      self.restored = True
+
    def __get_item__(self, order):
       # spectrum needs to be dict like
       return self.get_data(order)
@@ -226,15 +280,31 @@ class Spectrum:
       if self.w:
          w, f, e, b = self.w[o], self.f[o], self.e[o], self.bpmap[o]
       else:
-#         w, f, e, b = read_spec(self, self.filename, inst=self.inst, orders=orders, **kwargs)
-         w, f, e, b = self.data(self, orders=orders, **kwargs)
-         w = np.log(w) if wlog else w.astype(np.float)
-         f = f.astype(float)
-         e = e.astype(float)
+         if self.cache is not None:
+            w, f, e, b = self.cache.get(self, orders=orders, wlog=wlog, **kwargs)
+         else:
+            w, f, e, b = self.load(orders=orders, wlog=wlog, **kwargs)
          self.bflag |= np.bitwise_or.reduce(b.ravel())
       return type('specdata', (object,),
                dict(w=w, f=f, e=e, bpmap=b, berv=self.berv, o=o))
 
+   def reopen(self):
+      """Header scan of a restored spectrum (ScanIndex), needed before reading the data."""
+      if self.restored:
+         # header scan was skipped; open the file now
+         self.scan(self, self.filename, pfits=self.pfits)
+         self.restored = False
+
+   def load(self, orders=np.s_[:], wlog=def_wlog, **kwargs):
+      """Read the data from file and convert wavelength and types."""
+#      w, f, e, b = read_spec(self, self.filename, inst=self.inst, orders=orders, **kwargs)
+      self.reopen()
+      w, f, e, b = self.data(self, orders=orders, **kwargs)
+      w = np.log(w) if wlog else w.astype(np.float)
+      f = f.astype(float)
+      e = e.astype(float)
+      return w, f, e, b
+
    def read_data(self, verb=False, **kwargs):
       """Read only data, no header, store it as an attribute."""
       data = self.get_data(**kwargs)
@@ -244,6 +314,244 @@ class Spectrum:
          self.w, self.f, self.e, self.bpmap = data.w, data.f, data.e, data.bpmap
 
 
+def filestamp(filename):
+   """Size and mtime to detect changed files."""
+   st = os.stat(filename)
+   return st.st_size, st.st_mtime
+
+
+class ScanIndex(dict):
+   """
+   Persistent index for the header scan.
+
+   Maps the absolute filename to the Spectrum.scanstate. An entry is valid,
+   when file size, mtime and the key (barycentric setup) are unchanged.
+
+   Examples
+   --------
+   >>> idx = ScanIndex('gj699/gj699.scan.pkl')
+   >>> sp = Spectrum(filename, inst=inst, targ=targ, index=idx)
+   >>> if not sp.restored: idx.put(sp)
+   >>> idx.save()
+
+   """
+   def __init__(self, filename):
+      self.filename = filename
+      self.modified = False
+      if os.path.exists(filename):
+         try:
+            with open(filename, 'rb') as f:
+               self.update(pickle.load(f))
+         except Exception as e:
+            print 'WARNING: cannot read scan index', filename, e
+
+   def stamp(self, filename):
+      return filestamp(filename)
+
+   def lookup(self, filename, key):
+      entry = self.get(os.path.abspath(filename))
+      if entry and entry['key'] == key and entry['stamp'] == self.stamp(filename):
+         return entry['state']
+
+   def put(self, sp):
+      self[os.path.abspath(sp.filename)] = {'stamp': self.stamp(sp.filename), 'key': sp.scankey, 'state': sp.scanstate()}
+      self.modified = True
+
+   def save(self):
+      if self.modified:
+         tmp = self.filename + '.tmp'
+         with open(tmp, 'wb') as f:
+            pickle.dump(dict(self), f, pickle.HIGHEST_PROTOCOL)
+         os.rename(tmp, self.filename)   # atomic update
+         self.modified = False
+
+
+def bjdbrv_batch(splist):
+   """
+   Barycentric correction (WE or MHlib) for all spectra initialised with brvbatch.
+   Spectra with the same target and observatory are done in one call.
+
+   """
+   groups = {}
+   for sp in splist:
+      if getattr(sp, 'brvargs', None):
+         groups.setdefault(repr((sp.brvref, sorted(sp.brvargs.items()))), []).append(sp)
+
+   for group in groups.values():
+      if group[0].brvref == 'WE':
+         import brv_we14py
+         bjds, bervs = brv_we14py.bjdbrv_batch([sp.brvtime for sp in group], **group[0].brvargs)
+         bjds = bjds[:,1]
+         bervs = 1. * bervs
+         bervs[:,1] /= 1000.   # m/s to km/s, berv_start and berv_end stay in m/s as in Spectrum.__init__
+      else:
+         import bary
+         dateobs, exptime = zip(*[sp.brvtime for sp in group])
+         bjds, bervs = bary.barylib(list(dateobs), exptime=exptime, **group[0].brvargs)
+      for sp, bjd, berv in zip(group, bjds, bervs):
+         sp.bjd = bjd
+         if sp.brvref == 'WE':
+            sp.berv_start, sp.berv, sp.berv_end = berv
+         else:
+            sp.berv = berv
+         if sp.fib == 'B':
+            sp.berv = np.nan
+         if sp.header is not None:
+            sp.header['HIERARCH SERVAL BJD'] = (sp.bjd, 'Barycentric Julian Day')
+            sp.header['HIERARCH SERVAL BERV'] = (sp.berv, '[km/s] Barycentric correction')
+         del sp.brvargs, sp.brvtime
+
+
+class SpecCache(object):
+   """
+   Cache for the preprocessed data (w, f, e, bpmap) of all orders.
+
+   The recently used spectra are kept in memory up to maxmem bytes. With a
+   directory, the data are also stored as .npy files and memory mapped in
+   later iterations and runs. Entries are invalid, when size or mtime of
+   the file change. get returns copies, so the cached data cannot be altered.
+   The disk store holds all orders of each spectrum (about the size of the
+   fits files); prune removes the entries of spectra not in this run.
+   The memory part is per process, i.e. the pmap workers (nproc>1) fill
+   their own copies, which are discarded; only the disk store is shared.
+
+   Examples
+   --------
+   >>> Spectrum.cache = SpecCache(2e9, 'gj699/cache/')
+   >>> sp.get_data(orders=20)   # reads all orders once
+   >>> Spectrum.cache.prune(splist)
+
+   """
+   def __init__(self, maxmem=2e9, dirname=None):
+      self.maxmem = maxmem
+      self.dirname = dirname
+      self.mem = OrderedDict()
+      self.nbytes = 0
+      self.seen = set()
+      if dirname and not os.path.exists(dirname):
+         os.makedirs(dirname)
+
+   def key(self, sp, wlog):
+      key = repr((os.path.abspath(sp.filename), filestamp(sp.filename), sp.inst.name, sp.drs, sp.fib, wlog))
+      return hashlib.md5(key).hexdigest()
+
+   def get(self, sp, orders=np.s_[:], wlog=def_wlog, **kwargs):
+      key = self.key(sp, wlog)
+      self.seen.add(key)
+      data = self.mem.pop(key, None)
+      if data is not None:
+         self.nbytes -= self.size(data)
+      elif self.dirname:
+         names = [os.path.join(self.dirname, key+'.'+x+'.npy') for x in 'wfeb']
+         if all(os.path.exists(name) for name in names):
+            data = [np.load(name, mmap_mode='r') for name in names]
+      if data is None:
+         data = sp.load(orders=np.s_[:], wlog=wlog, **kwargs)
+         if self.dirname:
+            self.save(key, data)
+      self.put(key, data)
+      return [np.array(x[orders]) for x in data]
+
+   def size(self, data):
+      # memory mapped arrays do not count
+      return sum(x.nbytes for x in data if not isinstance(x, np.memmap))
+
+   def put(self, key, data):
+      # least recently used are at the beginning
+      self.mem[key] = data
+      self.nbytes += self.size(data)
+      while self.nbytes > self.maxmem and len(self.mem) > 1:
+         _, old = self.mem.popitem(last=False)
+         self.nbytes -= self.size(old)
+
+   def save(self, key, data):
+      # parallel workers can save the same spectrum, each via its own tmp file
+      for x, a in zip('wfeb', data):
+         name = os.path.join(self.dirname, key+'.'+x+'.npy')
+         tmp = '%s.%d.tmp' % (name, os.getpid())
+         with open(tmp, 'wb') as f:
+            np.save(f, a)
+         try:
+            os.rename(tmp, name)   # atomic, the last one wins
+         except OSError:
+            if os.path.exists(tmp): os.remove(tmp)
+
+   def prune(self, splist=(), wlog=def_wlog):
+      """
+      Remove the stored entries except for the spectra in splist and those
+      requested in this process (the keys seen in pmap workers are not known here).
+      """
+      if not self.dirname: return
+      keep = self.seen | set(self.key(sp, wlog) for sp in splist)
+      for name in os.listdir(self.dirname):
+         if name.endswith('.npy') and name.split('.')[0] not in keep:
+            os.remove(os.path.join(self.dirname, name))
+
+
+class OrderStore(object):
+   """
+   Order-major store of the data of a spectrum list (e.g. for coadding).
+
+   For each order a memory mapped .npy file with shape (nspec, 4, npix)
+   holds w, f, e, bpmap of all spectra, so looping over the spectra for
+   one order reads a contiguous block. The store is reused, when the file
+   list with size and mtime is unchanged. Flagged spectra are not read.
+   When all spectra are flagged, the store is empty (false in a boolean
+   context, e.g. `store.get(i, o) if store else ...`).
+
+   Examples
+   --------
+   >>> store = OrderStore('gj699/ostore/', splist)
+   >>> spo = store.get(i, o)   # like splist[i].get_data(orders=o)
+
+   """
+   def __init__(self, dirname, splist, wlog=def_wlog):
+      self.dirname = dirname
+      self.berv = [sp.berv for sp in splist]
+      key = repr([(os.path.abspath(sp.filename), filestamp(sp.filename), sp.drs, sp.fib, sp.flag) for sp in splist] + [wlog])
+      indexfile = os.path.join(dirname, 'index.pkl')
+      self.nord = None
+      if os.path.exists(indexfile):
+         with open(indexfile, 'rb') as f:
+            index = pickle.load(f)
+         if index['key'] == key:
+            self.nord = index['nord']
+      if self.nord is None:
+         self.build(splist, wlog)
+         with open(indexfile, 'wb') as f:
+            pickle.dump({'key': key, 'nord': self.nord}, f, pickle.HIGHEST_PROTOCOL)
+      self.data = [np.load(self.name(o), mmap_mode='r') for o in range(self.nord or 0)]
+
+   def __nonzero__(self):
+      return bool(self.data)
+
+   def name(self, o):
+      return os.path.join(self.dirname, 'o%02i.npy' % o)
+
+   def build(self, splist, wlog=def_wlog):
+      if not os.path.exists(self.dirname):
+         os.makedirs(self.dirname)
+      data = None
+      for i,sp in enumerate(splist):
+         if sp.flag: continue
+         spi = sp.get_data(pfits=2, wlog=wlog)
+         if data is None:
+            self.nord, npix = spi.f.shape
+            data = [np.lib.format.open_memmap(self.name(o), mode='w+', shape=(len(splist), 4, npix)) for o in range(self.nord)]
+            for a in data: a[:] = np.nan
+         for o in range(self.nord):
+            data[o][i] = spi.w[o], spi.f[o], spi.e[o], spi.bpmap[o]
+      if data is None: return   # all flagged, nord stays None
+      for a in data: a.flush()
+
+   def get(self, i, o):
+      if not self.data:
+         raise IndexError('empty order store (all spectra flagged)')
+      w, f, e, b = self.data[o][i]
+      return type('specdata', (object,),
+               dict(w=np.array(w), f=np.array(f), e=np.array(e), bpmap=b.astype(int), berv=self.berv[i], o=o))
+
+
 class Inst:
    def __init__(self, inst):
       pass
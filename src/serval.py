@@ -8,13 +8,22 @@ SERVAL - SpEctrum Radial Velocity AnaLyser (%s)
 ''' % (__version__, __author__)
 
 import argparse
+import contextlib
 import copy
 import ctypes
 from ctypes import c_void_p, c_double, c_int
 import csv
+import functools
 # from datetime import datetime imported with read_spec!
 import glob
+from itertools import chain, izip
+import json
+import multiprocessing
 import os
+try:
+   import cPickle as pickle
+except ImportError:
+   import pickle
 import resource
 import stat as os_stat
 import sys
@@ -24,26 +33,18 @@ import importlib
 
 import numpy as np
 from numpy import std,arange,zeros,where, polynomial,setdiff1d,polyfit,array, newaxis,average
-from scipy import interpolate, optimize
-from scipy.optimize import curve_fit
 
-from gplot import *
+from lazyplot import *   # gnuplot is started at the first plot
 from pause import pause, stop
 from wstat import wstd, wmean, wrms, rms, mlrms, iqr, wsem, nanwsem, nanwstd, naniqr, quantile
 from read_spec import *   # flag, sflag, def_wlog
 from calcspec import *
-from targ import Targ
 import cubicSpline
 import cspline as spl
 import masktools
-import phoenix_as_RVmodel
-from chi2map import Chi2Map
+# scipy.optimize, targ (urllib), phoenix_as_RVmodel and chi2map are imported where needed
 
 gplot2 = Gplot() # for a second plot window
-gplot.bar(0).colors('classic')
-
-if 'gplot_set' in locals():
-   raise ImportError('Please update new gplot.py.')
 
 if tuple(map(int,np.__version__.split('.'))) > (1,6,1):
    np.seterr(invalid='ignore', divide='ignore') # suppression warnings when comparing with nan.
@@ -76,6 +77,34 @@ _pKolynomial.polyfit.argtypes = [
    ptr(dtype=np.float),  # lhs
    ptr(dtype=np.float)   # pstat
 ]
+_pKolynomial.polyfit_grid.argtypes = [
+   ptr(dtype=np.float),  # x2
+   ptr(dtype=np.float),  # y2
+   ptr(dtype=np.float),  # e_y2
+   ptr(dtype=np.float),  # fmod ((nv x n))
+   c_double,             # ind
+   c_int, c_int,         # n, nv
+   c_double, c_int,      # wcen, deg
+   ptr(dtype=np.float),  # p ((nv x deg))
+   ptr(dtype=np.float)   # SSR ((nv))
+]
+_pKolynomial.polymom_grid.argtypes = [
+   ptr(dtype=np.float),  # x2
+   ptr(dtype=np.float),  # y2
+   ptr(dtype=np.float),  # e_y2
+   ptr(dtype=np.float),  # fmod ((nv x n))
+   c_double,             # ind
+   c_int, c_int,         # n, nv
+   c_double, c_int,      # wcen, deg
+   ptr(dtype=np.float),  # mom ((nv x 3*deg))
+   c_double              # sign
+]
+_pKolynomial.polysolve_grid.argtypes = [
+   ptr(dtype=np.float),  # mom ((nv x 3*deg))
+   c_int, c_int,         # nv, deg
+   ptr(dtype=np.float),  # p ((nv x deg))
+   ptr(dtype=np.float)   # SSR ((nv))
+]
 _pKolynomial.interpol1D.argtypes = [
    ptr(dtype=np.float),  # xn
    ptr(dtype=np.float),  # yn
@@ -86,6 +115,10 @@ _pKolynomial.interpol1D.argtypes = [
 
 c = 299792.4580   # [km/s] speed of light
 
+# velocity grid [km/s] and no pauses, when used as a module (set by the options in __main__)
+v_lo, v_hi, v_step = -5.5, 5.6, 0.1
+safemode = 1
+
 def nans(*args, **kwargs):
    return np.nan * np.empty(*args, **kwargs)
 
@@ -130,6 +163,174 @@ class Logger(object):
 
 def minsec(t): return '%um%.3fs' % divmod(t, 60)   # format time
 
+def usage():
+   '''Returns cpu time [s] and peak RSS [MB] of this process.'''
+   usage = resource.getrusage(resource.RUSAGE_SELF)
+   return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024.   # ru_maxrss in kB (Linux)
+
+class Stages(object):
+   """
+   Stage timers with call counts, wall and cpu time and peak RSS.
+
+   Examples
+   --------
+   >>> with stages('scan'):
+   ...    pass
+   >>> @stages.timed('fitspec')
+   ... def fitspec(): pass
+   >>> stages.start('output'); stages.stop('output')
+
+   The times are summed over the calls. Timings of the forked pmap
+   workers are merged back into the parent. write() stores the JSON report.
+
+   """
+   def __init__(self):
+      self.stats = {}   # name: [count, wall, cpu, maxrss]
+      self.running = {}
+      self.t0 = time.time()
+
+   def add(self, name, count, wall, cpu, maxrss):
+      st = self.stats.setdefault(name, [0, 0., 0., 0.])
+      st[0] += count
+      st[1] += wall
+      st[2] += cpu
+      st[3] = max(st[3], maxrss)
+
+   def merge(self, stats):
+      for name, st in stats.items(): self.add(name, *st)
+
+   def start(self, name):
+      self.running[name] = (time.time(),) + usage()
+
+   def stop(self, name):
+      t0, cpu0, _ = self.running.pop(name)
+      cpu, maxrss = usage()
+      self.add(name, 1, time.time()-t0, cpu-cpu0, maxrss)
+
+   @contextlib.contextmanager
+   def __call__(self, name):
+      self.start(name)
+      try:
+         yield
+      finally:
+         self.stop(name)
+
+   def timed(self, name):
+      '''Decorator to time each call of a function.'''
+      def decorator(func):
+         @functools.wraps(func)
+         def wrapper(*args, **kwargs):
+            t0, (cpu0, _) = time.time(), usage()
+            try:
+               return func(*args, **kwargs)
+            finally:
+               cpu, maxrss = usage()
+               self.add(name, 1, time.time()-t0, cpu-cpu0, maxrss)
+         return wrapper
+      return decorator
+
+   def report(self, **info):
+      cpu, maxrss = usage()
+      children = resource.getrusage(resource.RUSAGE_CHILDREN)
+      info.update(wall=time.time()-self.t0, cpu=cpu, maxrss_mb=maxrss,
+                  cpu_children=children.ru_utime+children.ru_stime, maxrss_children_mb=children.ru_maxrss/1024.,
+                  stages=dict((name, dict(count=st[0], wall=st[1], cpu=st[2], maxrss_mb=st[3])) for name, st in self.stats.items()))
+      return info
+
+   def write(self, filename, **info):
+      with open(filename, 'w') as f:
+         json.dump(self.report(**info), f, indent=1, sort_keys=True)
+
+stages = Stages()
+
+_pmapfunc = None   # the work function, inherited by the forked workers
+
+def _pmapcall(args):
+   # the worker returns also its stage timings (the inherited ones are cleared)
+   stages.stats.clear()
+   res = _pmapfunc(*args)
+   return res, stages.stats
+
+def pmap(func, args, nproc=1):
+   """
+   Ordered map of func over the argument tuples args.
+
+   With nproc > 1, the calls are distributed to a pool of forked processes.
+   Since the workers inherit func and all data via fork, func can be a
+   closure; only the arguments and results must be picklable.
+   Returns a generator and the results come in the order of args.
+   """
+   global _pmapfunc
+   if nproc < 2:
+      for arg in args:
+         yield func(*arg)
+      return
+   _pmapfunc = func
+   pool = multiprocessing.Pool(nproc)
+   _pmapfunc = None
+   try:
+      for res, stats in pool.imap(_pmapcall, args):
+         stages.merge(stats)
+         yield res
+      pool.close()
+   finally:
+      pool.terminate()
+      pool.join()
+
+
+class Checkpoint(object):
+   """
+   Checkpoint store for the coadded template orders and the RV results.
+
+   Each finished unit (stage 'tpl' per order, stage 'rv' per spectrum) is
+   pickled as soon as it is done into its own file in dirname, e.g.
+   tpl_2_00042.pkl for order 42 in iteration 2. The files are written
+   via .tmp and rename, so an interrupted run leaves only complete units.
+   The key (input files and options) is kept in key.pkl; with another key
+   the store is cleared.
+
+   """
+   def __init__(self, dirname, key, resume=True):
+      self.dirname = dirname
+      if not os.path.isdir(dirname): os.makedirs(dirname)
+      keyfile = dirname + 'key.pkl'
+      oldkey = None
+      if resume and os.path.exists(keyfile):
+         with open(keyfile, 'rb') as f:
+            oldkey = pickle.load(f)
+      if oldkey != key:
+         self.clear()
+         with open(keyfile, 'wb') as f:
+            pickle.dump(key, f, 2)
+
+   def name(self, stage, iterate, i):
+      return self.dirname + '%s_%s_%05i.pkl' % (stage, iterate, i)
+
+   def get(self, stage, iterate, i):
+      '''Returns the stored result or None.'''
+      try:
+         with open(self.name(stage, iterate, i), 'rb') as f:
+            return pickle.load(f)
+      except (IOError, EOFError, pickle.UnpicklingError):
+         return None
+
+   def put(self, stage, iterate, i, data):
+      filename = self.name(stage, iterate, i)
+      with open(filename+'.tmp', 'wb') as f:
+         pickle.dump(data, f, 2)
+      os.rename(filename+'.tmp', filename)
+
+   def clear(self):
+      for filename in glob.glob(self.dirname+'*.pkl*'):
+         os.remove(filename)
+
+
+class NoCheckpoint(object):
+   """Dummy checkpoint store (without -checkpoint and -resume), nothing is stored."""
+   def get(self, stage, iterate, i): return None
+   def put(self, stage, iterate, i, data): pass
+   def clear(self): pass
+
 
 class interp:
    """interpolation similar to interpolate.interp1d but faster
@@ -145,9 +346,10 @@ class interp:
 
 
 class Tpl:
-   def __init__(self, wk, fk, initfunc, evalfunc, mask=False, berv=None):
+   def __init__(self, wk, fk, initfunc=None, evalfunc=None, mask=False, berv=None, bspl=None):
       '''
       wk : barycentric corrected wavelength
+      bspl : uniform B-spline (cspline.ucbspl) with knots wk, fk; it is evaluated directly (no initfunc, evalfunc).
       '''
       ii = slice(None)
       if mask:
@@ -155,10 +357,42 @@ class Tpl:
       self.wk = wk[ii]
       self.fk = fk[ii]
       self.berv = berv
-      self.funcarg = initfunc(self.wk, self.fk)
-      self.evalfunc = evalfunc
+      self.bspl = bspl
+      self.funcder = {}
+      if bspl is None:
+         self.funcarg = initfunc(self.wk, self.fk)
+         self.evalfunc = evalfunc
+         if evalfunc is cubicSpline.spl_evf:
+            # derivative coefficients once (not at each call)
+            self.funcder = {der: cubicSpline.spl_derf(self.funcarg, der) for der in (1, 2)}
    def __call__(self, w, der=0):
+      if self.bspl is not None:
+         return self.bspl(w, der=der)
+      if der in self.funcder:
+         return self.evalfunc(w, self.funcder[der])
       return self.evalfunc(w, self.funcarg, der=der)
+   def shifted(self, w, v, der=2):
+      '''
+      Template and its derivatives, Doppler shifted to each velocity v.
+
+      Returns
+      -------
+      f, df, ddf : ((nv x n)) at dopshift(w, v) for each v; derivatives w.r.t. the (log) wavelength.
+         Only up to the derivative der.
+      '''
+      v = np.atleast_1d(v)
+      a = 1. / (1.+v/c)   # dopshift
+      if def_wlog:
+         fa, fo = np.ones_like(a), np.log(a)
+      else:
+         fa, fo = a, np.zeros_like(a)
+      if self.bspl is None and self.evalfunc is cubicSpline.spl_evf:
+         return cubicSpline.spl_evfd(w, self.funcarg, fa, fo)[:der+1]
+      ws = fa[:,newaxis]*w + fo[:,newaxis]
+      if self.bspl is not None:
+         # all shifts in one call, the knot index is computed and needs no sorting
+         return tuple(self.bspl(ws.ravel(), der=d).reshape(ws.shape) for d in range(der+1))
+      return tuple(np.array([self(wi, der=d) for wi in ws]) for d in range(der+1))
    def mskatm(self, w, msk):
       # mask regions (atm, stellar) in template
       # need target velocity and velocity range
@@ -171,19 +405,52 @@ class Tpl:
          return slice(0,0) # empty
 
 
+def read_knot_template(filename):
+   '''
+   Restore the B-spline templates of a previous run from the knot sampled template (<obj>.fits).
+
+   The coadded B-splines are natural, so the natural B-spline through the knot
+   values is the same spline. Returns a list of Tpl (None for orders without knots).
+   '''
+   hdu = pyfits.open(filename)
+   wk, fk = hdu['wave'].data, hdu['spec'].data
+   TPL = [None] * len(fk)
+   for o in range(len(fk)):
+      ind = np.isfinite(wk[o]) & np.isfinite(fk[o])
+      if ind.sum() > 3:
+         smod = spl.ucbspl_fit(wk[o][ind], fk[o][ind], K=ind.sum())   # interpolant
+         TPL[o] = Tpl(smod.xk, smod(), bspl=smod)
+   return TPL
+
+
 def analyse_rv(obj, postiter=1, fibsuf='', oidx=None, safemode=False, pdf=False):
    """
    """
    print obj+'/'+obj+'.rvc'+fibsuf+'.dat'
-   allrv = np.genfromtxt(obj+'/'+obj+'.rvo'+fibsuf+'.dat')
-   allerr = np.genfromtxt(obj+'/'+obj+'.rvo'+fibsuf+'.daterr')
-   sbjd = np.genfromtxt(obj+'/'+obj+'.rvo'+fibsuf+'.dat', dtype=('|S33'), usecols=[0]) # as string
-   snr = np.genfromtxt(obj+'/'+obj+'.snr'+fibsuf+'.dat')
+   bundle = obj+'/'+obj+fibsuf+'.npz'
+   rvofile = obj+'/'+obj+'.rvo'+fibsuf+'.dat'
+   if os.path.exists(bundle) and os.path.getmtime(bundle) >= os.path.getmtime(rvofile):
+      # binary products, the good ones as in the dat files
+      p = np.load(bundle)
+      good = p['rvflag'] == 0
+      c = lambda name: p[name][good]
+      allrv = np.column_stack((c('bjd'), c('RV'), c('e_RV'), c('rvm'), c('rvmerr'), c('rv')))
+      allerr = np.column_stack((c('bjd'), c('RV'), c('e_RV'), c('rvm'), c('rvmerr'), c('e_rv')))
+      sbjd = np.array(map(str, c('bjd')))
+      snr = np.column_stack((c('bjd'), np.nansum(c('snr')**2, axis=1)**0.5, c('snr')))
+      bjd, RVc_old, e_RVc_old, RVd, e_RVd, RV_old, e_RV_old, BRV, RVsa = (c(name) for name in ('bjd', 'RVc', 'e_RVc', 'drift', 'e_drift', 'RV', 'e_RV', 'berv', 'sa'))
+      if good.sum() < 2:
+         return   # just one line, e.g. drift
+   else:
+      allrv = np.genfromtxt(rvofile)
+      allerr = np.genfromtxt(obj+'/'+obj+'.rvo'+fibsuf+'.daterr')
+      sbjd = np.genfromtxt(rvofile, dtype=('|S33'), usecols=[0]) # as string
+      snr = np.genfromtxt(obj+'/'+obj+'.snr'+fibsuf+'.dat')
 
-   if np.size(allrv) == 1:
-      return   # just one line, e.g. drift
+      if np.size(allrv) == 1:
+         return   # just one line, e.g. drift
 
-   bjd, RVc_old, e_RVc_old, RVd, e_RVd, RV_old, e_RV_old, BRV, RVsa = np.genfromtxt(obj+'/'+obj+'.rvc'+fibsuf+'.dat', dtype=None).T
+      bjd, RVc_old, e_RVc_old, RVd, e_RVd, RV_old, e_RV_old, BRV, RVsa = np.genfromtxt(obj+'/'+obj+'.rvc'+fibsuf+'.dat', dtype=None).T
 
    orders, = np.where(np.sum(allerr[:,5:]>0, 0))   # orders with all zero error values
    if oidx is not None:
@@ -408,6 +675,67 @@ def polyreg(x2, y2, e_y2, v, deg=1, retmod=True):   # polynomial regression
       return p, SSR, calcspec(x2, v, *p, fmod=fmod)
    return p, SSR
 
+def polyreg_grid(x2, y2, e_y2, vgrid, deg=1):
+   """
+   Polynomial regression for the template shifted to each velocity of vgrid.
+
+   The results are identical to polyreg calls for each velocity.
+
+   Returns
+   -------
+   p : ((nv x deg)) polynomial coefficients.
+   SSR : ((nv)) goodness of fit.
+
+   """
+   fmod = calcspec.tpl.shifted(x2, vgrid, der=0)[0]   # the shifted templates
+   p = np.empty((vgrid.size, deg))
+   SSR = np.empty(vgrid.size)
+   ind = 0.0001
+   if _pKolynomial.polyfit_grid(x2, y2, e_y2, fmod, ind, x2.size, vgrid.size, calcspec.wcen, deg, p, SSR):
+      raise MemoryError('polyfit_grid')
+   for k in np.where(SSR < 0)[0]:
+      ii, = np.where((e_y2<=0) & (fmod[k]>0.01))
+      print 'WARNING: Matrix is not positive definite.', 'Zero or negative yerr values for ', ii.size, 'at', ii
+      p[k] = 0
+   return p, SSR
+
+def polymom_grid(x2, y2, e_y2, vgrid, deg=1, mom=None, sign=1.):
+   """
+   Moments of the normal equations of polyreg for the template shifted to each velocity of vgrid.
+
+   With mom, the moments of the pixels are added to mom (sign=1) or removed
+   (sign=-1), e.g. to downdate the moments for clipped pixels.
+
+   Returns
+   -------
+   mom : ((nv x 3*deg)) matrix moments, rhs moments and weighted sum of squares.
+
+   """
+   fmod = calcspec.tpl.shifted(x2, vgrid, der=0)[0]   # the shifted templates
+   if mom is None: mom = np.zeros((vgrid.size, 3*deg))
+   ind = 0.0001
+   _pKolynomial.polymom_grid(x2, y2, e_y2, fmod, ind, x2.size, vgrid.size, calcspec.wcen, deg, mom, sign)
+   return mom
+
+def polysolve_grid(mom, deg=1):
+   """
+   Polynomial regression from the moments of polymom_grid.
+
+   Returns
+   -------
+   p : ((nv x deg)) polynomial coefficients.
+   SSR : ((nv)) goodness of fit.
+
+   """
+   p = np.empty((len(mom), deg))
+   SSR = np.empty(len(mom))
+   if _pKolynomial.polysolve_grid(mom, len(mom), deg, p, SSR):
+      raise MemoryError('polysolve_grid')
+   for k in np.where(SSR < 0)[0]:
+      print 'WARNING: Matrix is not positive definite.', 'Zero or negative yerr values? (v index %s)' % k
+      p[k] = 0
+   return p, SSR
+
 def gauss(x, a0, a1, a2, a3):
    z = (x-a0) / a2
    y = a1 * np.exp(-z**2 / 2) + a3 #+ a4 * x + a5 * x**2
@@ -438,6 +766,69 @@ def optidrift(ft, df, f2, e2=None):
    #gplot(f2, ft*A, A*ft-A*df/c*v, A*ft-A*df/c*0.1,' us 0:1, "" us 0:2, "" us 0:3, "" us 0:4, "" us 0:($1-$3) w lp,  "" us 0:($1-$4) w lp lt 7')
    return  type('par',(),{'params': np.append(v,A), 'perror': np.array([e_v,1.0])}), fmod
 
+def ccf_box(wt, ft, x, y, vgrid):
+   """
+   Box CCF for all velocities at once.
+
+   A pixel x is in the mask shifted by v, if ft[k] > 0 for the first edge
+   with wt[k]+v/c >= x (outside beyond the last edge). The flux sums in
+   the boxes are differences of the cumulative sum over the sorted pixels.
+
+   Returns
+   -------
+   SSR : ((nv)) Mean flux in the mask.
+
+   """
+   i = np.argsort(x, kind='mergesort')
+   x = x[i]
+   Y = np.r_[0., np.cumsum(y[i])]
+   k, = np.where(ft > 0)
+   lo = np.r_[-np.inf, wt][k]   # boxes (wt[k-1], wt[k]]
+   hi = wt[k]
+   s = vgrid[:,newaxis] / c
+   ilo = np.searchsorted(x, lo+s, 'right')
+   ihi = np.searchsorted(x, hi+s, 'right')
+   with np.errstate(invalid='ignore', divide='ignore'):
+      return (Y[ihi]-Y[ilo]).sum(axis=1) / (ihi-ilo).sum(axis=1)
+
+def ccf_trapeze(wt, ft, x, y, vgrid):
+   """
+   Trapeze CCF for all velocities at once.
+
+   The mask weights are linearly interpolated between the points (wt, ft)
+   and constant beyond the ends. In each mask segment the weight is linear
+   in x, M(x) = a + b*x, and the weighted sums follow from cumulative sums
+   of y and x*y over the sorted pixels.
+
+   Returns
+   -------
+   SSR : ((nv)) Weighted mean flux in the mask.
+
+   """
+   i = np.argsort(x, kind='mergesort')
+   x0 = np.mean(x)   # centred for numerical precision
+   u, y = x[i] - x0, y[i]
+   N = np.arange(u.size+1.)
+   U = np.r_[0., np.cumsum(u)]
+   Y = np.r_[0., np.cumsum(y)]
+   UY = np.r_[0., np.cumsum(u*y)]
+   # segments [w0, w1) between the mask points and the constant ends
+   w0, w1 = np.r_[-np.inf, wt-x0], np.r_[wt-x0, np.inf]
+   f0, f1 = np.r_[ft[0], ft], np.r_[ft, ft[-1]]
+   with np.errstate(invalid='ignore', divide='ignore'):
+      b = np.where(w1 > w0, (f1-f0)/(w1-w0), 0.)
+   b[~np.isfinite(b)] = 0.
+   a = f0 - b*np.where(np.isfinite(w0), w0, 0.)
+   s = vgrid[:,newaxis] / c
+   ilo = np.searchsorted(u, w0+s)
+   ihi = np.searchsorted(u, w1+s)
+   # M(u-s) = a + b*(u-s)
+   S0, S1 = Y[ihi]-Y[ilo], UY[ihi]-UY[ilo]
+   N0, N1 = N[ihi]-N[ilo], U[ihi]-U[ilo]
+   with np.errstate(invalid='ignore', divide='ignore'):
+      return (a*S0 + b*(S1-s*S0)).sum(axis=1) / (a*N0 + b*(N1-s*N0)).sum(axis=1)
+
+@stages.timed('CCF')
 def CCF(wt, ft, x2, y2, va, vb, e_y2=None, keep=None, plot=False, ccfmode='trapeze'):
    # CCF is on the same level as the least square routine fit_spec
    if keep is None: keep = np.arange(len(x2))
@@ -445,26 +836,45 @@ def CCF(wt, ft, x2, y2, va, vb, e_y2=None, keep=None, plot=False, ccfmode='trape
    vgrid = np.arange(va, vb, v_step)
 
    # CCF is a data compression/smoothing/binning
-   SSR = np.arange(vgrid.size, dtype=np.float64)
-
-   def model_box(x, v):
-       idx = np.searchsorted(wt+v/c, x)
-       return ft[idx] > 0
-
-   for i in SSR:
-      if ccfmode == 'box':
-         # real boxes (zero order interpolation)
-         #idx = np.searchsorted(wt+vgrid[i]/c, x2[keep])
-         #SSR[i] = np.dot(y2[keep], ft[idx]>0) / np.sum(ft[idx]>0)
-         y2mod = model_box(x2[keep], vgrid[i])
-         SSR[i] = np.dot(y2[keep], y2mod) / np.sum(y2mod)
-         # gplot(np.exp(x2), y2, ft[idx]*y2.max(),'w lp, "" us 1:3 w l lt 3')
-      if ccfmode == 'trapeze':
-         stop()
-         # gplot(np.exp(x2), y2,'w lp,', np.exp(x2[keep]),ft[idx]*5010, 'w l lt 3')
+   # all velocities at once
+   if ccfmode == 'box':
+      # real boxes (zero order interpolation)
+      SSR = ccf_box(wt, ft, x2[keep], y2[keep], vgrid)
+   elif ccfmode == 'trapeze':
+      # linear interpolated mask weights
+      SSR = ccf_trapeze(wt, ft, x2[keep], y2[keep], vgrid)
+   elif ccfmode == 'binless':
+      # get the line center from the mask
+      # grab the data around the line center with the window size
+      # phase fold all windows to velocity space by subtracting the line center
+      # assume windows do not overlap
+      wsz = 6.0 # [km/s] 3.0 for HARPS, 6.0 for FEROS
+      linecen = 0.5 * (wt[1::4]+wt[2::4]) # get the linecenter form the mask
+      lineflux = 0.5 * (ft[1::4]+ft[2::4])
+      idx = np.searchsorted(linecen, x2[keep]) # find index of nearest largest line
+      idx = idx - ((linecen[idx]-x2[keep]) > (x2[keep]-linecen[idx-1])) # index of the nearest (smaller or larger) line
+      ind = np.abs(x2[keep]-linecen[idx]) < wsz/c # index for values with the window
+      xv2 = (x2[keep[ind]]-linecen[idx[ind]]) * c # phase fold
+      yv2 = y2[keep[ind]] / lineflux[idx[ind]]
+      ev2 = e_y2[keep[ind]] / lineflux[idx[ind]]
+
+      # normalise window flux with the flux mean in each window
+      iidx = idx[ind] - 1
+      lidx = iidx - iidx.min()
+      linenorm = (np.bincount(lidx, weights=yv2) / np.bincount(lidx))[lidx]  # mean = sum / n
+      yv2norm = yv2 / linenorm
+
+      # stacked windows binned to the velocity grid
+      ib = np.round((xv2-vgrid[0]) / v_step).astype(int)
+      ok = (ib >= 0) & (ib < vgrid.size)
+      with np.errstate(invalid='ignore'):
+         SSR = np.bincount(ib[ok], weights=yv2norm[ok], minlength=vgrid.size) / np.bincount(ib[ok], minlength=vgrid.size)
+   else:
+      raise Exception('ccfmode %s not implemented.' % ccfmode)
 
    # Peak analysis with gaussian fit
    # The Gaussian is a template for the second level product CCF
+   from scipy.optimize import curve_fit
    try:
       params, covariance = curve_fit(gauss, vgrid, SSR, p0=(0., SSR.max()-SSR.min(), 2.5, SSR.min()))
       perror = np.diag(covariance) if np.isfinite(covariance).min() else 0*params
@@ -486,30 +896,6 @@ def CCF(wt, ft, x2, y2, va, vb, e_y2=None, keep=None, plot=False, ccfmode='trape
       xv2 = (x2[keep[ind]]-0.5*(wt[iidx+1,0]+wt[iidx])) * c
       yv2 = y2[keep[ind]] / ft[iidx]
       ev2 = e_y2[keep[ind]] / ft[iidx]
-   elif ccfmode == 'binless':
-      # get the line center from the mask
-      # grab the data around the line center with the window size
-      # phase fold all windows to velocity space by subtracting the line center
-      # assume windows do not overlap
-      wsz = 6.0 # [km/s] 3.0 for HARPS, 6.0 for FEROS
-      linecen = 0.5 * (wt[1::4]+wt[2::4]) # get the linecenter form the mask
-      lineflux = 0.5 * (ft[1::4]+ft[2::4])
-      idx = np.searchsorted(linecen, x2[keep]) # find index of nearest largest line
-      idx = idx - ((linecen[idx]-x2[keep]) > (x2[keep]-linecen[idx-1])) # index of the nearest (smaller or larger) line
-      ind = np.abs(x2[keep]-linecen[idx]) < wsz/c # index for values with the window
-      xv2 = (x2[keep[ind]]-linecen[idx[ind]]) * c # phase fold
-      yv2 = y2[keep[ind]] / lineflux[idx[ind]]
-      ev2 = e_y2[keep[ind]] / lineflux[idx[ind]]
-
-      # normalise window flux with the flux mean in each window
-      iidx = idx[ind] - 1
-      lidx = iidx - iidx.min()
-      nlines = lidx.max() + 1
-      linenorm = np.zeros((nlines,2))
-      for i,y in zip(lidx, yv2): linenorm[i] += np.array([y,1])
-      linenorm = (linenorm[:,0] / linenorm[:,1])[lidx]  # mean = sum / n
-      yv2norm = yv2 / linenorm
-      #yv2 = yv2norm
 
    fmod = 0
    if 0 or plot and ccfmode=='binless':
@@ -572,9 +958,10 @@ def SSRstat(vgrid, SSR, dk=1, plot='maybe'):
    k = SSR[dk:-dk].argmin() + dk   # best point (exclude borders)
    vpeak = vgrid[k-dk:k+dk+1]
    SSRpeak = SSR[k-dk:k+dk+1] - SSR[k]
+   dv = vgrid[1] - vgrid[0]   # grid step
    # interpolating parabola a0+a1*x+a2*x**2 (direct solution) through the three pixels in the minimum
-   a = np.array([0, (SSR[k+dk]-SSR[k-dk])/(2*v_step), (SSR[k+dk]-2*SSR[k]+SSR[k-dk])/(2*v_step**2)])  # interpolating parabola for even grid
-   v = (SSR[k+dk]-SSR[k-dk]) / (SSR[k+dk]-2*SSR[k]+SSR[k-dk]) * 0.5 * v_step
+   a = np.array([0, (SSR[k+dk]-SSR[k-dk])/(2*dv), (SSR[k+dk]-2*SSR[k]+SSR[k-dk])/(2*dv**2)])  # interpolating parabola for even grid
+   v = (SSR[k+dk]-SSR[k-dk]) / (SSR[k+dk]-2*SSR[k]+SSR[k-dk]) * 0.5 * dv
 
    v = vgrid[k] - a[1]/2./a[2]   # position of parabola minimum
    e_v = np.nan
@@ -593,17 +980,23 @@ def SSRstat(vgrid, SSR, dk=1, plot='maybe'):
       pause(v)
    return v, e_v, a
 
-def opti(va, vb, x2, y2, e_y2, p=None, vfix=False, plot=False):
+def opti(va, vb, x2, y2, e_y2, p=None, vfix=False, plot=False, mom=None, drop=None, dv=None):
    """ vfix to fix v for RV constant stars?
    performs a mini CCF; the grid stepping
    returns best v and errors from parabola curvature
+   dv : grid step (default: v_step)
+   mom : moments of the normal equations on the grid from a previous call (par.mom), warm start for clip iterations
+   drop : (x2, y2, e_y2) of the pixels removed since then; their moments are downdated
    """
-   vgrid = np.arange(va, vb, v_step)
+   vgrid = np.arange(va, vb, dv or v_step)
    nk = len(vgrid)
 
-   SSR = np.empty(nk)
-   for k in range(nk):
-      p, SSR[k] = polyreg(x2, y2, e_y2, vgrid[k], len(p), retmod=False)
+   # all velocities in one call
+   if mom is None:
+      mom = polymom_grid(x2, y2, e_y2, vgrid, len(p))
+   elif drop is not None:
+      mom = polymom_grid(drop[0], drop[1], drop[2], vgrid, len(p), mom=mom, sign=-1.)
+   _, SSR = polysolve_grid(mom, len(p))
 
    # analyse the CCF peak fitting
    v, e_v, a = SSRstat(vgrid, SSR, plot=(not safemode)*(1+plot))
@@ -620,9 +1013,63 @@ def opti(va, vb, x2, y2, e_y2, p=None, vfix=False, plot=False):
    if 1 and (np.isnan(e_v) or plot) and not safemode:
       gplot(x2, y2, fmod, ' w lp, "" us 1:3 w lp lt 3')
       pause(v)
-   return type('par', (), {'params': np.append(v,p), 'perror': np.array([e_v,1.0]), 'ssr': (vgrid,SSR)}), fmod
+   return type('par', (), {'params': np.append(v,p), 'perror': np.array([e_v,1.0]), 'ssr': (vgrid,SSR), 'mom': mom}), fmod
+
+def ssrgrid(va, vb, x2, y2, e_y2, deg, dv=None):
+   """SSR curve on the velocity grid, e.g. for the chi2 map."""
+   vgrid = np.arange(va, vb, dv or v_step)
+   return vgrid, polyreg_grid(x2, y2, e_y2, vgrid, deg)[1]
+
+def optinewton(va, vb, x2, y2, e_y2, p, v0=0., maxiter=20, vtol=1e-6):
+   """
+   Joint least square fit of v and the polynomial with Gauss-Newton iterations.
+
+   Uses the analytic derivative of the template. The polynomial is
+   initialised with polyreg at v0.
+   Returns None, None if the solver fails (singular matrix, no convergence,
+   v outside [va,vb]). Then the grid (opti) should be used.
+   """
+   tpl = calcspec.tpl
+   p, SSR = polyreg(x2, y2, e_y2, v0, len(p), retmod=False)
+   if SSR < 0: return None, None
+   Z = (x2-calcspec.wcen) ** np.arange(len(p))[:,newaxis]   # ((deg x n)) powers for the polynomial
+   sqw = 1 / e_y2
+   v = v0
+   for niter in range(1, maxiter+1):
+      s = dopshift(x2, v)
+      t = tpl(s)
+      poly = np.dot(p, Z)
+      dsdv = -1 / (c+v) * (1 if def_wlog else s)   # derivative of dopshift
+      ind = t > 0.0001   # as in polyfit
+      # weighted Jacobian for v and the polynomial coefficients and the residuals
+      J = np.vstack((poly*tpl(s, der=1)*dsdv, t*Z)).T[ind] * sqw[ind,newaxis]
+      res = (y2-poly*t)[ind] * sqw[ind]
+      scale = np.sqrt((J*J).sum(axis=0))
+      try:
+         cov = np.linalg.inv(np.dot((J/scale).T, J/scale)) / np.outer(scale, scale)
+      except np.linalg.LinAlgError:
+         return None, None
+      dpar = np.dot(cov, np.dot(J.T, res))
+      if not np.isfinite(dpar).all():
+         return None, None
+      v += dpar[0]
+      p = p + dpar[1:]
+      if not va <= v <= vb:
+         return None, None
+      if abs(dpar[0]) < vtol:
+         break
+   else:
+      return None, None
+
+   e_v = np.sqrt(cov[0,0])
+   fmod = calcspec(x2, v, *p)
+   if p[0] < 0:
+      e_v = np.nan
+      print "Negative scale value. Setting  e_v= %f" % e_v
+   return type('par', (), {'params': np.append(v,p), 'perror': np.array([e_v,1.0]), 'ssr': None, 'nnewton': niter}), fmod
 
-def fitspec(tpl, w2, f2, e_y=None, v=0, vfix=False, clip=None, nclip=1, keep=None, indmod=np.s_[:], v_step=True, df=None, plot=False, deg=3, chi2map=False):
+@stages.timed('fitspec')
+def fitspec(tpl, w2, f2, e_y=None, v=0, vfix=False, clip=None, nclip=1, keep=None, indmod=np.s_[:], v_step=True, df=None, plot=False, deg=3, chi2map=False, vsolver='grid', vrange=None):
    """
    Performs the robust least square fit via iterative clipping.
 
@@ -633,8 +1080,12 @@ def fitspec(tpl, w2, f2, e_y=None, v=0, vfix=False, clip=None, nclip=1, keep=Non
    nclip : Number of clipping iterations (default: 0 if clip else 1).
    df : Derivative for drift measurement.
    v_step : Number of v steps (only background polynomial => v_step = false).
+   chi2map : Return also the SSR curve on the velocity grid.
+   vsolver : 'grid' (opti) or 'newton' (optinewton, opti as fallback).
+   vrange : (v_lo, v_hi, v_step) of the velocity grid around v (default: the module settings).
 
    """
+   va, vb, dv = vrange or (v_lo, v_hi, None)
    if keep is None: keep = np.arange(len(w2))
    if e_y is None: e_y = np.mean(f2)**0.5 + 0*f2   # mean photon noise
    if clip is None: nclip = 0   # number of clip iterations; default 1
@@ -643,6 +1094,8 @@ def fitspec(tpl, w2, f2, e_y=None, v=0, vfix=False, clip=None, nclip=1, keep=Non
 
    p = np.array([v, 1.] + [0]*deg)   # => [v,1,0,0,0]
    fMod = np.nan * w2
+   mom = None   # grid moments of the last opti call (pixels keepmom)
+   ssr = None   # SSR curve on the grid of the last opti call
    #fres = 0.*w2     # same size
    for n in range(nclip+1):
       if df is not None:
@@ -651,9 +1104,21 @@ def fitspec(tpl, w2, f2, e_y=None, v=0, vfix=False, clip=None, nclip=1, keep=Non
                                  e_y.take(keep,mode='clip'))
       elif v_step:
          '''least square mode'''
-         par, fModkeep = opti(v+v_lo, v+v_hi, w2.take(keep,mode='clip'), f2.take(keep,mode='clip'),
-                              e_y.take(keep,mode='clip'), p[1:], vfix=vfix, plot=plot)
-         ssr = par.ssr
+         par = None
+         if vsolver == 'newton' and not vfix:
+            par, fModkeep = optinewton(v+va, v+vb, w2.take(keep,mode='clip'), f2.take(keep,mode='clip'),
+                                       e_y.take(keep,mode='clip'), p[1:], v0=p[0])
+         if par is None:
+            drop = None
+            if mom is not None:
+               # warm start: downdate the grid moments for the pixels rejected since then
+               idrop = np.setdiff1d(keepmom, keep)
+               drop = w2.take(idrop,mode='clip'), f2.take(idrop,mode='clip'), e_y.take(idrop,mode='clip')
+            par, fModkeep = opti(v+va, v+vb, w2.take(keep,mode='clip'), f2.take(keep,mode='clip'),
+                                 e_y.take(keep,mode='clip'), p[1:], vfix=vfix, plot=plot, mom=mom, drop=drop, dv=dv)
+            mom, keepmom = par.mom, keep
+         ssr = par.ssr   # from the (downdated) moments of keep
+         keepssr = keep
       else:
          '''only background polynomial'''
          p, SSR, fModkeep = polyreg(w2.take(keep,mode='clip'), f2.take(keep,mode='clip'), e_y.take(keep,mode='clip'), v, len(p)-1)
@@ -704,10 +1169,55 @@ def fitspec(tpl, w2, f2, e_y=None, v=0, vfix=False, clip=None, nclip=1, keep=Non
       fMod[indmod] = calcspec(w2[indmod], *p)   # compute also at bad pixels
 
    if chi2map:
+      if ssr is None:
+         # no grid moments (newton, drift): SSR curve on the grid with the pixels of the last fit
+         ssr = ssrgrid(v+va, v+vb, w2.take(keepssr,mode='clip'), f2.take(keepssr,mode='clip'), e_y.take(keepssr,mode='clip'), len(p)-1, dv=dv)
       return par, fMod, keep, stat, ssr
    else:
       return par, fMod, keep, stat
 
+def orderpix(b2, pmin, pmax):
+   """Flags the pixels outside [pmin:pmax] in the bad pixel map (in place). Returns the indices of the good pixels."""
+   b2[:pmin] |= flag.out
+   b2[pmax:] |= flag.out
+   return np.arange(b2.size)[b2==0]
+
+def difflw(tpl, wmod, f2, e2, f2mod, keep, params):
+   """
+   Differential line width of one order from the fitspec model.
+
+   The residuals (without the poly) are scaled to the second derivative
+   of the template:  f = p*t,  a*ddt ~ y/p - t = r/p  =>  r = p*a*ddt
+   Returns dlw, e_dlw [m/s km/s].
+   """
+   poly = calcspec(wmod, *params, retpoly=True)
+   _, _, ddy = tpl.shifted(wmod, params[0])
+   ddy = poly * ddy[0]
+   if not def_wlog:
+      ddy *= wmod**2
+   dlwo = c**2 * np.dot(1/e2[keep]**2*ddy[keep], (f2-f2mod)[keep]) / np.dot(1/e2[keep]**2*ddy[keep], ddy[keep])
+   e_dlwo = c**2 * np.sqrt(1 / np.dot(1/e2[keep]**2, ddy[keep]**2))
+   drchi = rms(((f2-f2mod) - dlwo/c**2*ddy)[keep] / e2[keep])
+   return dlwo * 1000, e_dlwo * 1000 * drchi   # convert from (km/s) to m/s km/s
+
+def crxfit(x, rv, e_rv):
+   """
+   Chromatic index, the slope of the order RVs against x = ln(lambda).
+
+   Returns CRX, e_CRX, the RV at xc and its error, and the centre xc.
+   """
+   from scipy.optimize import curve_fit
+   def func(x, a, b): return a + b*x
+   xc = np.mean(x)   # only to center the trend fit
+   # fit trend with curve_fit to get parameter error
+   pval, cov = curve_fit(func, x-xc, rv, [0.0, 0.0], e_rv)
+   perr = np.sqrt(np.diag(cov))
+   return pval[1], perr[1], pval[0], perr[0], xc
+
+def secacc(targ, bjd, bjd0):
+   """Secular acceleration [m/s] at bjd relative to bjd0."""
+   return targ.sa / 365.25 * (bjd-bjd0)
+
 
 
 def serval(*argv):
@@ -806,6 +1316,7 @@ def serval(*argv):
    if targ.name == 'cal':
       print 'no barycentric correction (calibration)'
    elif targ.ra and targ.de or targ.name:
+      from targ import Targ
       targ = Targ(targ.name, targrade, targpm, plx=targplx, rv=targrv, cvs=obj+'/'+obj+'.targ.cvs')
       print ' using sa=', targ.sa, 'm/s/yr', 'ra=', targ.ra, 'de=', targ.de, 'pmra=', targ.pmra, 'pmde=', targ.pmde
    else:
@@ -813,8 +1324,12 @@ def serval(*argv):
 
    # choose the interpolation type
    spltype = 3 # 3=> fast version
-   spline_cv = {1: interpolate.splrep, 2: cubicSpline.spl_c,  3: cubicSpline.spl_cf }[spltype]
-   spline_ev = {1: interpolate.splev,  2: cubicSpline.spl_ev, 3: cubicSpline.spl_evf}[spltype]
+   if spltype == 1:
+      from scipy import interpolate
+      spline_cv, spline_ev = interpolate.splrep, interpolate.splev
+   else:
+      spline_cv = {2: cubicSpline.spl_c,  3: cubicSpline.spl_cf }[spltype]
+      spline_ev = {2: cubicSpline.spl_ev, 3: cubicSpline.spl_evf}[spltype]
 
    print dir_or_inputlist
    print 'tpl=%s pmin=%s nset=%s omin=%s omax=%s' % (tpl, pmin, nset, omin, omax)
@@ -912,7 +1427,7 @@ def serval(*argv):
          maskfile = servallib + atmfile
 
       print 'maskfile', maskfile
-      mask = np.genfromtxt(maskfile, dtype=None)
+      mask = masktools.loadmask(maskfile)
 
       if 'telluric_mask_atlas_short.dat' in maskfile:
          lcorr = 0.000009  # Guillems mask needs this shift of 2.7 km/s
@@ -923,17 +1438,13 @@ def serval(*argv):
    if skyfile:
       if skyfile=='auto' and inst.name=='CARM_NIR':
          skyfile = servallib + 'sky_carm_nir'
-         sky = np.genfromtxt(skyfile, dtype=None)
+         sky = masktools.loadmask(skyfile)
          skymsk = interp(lam2wave(sky[:,0]), sky[:,1])
 
 
    msksky = [0] * iomax
    if 1 and inst.name=='CARM_VIS':
-      try:
-         import pyfits
-      except:
-         import astropy.io.fits as pyfits
-      msksky = flag.atm * pyfits.getdata(servallib + 'carm_vis_tel_sky.fits')
+      msksky = flag.atm * masktools.loadmask(servallib + 'carm_vis_tel_sky.fits')
 
    if msklist: # convert line list to mask
       mask = masktools.list2mask(msklist, wd=mskwd)
@@ -946,6 +1457,15 @@ def serval(*argv):
       tellmask = interp(lam2wave(mask[:,0]), mask[:,1])
       print 'using telluric mask: ', maskfile
 
+   # atm, sky and bad template flags for all orders of a spectrum in one call
+   masks = masktools.MaskSet()
+   if mask is not None:
+      atm = masktools.IntervalSet.from_mask(tellmask.x, tellmask.y)
+      masks.add(atm, flag.atm)
+      masks.add(atm, flag.badT, frame='tpl')   # tellurics in the template
+   if skymsk is not nomask:
+      masks.add(masktools.IntervalSet.from_mask(skymsk.x, skymsk.y), flag.sky)
+
    if 0:
       mask2 = np.genfromtxt('telluric_add.dat', dtype=None)
       # DO YOU NEED THIS: mask2[:,0] = airtovac(mask2[:,0])  ??
@@ -970,15 +1490,32 @@ def serval(*argv):
    print "    # %*s %*s OBJECT    BJD        SN  DRSBERV  DRSdrift flag calmode" % (-len(inst.name)-6, "inst_mode", -len(os.path.basename(files[0])), "timeid")
    infowriter = csv.writer(infofile, delimiter=';', lineterminator="\n")
 
+   if cache:
+      Spectrum.cache = SpecCache(cachemem*1e6, dirname=None if cache is True else cache)
+
+   scanindex = None
+   if scanidx:
+      scanindex = ScanIndex(outdir+obj+'.scan.pkl' if scanidx is True else scanidx)
+
+   stages.start('scan')
    for n,filename in enumerate(files):   # scanning fitsheader
       print '%3i/%i' % (n+1, nspec),
-      sp = Spectrum(filename, inst=inst, pfits=2 if 'HARPS' in inst.name else True, drs=drs, fib=fib, targ=targ, verb=True)
+      sp = Spectrum(filename, inst=inst, pfits=2 if 'HARPS' in inst.name else True, drs=drs, fib=fib, targ=targ, verb=True, index=scanindex, brvbatch=True)
       splist.append(sp)
+      sp.header = None   # saves memory(?), but needs re-read (?)
+
+   stages.stop('scan')
+
+   with stages('barycorr'):
+      bjdbrv_batch(splist)   # barycentric correction for all epochs in one call
+
+   for n,sp in enumerate(splist):
       if use_drsberv:
          sp.bjd, sp.berv = sp.drsbjd, sp.drsberv
-      sp.sa = targ.sa / 365.25 * (sp.bjd-splist[0].bjd)
-      sp.header = None   # saves memory(?), but needs re-read (?)
-      if inst.name == 'HARPS' and drs: sp.ccf = read_harps_ccf(filename)
+      sp.sa = secacc(targ, sp.bjd, splist[0].bjd)
+      if not sp.restored:
+         if inst.name == 'HARPS' and drs: sp.ccf = read_harps_ccf(sp.filename)
+         if scanindex is not None: scanindex.put(sp)
       if sp.sn55 < snmin: sp.flag |= sflag.lowSN
       if sp.sn55 > snmax: sp.flag |= sflag.hiSN
       if distmax and sp.ra and sp.de:
@@ -1001,6 +1538,7 @@ def serval(*argv):
    badfile.close()
    bervfile.close()
    infofile.close()
+   if scanindex is not None: scanindex.save()
    sys.stdout.logname(obj+'/log.'+obj)
 
    t1 = time.time() - t0
@@ -1094,6 +1632,7 @@ def serval(*argv):
 
    if 1:
       to = time.time()
+      stages.start('template setup')
       if ccf:
          ccfmask = np.loadtxt(servallib + ccf)
       elif driftref:
@@ -1105,6 +1644,7 @@ def serval(*argv):
          try:
             if 'phoe' in tpl:
                #if 'PHOENIX-ACES-AGSS-COND' in tpl:
+               import phoenix_as_RVmodel
                ww, ff = phoenix_as_RVmodel.readphoenix(servallib + 'lte03900-5.00-0.0_carm.fits', wmin=np.exp(np.nanmin(spt.w)), wmax=np.exp(np.nanmax(spt.w)))
                ww = lam2wave(ww)
                is_ech_tpl = False
@@ -1113,7 +1653,15 @@ def serval(*argv):
                # last option
                # read a spectrum stored order wise
                ww, ff, head = read_template(tpl+(os.sep+'template.fits' if os.path.isdir(tpl) else ''))
-               TPL = [Tpl(wo, fo, spline_cv, spline_ev) for wo,fo in zip(ww,ff)]
+               tpldir = os.path.normpath(tpl if os.path.isdir(tpl) else os.path.dirname(tpl) or '.')
+               knotfile = os.path.join(tpldir, os.path.basename(os.path.abspath(tpldir))+'.fits')   # <obj>/<obj>.fits
+               TPL = [None] * len(ff)
+               if os.path.exists(knotfile):
+                  # the B-splines of the coadd, as in the run that made the template
+                  print 'restoring B-spline template:', knotfile
+                  TPL = read_knot_template(knotfile)
+               # spline through the oversampled template (orders without knots, older runs)
+               TPL = [Tpl(wo, fo, spline_cv, spline_ev) if to is None else to for to,wo,fo in zip(TPL,ww,ff)]
                if 'HIERARCH SERVAL COADD NUM' in head:
                   print 'HIERARCH SERVAL COADD NUM:', head['HIERARCH SERVAL COADD NUM']
                   if omin<head['HIERARCH SERVAL COADD COMIN']: pause('omin to small')
@@ -1153,14 +1701,8 @@ def serval(*argv):
             # Smoothing with bspline
             smod = spl.ucbspl_fit(barshift(spt.w[o,idx],spt.berv), spt.f[o,idx], K=idx.size/2, e_yk=True, lam=0.00001)
 
-            # Conversion to cardinal spline and then to fast spline
-            smod_spl = smod.to_spl()
-            #gplot(smod.osamp(10),',',wwo, ffo, ',', wwo,spline_ev(ww5,kko))
-            xk, kko = smod_spl.xk, smod_spl.a
-            yk = smod_spl()
-            kko = xk, yk, kko[1]/(xk[1:]-xk[:-1]), np.append(2*kko[2]/(xk[1:]-xk[:-1])**2, 0), kko[3]/(xk[1:]-xk[:-1])**3
-            TPL[o] = Tpl(xk, yk, spline_cv, spline_ev, mask=True, berv=spt.berv)
-            TPL[o].funcarg = kko # replace with original spline
+            # evaluated directly from the B-spline coefficients
+            TPL[o] = Tpl(smod.xk, smod(), berv=spt.berv, bspl=smod)
 
             if 0 or o==-50:
                #gplot(ww[o],ff[o], ',', barshift(spt.w[o,ptmin:ptmax],spt.berv), spt.f[o,ptmin:ptmax])
@@ -1180,6 +1722,21 @@ def serval(*argv):
          #gplot(barshift(spt.w[o,ptmin:ptmax],spt.berv),spt.f[o,ptmin:ptmax])
          #ogplot(ww[o],ff[o]); pause()
 
+   stages.stop('template setup')
+
+   orderstore = None
+   if ostore and inst.name != 'FEROS':   # FEROS spectra can have different size
+      orderstore = OrderStore(outdir+'ostore/', spoklist[tset])
+
+   # options of the run; -incremental reuses only products with the same options
+   optkey = repr([a for a in argv[1:] if a not in ('-resume', '-checkpoint', '-incremental')])
+
+   # finished template orders and RVs are stored as they come, a rerun with -resume skips them
+   checkpoint = NoCheckpoint()
+   if ckpt or resume:
+      ckptkey = ([a for a in argv[1:] if a not in ('-resume', '-checkpoint')], [(os.path.abspath(sp.filename), os.path.getmtime(sp.filename)) for sp in spoklist])
+      checkpoint = Checkpoint(outdir+'checkpoint/', ckptkey, resume=resume)
+
    for iterate in range(1, niter+1):
 
       print '\nIteration %s / %s (%s)' % (iterate, niter, obj)
@@ -1188,7 +1745,7 @@ def serval(*argv):
          ################################
          ### create high S_N template ###
          ################################
-         print 'coadding method: post3'
+         print 'coadding method: %s' % coadd
          coadd == 'post3'
          tpl = outdir + 'template_' +coadd + fibsuf + '.fits'
 
@@ -1200,68 +1757,114 @@ def serval(*argv):
 
          npix = len(spt.w[0,:])
          ntset = len(spoklist[tset])
-         wmod = nans((ntset,npix))
-         mod = zeros((ntset,npix))
-         emod = zeros((ntset,npix))
-         bmod = zeros((ntset,npix), dtype=int)
+         if coadd != 'stream':
+            # workspace for all spectra of an order
+            wmod = nans((ntset,npix))
+            mod = zeros((ntset,npix))
+            emod = zeros((ntset,npix))
+            bmod = zeros((ntset,npix), dtype=int)
+         elif ofacauto:
+            print 'WARNING: -ofacauto is not supported with -coadd stream'
          spt.header['HIERARCH SERVAL OFAC'] = (ofac, 'oversampling factor per raw pixel')
          spt.header['HIERARCH SERVAL PSPLLAM'] = (pspllam, 'smoothing value of the psline')
          spt.header['HIERARCH SERVAL UTC'] = (datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"), 'time of coadding')
-         for o in corders:
+         def coaddspec(i, sp, o):
+            '''Read order o of spectrum i and its flags. Returns sp, bmod, the RV shifted wavelengths and the template range.'''
+            sp = orderstore.get(i, o) if orderstore else sp.get_data(pfits=2, orders=o)
+            if inst.name == 'FEROS':
+               thisnpix = len(sp.bpmap)
+               # spectra can have different size
+               if thisnpix < npix:
+                  sp.bpmap = np.append(sp.bpmap, np.ones(npix-thisnpix))
+                  sp.e = np.append(sp.e, np.ones(npix-thisnpix))
+                  sp.w = np.append(sp.w, sp.w[-1]*np.ones(npix-thisnpix))
+                  sp.f = np.append(sp.f, np.ones(npix-thisnpix))
+               if thisnpix > npix:
+                  sp.bpmap = sp.bpmap[:npix-thisnpix]
+                  sp.e = sp.e[:npix-thisnpix]
+                  sp.w = sp.w[:npix-thisnpix]
+                  sp.f = sp.f[:npix-thisnpix]
+
+            # see https://github.com/mzechmeister/serval/issues/19#issuecomment-452661455
+            # note in this step the RVs have reverted signs.
+            bmodi = sp.bpmap | msksky[o] | masks(sp.w, tpl=dopshift(redshift(sp.w, vo=sp.berv, ve=RV[i]/1000.), spt.berv))
+
+            w2 = redshift(sp.w, vo=sp.berv, ve=RV[i]/1000.)   # correct also for stellar rv
+            #i0 = np.searchsorted(w2, ww[o].min()) - 1   # w2 must be oversized
+            #wt = barshift(spt.w[o,idx], spt.berv)
+            i0 = np.searchsorted(w2, TPL[o].wk[0]) - 1   # w2 must be oversized
+            if i0<0:
+               i0 = 0
+            #ie = np.searchsorted(w2, ww[o].max())
+            ie = np.searchsorted(w2,TPL[o].wk[-1])
+            bmodi[:i0] |= flag.out
+            bmodi[ie:] |= flag.out
+            return sp, bmodi, w2, i0, ie
+
+         def coaddpind(i, o, sp, bmodi, i0, ie):
+            '''Valid pixels in the template range for the normalisation. None to skip the spectrum, False to stop.'''
+            pind, = where(bmodi[i0:ie] == 0)
+            if np.sum(sp.f[pind]<0) > 0.4*pind.size:
+               print 'too many negative data points in n=%s, o=%s, RV=%s; skipping order' % (i, o, RV[i])
+               return None
+
+            if inst.name == 'FEROS':
+                uind = pind*1
+                hh = np.argsort(sp.f[i0:ie])
+                ii = hh[0:len(hh)*0.98]
+                pind = np.intersect1d(pind, ii)
+                #gplot(sp.w[i0:ie], sp.f[i0:ie],',',sp.w[i0:ie][uind],sp.f[i0:ie][uind],',',sp.w[i0:ie][pind], sp.f[i0:ie][pind])
+            #if o==29 and i==4: stop()
+            if not len(pind):
+               print 'no valid points in n=%s, o=%s, RV=%s; skipping order' % (i, o, RV[i])
+               if not safemode: pause()
+               return False
+            return pind
+
+         def coaddweights(mod, emod, ind, tellind, emed):
+            '''Weights for coadding, down weighted for atm and sky. emed is the median error of the valid points.'''
+            we = 0*mod
+            we[ind] = 1. / emod[ind]**2
+            if atmfile and ('UNe' in atmfile or 'UAr' in atmfile or 'ThNe' in atmfile or 'ThAr' in atmfile): # old downweight scheme
+               we[ind] += 0.000000001
+               we[tellind] /= 10       # downweight
+            elif atmwgt: # down weight with a constant factor
+               # for low SN spectra or variing SN between observation, e.g. Trappist-1
+               we[tellind] *= atmwgt   # downweight
+            elif 0: # down weight with line depth
+               # for high SN spectra, deep absorption line
+               #we[tellind] *= (mod[tellind]/np.percentile(mod[ind+~tellind],95)).clip(0.02,1)**4 / 10
+               fcont = np.abs(np.percentile(mod[ind&~tellind],95)*1.1)
+               #fcont = quantile(mod[ind&~tellind], 0.95, w=1/emod[ind&~tellind])*1.1
+               print fcont
+               #we[tellind] = 1/(5*emod[tellind]**2 + (mod[tellind]-fcont)**2)
+               #we[tellind] = 0.1/emod[tellind]**2   # for low S/N # keeps the relative S/N properties of the data
+               #we[tellind] = 1/(emod[tellind]**2 + (fcont*np.log(abs(mod[tellind]/fcont).clip(1e-6)))**2) # for high S/N
+               we[tellind] = 1/(emod[tellind]**2 + (fcont*np.log((np.sqrt(mod[tellind]**2+emod[tellind]**2)/fcont).clip(1e-6)))**2) # for high S/N
+               #we[tellind] *= (mod[tellind]/fcont).clip(0.02,1)**4 / 10
+               # old error vs new
+               #gplot(wmod[ind],mod[ind], 1/np.sqrt(we[ind]), emod[ind], 'us 1:2:3 w e, "" us 1:2:4 w e')
+            else:
+               we[tellind] = 0.1 / ntset / (emod[tellind]**2 + emed**2)
+            return we
+
+         @stages.timed('coadd order')
+         def coaddorder(o):
+            '''Coadd order o. Returns the B-spline template, the knot sampled template and the header cards.'''
             print "coadding o %02i:" % o,     # continued below in iteration loop
+            wmod[:], mod[:], emod[:], bmod[:] = np.nan, 0, 0, 0   # reset the workspace
+            cards = []   # header keywords
             for i,sp in enumerate(spoklist[tset]):
              '''get the polynomials'''
              if not sp.flag:
-               sp = sp.get_data(pfits=2, orders=o)
-               if inst.name == 'FEROS':
-                  thisnpix = len(sp.bpmap)
-                  # spectra can have different size
-                  if thisnpix < npix:
-                     sp.bpmap = np.append(sp.bpmap, np.ones(npix-thisnpix))
-                     sp.e = np.append(sp.e, np.ones(npix-thisnpix))
-                     sp.w = np.append(sp.w, sp.w[-1]*np.ones(npix-thisnpix))
-                     sp.f = np.append(sp.f, np.ones(npix-thisnpix))
-                  if thisnpix > npix:
-                     sp.bpmap = sp.bpmap[:npix-thisnpix]
-                     sp.e = sp.e[:npix-thisnpix]
-                     sp.w = sp.w[:npix-thisnpix]
-                     sp.f = sp.f[:npix-thisnpix]
-
-               bmod[i] = sp.bpmap | msksky[o]
-               bmod[i][tellmask(sp.w)>0.01] |= flag.atm
-               bmod[i][skymsk(sp.w)>0.01] |= flag.sky
-               # see https://github.com/mzechmeister/serval/issues/19#issuecomment-452661455
-               # note in this step the RVs have reverted signs.
-               bmod[i][tellmask(dopshift(redshift(sp.w, vo=sp.berv, ve=RV[i]/1000.), spt.berv))>0.01] |= flag.badT
-
-               w2 = redshift(sp.w, vo=sp.berv, ve=RV[i]/1000.)   # correct also for stellar rv
-               #i0 = np.searchsorted(w2, ww[o].min()) - 1   # w2 must be oversized
-               #wt = barshift(spt.w[o,idx], spt.berv)
-               i0 = np.searchsorted(w2, TPL[o].wk[0]) - 1   # w2 must be oversized
-               if i0<0:
-                  i0 = 0
-               #ie = np.searchsorted(w2, ww[o].max())
-               ie = np.searchsorted(w2,TPL[o].wk[-1])
-               pind, = where(bmod[i][i0:ie] == 0)
-               bmod[i][:i0] |= flag.out
-               bmod[i][ie:] |= flag.out
-               if np.sum(sp.f[pind]<0) > 0.4*pind.size:
-                  print 'too many negative data points in n=%s, o=%s, RV=%s; skipping order' % (i, o, RV[i])
+               sp, bmod[i], w2, i0, ie = coaddspec(i, sp, o)
+               pind = coaddpind(i, o, sp, bmod[i], i0, ie)
+               if pind is None:
                   wmod[i] = np.nan
                   mod[i] = np.nan
                   emod[i] = np.nan
                   continue
-
-               if inst.name == 'FEROS':
-                   uind = pind*1
-                   hh = np.argsort(sp.f[i0:ie])
-                   ii = hh[0:len(hh)*0.98]
-                   pind = np.intersect1d(pind, ii)
-                   #gplot(sp.w[i0:ie], sp.f[i0:ie],',',sp.w[i0:ie][uind],sp.f[i0:ie][uind],',',sp.w[i0:ie][pind], sp.f[i0:ie][pind])
-               #if o==29 and i==4: stop()
-               if not len(pind):
-                  print 'no valid points in n=%s, o=%s, RV=%s; skipping order' % (i, o, RV[i])
-                  if not safemode: pause()
+               if pind is False:
                   break
 
                # get poly from fit with mean RV
@@ -1281,29 +1884,7 @@ def serval(*argv):
             tellind = (bmod&(flag.atm+flag.sky)) > 0                  # valid but down weighted
             #emod[tellind] *= 1000
             ind *= emod > 0.0
-            we = 0*mod
-            we[ind] = 1. / emod[ind]**2
-            if atmfile and ('UNe' in atmfile or 'UAr' in atmfile or 'ThNe' in atmfile or 'ThAr' in atmfile): # old downweight scheme
-               we[ind] += 0.000000001
-               we[tellind] /= 10       # downweight
-            elif atmwgt: # down weight with a constant factor
-               # for low SN spectra or variing SN between observation, e.g. Trappist-1
-               we[tellind] *= atmwgt   # downweight
-            elif 0: # down weight with line depth
-               # for high SN spectra, deep absorption line
-               #we[tellind] *= (mod[tellind]/np.percentile(mod[ind+~tellind],95)).clip(0.02,1)**4 / 10
-               fcont = np.abs(np.percentile(mod[ind&~tellind],95)*1.1)
-               #fcont = quantile(mod[ind&~tellind], 0.95, w=1/emod[ind&~tellind])*1.1
-               print fcont
-               #we[tellind] = 1/(5*emod[tellind]**2 + (mod[tellind]-fcont)**2)
-               #we[tellind] = 0.1/emod[tellind]**2   # for low S/N # keeps the relative S/N properties of the data
-               #we[tellind] = 1/(emod[tellind]**2 + (fcont*np.log(abs(mod[tellind]/fcont).clip(1e-6)))**2) # for high S/N
-               we[tellind] = 1/(emod[tellind]**2 + (fcont*np.log((np.sqrt(mod[tellind]**2+emod[tellind]**2)/fcont).clip(1e-6)))**2) # for high S/N
-               #we[tellind] *= (mod[tellind]/fcont).clip(0.02,1)**4 / 10
-               # old error vs new
-               #gplot(wmod[ind],mod[ind], 1/np.sqrt(we[ind]), emod[ind], 'us 1:2:3 w e, "" us 1:2:4 w e')
-            else:
-               we[tellind] = 0.1 / ntset / (emod[tellind]**2 + np.median(emod[ind])**2)
+            we = coaddweights(mod, emod, ind, tellind, np.median(emod[ind]))
             ind0 = ind*1
 
             n_iter = 2
@@ -1326,7 +1907,6 @@ def serval(*argv):
                #yfit = ww[o]* 0 # np.nan
                #ind2 &= (ww[o]> smod.xmin) & (ww[o]< smod.xmax)
                #yfit[ind2] = smod(ww[o][ind2])
-               ww[o], yfit = smod.osamp(1.000000001*osize/smod.K)
                wko = smod.xk     # the knot positions
                fko = smod()      # the knot values
                eko = smod.e_yk   # the error estimates for knot values
@@ -1412,7 +1992,7 @@ def serval(*argv):
             yymod[ind] = ymod
             for i,sp in enumerate(spoklist[tset]):
                if sp.sn55 < 400:
-                  spt.header['HIERARCH COADD FILE %03i' % (i+1)] = (sp.timeid, 'rv = %0.5f km/s' % (-RV[i]/1000.))
+                  cards += [('HIERARCH COADD FILE %03i' % (i+1), (sp.timeid, 'rv = %0.5f km/s' % (-RV[i]/1000.)))]
                   iind = (i, ind[i])   # a short-cut for the indexing
                   signal = wmean(mod[iind], 1/emod[iind]**2)  # the signal
                   noise = wrms(mod[iind]-yymod[iind], emod[iind])   # the noise
@@ -1420,9 +2000,9 @@ def serval(*argv):
             sn = np.sum(np.array(sn)**2)**0.5
 
             print ' S/N: %.5f' % sn
-            spt.header['HIERARCH SERVAL COADD SN%03i' % o] = (float("%.3f" % sn), 'signal-to-noise estimate')
+            cards += [('HIERARCH SERVAL COADD SN%03i' % o, (float("%.3f" % sn), 'signal-to-noise estimate'))]
             if ofacauto:
-               spt.header['HIERARCH SERVAL COADD K%03i' % o] = (Ko, 'optimal knot number')
+               cards += [('HIERARCH SERVAL COADD K%03i' % o, (Ko, 'optimal knot number'))]
 
             # plot the model and spt
             if o in lookt:
@@ -1437,7 +2017,7 @@ def serval(*argv):
                #gplot2.bar(0)(wmod.ravel(), mod.ravel(), emod.ravel(), linecolor.ravel(), ' us 1:2:3:4  w e pt 7 ps 0.5 lc var t "data"')
                gplot-(wmod[ind], mod[ind], emod[ind], ' w e pt 7 ps 0.5 t "data"')
                gplot<(TPL[o].wk, TPL[o].fk, 'us 1:2 w lp lt 2 ps 0.5 t "spt"')
-               gplot<(ww[o], yfit,' us 1:2 w l lt 3 t "template"')
+               gplot<(smod.osamp(1.000000001*osize/smod.K), ' us 1:2 w l lt 3 t "template"')
                if (~ind).any():
                   gplot<(wmod[~ind], mod[~ind], emod[~ind].clip(0,mod[ind].max()/20),'us 1:2:3 w e lt 4 pt 7 ps 0.5 t "flagged"')
                if (ind<ind0).any():
@@ -1455,21 +2035,158 @@ def serval(*argv):
                   gplot(wmod[ind], res, -sig*ckappa[1], -sig, sig, sig*ckappa[1], 'us 1:2, "" us 1:3 w l lt 2, "" us 1:4 w l lt 3, "" us 1:5 w l lt 3, "" us 1:6 w l lt 2')
                   pause('lookt ',o)
 
-            # apply the fit
-            #ff[o][ind2] = yfit
-            if ofacauto:
-               # replace template.fits with optimal knot spacing (smoothing) for RVs
-               yfit = ff[o]* 0 # np.nan
-               ind2 = (ww[o]> smod.xmin) & (ww[o]< smod.xmax)
-               yfit[ind2] = smod(ww[o][ind2])
-               # pause()
-            ff[o] = yfit
-            TPL[o] = Tpl(ww[o], ff[o], spline_cv, spline_ev)
-            wk[o] = wko
-            fk[o] = fko
-            ek[o] = eko
-            bk[o] = bko
+            # the B-spline is the template (with ofacauto the optimal knot spacing)
+            return smod, wko, fko, eko, bko, cards
+
+         @stages.timed('coadd order')
+         def coaddorder_stream(o):
+            '''
+            Coadd order o with streamed normal equations (-coadd stream).
+
+            The spectra are read once for the normalisation polynomials, and then
+            twice in each clip iteration: to accumulate the banded normal equations
+            of the B-spline and to accumulate the per-knot statistics of the
+            residuals for the adaptive sigma. Instead of the (nspec x npix)
+            workspace, the polynomials and the models of the previous iterations
+            (for the clipping) are kept, i.e. memory O(K) per order.
+            Returns the same as coaddorder.
+            '''
+            print "coadding o %02i:" % o,     # continued below in iteration loop
+            cards = []   # header keywords
+            norm = [None] * ntset   # polynomial of each spectrum (params, wcen)
+            emed = []    # median errors of the spectra
+            wmin, wmax = np.inf, -np.inf   # fixed knot range from all valid points
+            for i,sp in enumerate(spoklist[tset]):
+             if not sp.flag:
+               sp, bmodi, w2, i0, ie = coaddspec(i, sp, o)
+               pind = coaddpind(i, o, sp, bmodi, i0, ie)
+               if pind is None: continue
+               if pind is False: break
+
+               # get poly from fit with mean RV
+               par = fitspec(TPL[o],
+                  w2[i0:ie], sp.f[i0:ie], sp.e[i0:ie], v=0, vfix=True, keep=pind, v_step=False, clip=kapsig, nclip=nclip, deg=deg)[0]
+               norm[i] = par.params, calcspec.wcen
+               emodi = sp.e / calcspec(w2, *par.params, retpoly=True)
+               ind = ((bmodi&(flag.nan+flag.neg+flag.out)) == 0) & (emodi > 0)
+               if ind.any():
+                  wmin, wmax = min(wmin, w2[ind].min()), max(wmax, w2[ind].max())
+                  emed.append(np.median(emodi[ind]))
+            emed = np.median(emed)
+
+            def normspec():
+               '''Yields the valid normalised data of each spectrum.'''
+               for i,sp in enumerate(spoklist[tset]):
+                  if norm[i] is None: continue
+                  sp, bmodi, w2, _, _ = coaddspec(i, sp, o)
+                  params, calcspec.wcen = norm[i]
+                  poly = calcspec(w2, *params, retpoly=True)
+                  modi = sp.f / poly
+                  emodi = sp.e / poly
+                  ind = ((bmodi&(flag.nan+flag.neg+flag.out)) == 0) & (emodi > 0)
+                  tellind = (bmodi&(flag.atm+flag.sky)) > 0
+                  we = coaddweights(modi, emodi, ind, tellind, emed)
+                  yield i, w2[ind], modi[ind], emodi[ind], we[ind], tellind[ind], bmodi[ind]
+
+            def okclip(w2, modi, emodi, tellind):
+               '''The pixels not clipped by the models of the previous iterations.'''
+               okmap = np.ones(w2.size, dtype=bool)
+               for smodj, varaj in clips:
+                  res = (modi-smodj(w2)) / emodi
+                  sig = np.sqrt(varaj(w2))
+                  if ckappa[0]: okmap &= res > -ckappa[0]*sig
+                  if ckappa[1]: okmap &= res < ckappa[1]*sig
+               okmap[tellind] = True   # do not reject the tellurics (see coaddorder)
+               return okmap
+
+            n_iter = 2
+            if inst.name == 'FEROS': n_iter = 3
+            nks = nk / 5   # knots for the flexible sigma
+            clips = []     # (model, variance) of the previous iterations
+            for it in range(n_iter+1):   # clip 5 sigma outliers
+               # B-spline fit for co-adding
+               neq = spl.ucbspl_stream(K=nk, xmin=wmin, xmax=wmax)
+               nout = 0
+               for i, w2, modi, emodi, we, tellind, bmodi in normspec():
+                  okmap = okclip(w2, modi, emodi, tellind)
+                  nout += np.sum(~okmap)
+                  neq.add(w2[okmap], modi[okmap], we[okmap])
+
+               mu, e_mu = None, None
+               if pmu and pe_mu:
+                  # use mean as an estimate for continuum of absoption spectrum
+                  mu = neq.mean() if pmu is True else pmu
+                  # deviation of mu should be as large or larger than mu
+                  e_mu = pe_mu * mu  # 5 *mu
 
+               smod = neq.solve(lam=pspllam, mu=mu, e_mu=e_mu, e_yk=True)
+               wko = smod.xk     # the knot positions
+               fko = smod()      # the knot values
+               eko = smod.e_yk   # the error estimates for knot values
+
+               # normalised residuals, chi2 per knot for the flexible sig
+               chik = np.zeros(nks+2)    # chi2 per knot
+               normk = np.zeros(nks+2)   # normalising factor to compute local chi2_red
+               sres = [0., 0., 0]   # sum of res, res**2 and count without tellurics for sig
+               if it == n_iter:
+                  # estimate the number of valid points for each knot
+                  edges = 0.5 * (wko[1:]+wko[:-1])
+                  edges = np.hstack((edges[0]+2*(wko[0]-edges[0]), edges, edges[-1]+2*(wko[-1]-edges[-1])))
+                  bko = 0.
+                  sn = []
+               for i, w2, modi, emodi, we, tellind, bmodi in normspec():
+                  okmap = okclip(w2, modi, emodi, tellind)
+                  w2, modi, emodi, tellind, bmodi = w2[okmap], modi[okmap], emodi[okmap], tellind[okmap], bmodi[okmap]
+                  ymod = smod(w2)
+                  res = (modi-ymod) / emodi
+                  sres[0] += np.sum(res[~tellind])
+                  sres[1] += np.sum(res[~tellind]**2)
+                  sres[2] += np.sum(~tellind)
+                  G, kkk = spl._cbspline_Bk(w2, nks, wmin, wmax)
+                  for k in range(4):
+                     normk += np.bincount(kkk+k, G[k], nks+2)
+                     chik += np.bincount(kkk+k, res**2 * G[k], nks+2)
+                  if it == n_iter:
+                     bko += np.histogram(w2, bins=edges, weights=(bmodi==0)*1.0)[0]
+                     if spoklist[tset][i].sn55 < 400 and w2.size:
+                        signal = wmean(modi, 1/emodi**2)  # the signal
+                        noise = wrms(modi-ymod, emodi)   # the noise
+                        sn.append(signal/noise)
+
+               sig = np.sqrt(sres[1]/sres[2] - (sres[0]/sres[2])**2) if sres[2] else np.nan
+               if np.isnan(sig):
+                  msg ='nan err_values in coadding. This may happen when data have gaps e.g. due masking or bad pixel flaging. Try the -pspline option'
+                  if safemode:
+                     print msg
+                     exit()
+                  pause(msg)
+               vara = spl.ucbspl(chik/normk, wmin, wmax)
+               clips.append((smod, vara))
+               print "%.5f (%d)" % (np.median(np.sqrt(vara())), nout),
+
+            cards += [('HIERARCH COADD FILE %03i' % (i+1), (sp.timeid, 'rv = %0.5f km/s' % (-RV[i]/1000.)))
+                      for i,sp in enumerate(spoklist[tset]) if sp.sn55 < 400]
+            sn = np.sum(np.array(sn)**2)**0.5
+
+            print ' S/N: %.5f' % sn
+            cards += [('HIERARCH SERVAL COADD SN%03i' % o, (float("%.3f" % sn), 'signal-to-noise estimate'))]
+            return smod, wko, fko, eko, bko, cards
+
+         done = [(o, checkpoint.get('tpl', iterate, o)) for o in corders]
+         done = [(o, res) for o,res in done if res is not None]
+         todo = set(corders) - set(o for o,res in done)
+         if done: print 'resume: %s coadded orders from checkpoint' % len(done)
+
+         # the orders are independent, the workers read only their order
+         for o,res in chain(done, izip(sorted(todo), pmap(coaddorder_stream if coadd=='stream' else coaddorder, [(o,) for o in sorted(todo)], nproc=nproc))):
+            if o in todo: checkpoint.put('tpl', iterate, o, res)
+            smod, wk[o], fk[o], ek[o], bk[o], cards = res
+            TPL[o] = Tpl(smod.xk, smod(), bspl=smod)
+            for key, val in cards: spt.header[key] = val
+
+         # oversampled template only for template.fits, the RVs use the B-splines
+         for o in corders:
+            ww[o], ff[o] = TPL[o].bspl.osamp(1.000000001*osize/TPL[o].bspl.K)
          if isinstance(ff, np.ndarray) and np.isnan(ff.sum()): stop('nan in template')
          spt.header['HIERARCH SERVAL COADD TYPE'] = (coadd, 'coadd method')
          spt.header['HIERARCH SERVAL COADD OMIN'] = (omin, 'minimum order for RV')
@@ -1585,27 +2302,14 @@ def serval(*argv):
       if targrv is None:
          targrv = tplrv
 
+      linenames = []   # line indices, lineind holds for each a list of (value, error)
       if meas_index:
-         halpha = []
-         haleft = []
-         harigh = []
-         cai = []
-         cak = []
-         cah = []
-         irt1 = []
-         irt1a = []
-         irt1b = []
-         irt2 = []
-         irt2a = []
-         irt2b = []
-         irt3 = []
-         irt3a = []
-         irt3b = []
-         nad1 = []
-         nad2 = []
-         nadr1 = []   # NaD Ref 1
-         nadr2 = []
-         nadr3 = []
+         linenames += ['Halpha', 'Haleft', 'Harigh', 'CaI', 'CaK', 'CaH']
+      if meas_CaIRT:
+         linenames += ['CaIRT1', 'CaIRT1a', 'CaIRT1b', 'CaIRT2', 'CaIRT2a', 'CaIRT2b', 'CaIRT3', 'CaIRT3a', 'CaIRT3b']
+      if meas_NaD:
+         linenames += ['NaD1', 'NaD2', 'NaDref1', 'NaDref2', 'NaDref3']
+      lineind = dict((name, [(np.nan, np.nan)]*nspecok) for name in linenames)
 
       rvccf, e_rvccf = zeros((nspec,nord)), zeros((nspec,nord))
       diff_rv = bool(driftref)
@@ -1613,6 +2317,7 @@ def serval(*argv):
       #chi2map = nans((nord, int(np.ceil((v_hi-v_lo)/ v_step))))
       chi2map = nans((nord, len(np.arange(targrv-tplrv+v_lo, targrv-tplrv+v_hi, v_step))))
       diff_width = not (ccf or diff_rv)
+      meas_chi2 = diff_width and (vsolver == 'grid' or bool(outchi) or mlcrx)   # chi2map for ML RV and ML CRX
       RV, e_RV = nans((2, nspec))
       rv, e_rv = nans((2, nspec, nord))
       dLW, e_dLW = nans((2, nspec)) # differential width change
@@ -1621,12 +2326,16 @@ def serval(*argv):
       print 'Iteration %s / %s (%s)' % (iterate, niter, obj)
       print "RV method: ", 'CCF' if ccf else 'DRIFT' if diff_rv else 'LEAST SQUARE'
 
-      for i,sp in enumerate(spoklist):
+      @stages.timed('rvspec' if iterate == niter else 'rvspec (pre-RV)')
+      def rvspec(i):
+         '''RV measurement for spectrum i. Returns its rows of the result arrays and the line indices.'''
+         global sp, fmod, pmin, pmax   # sp, fmod @getHalpha
          #if sp.flag:
             #continue
             # introduced for drift measurement? but then Halpha is not appended and writing halpha.dat will fail
          #sp = copy.deepcopy(sp)  # to prevent attaching the data to spoklist
-         sp = copy.copy(sp)  # to prevent attaching the data to spoklist
+         spoklist[i].reopen()   # once for restored spectra, not for each copy
+         sp = copy.copy(spoklist[i])  # to prevent attaching the data to spoklist
          if sp.filename.endswith('.gz') and sp.header:
             # for gz and if deepcopy and if file already open (after coadding header still present) this will result in "AttributeError: 'GzipFile' object has no attribute 'offset'"
             # deepcopy probably does not copy everything properly
@@ -1636,12 +2345,13 @@ def serval(*argv):
 
          if wfix: sp.w = spt.w
          fmod = sp.w * np.nan
+         bmask = masks(sp.w, tpl=(-spt.berv+sp.berv+(tplrv-targrv), 0.))   # tpl frame: barshift(w, -spt.berv+sp.berv+(tplrv-targrv))
          for o in orders:
             w2 = sp.w[o]
             x2 = np.arange(w2.size)
             f2 = sp.f[o]
             e2 = sp.e[o]
-            b2 = sp.bpmap[o] | msksky[o]
+            b2 = sp.bpmap[o] | msksky[o] | bmask[o]
 
             if inst.name == 'FEROS':
                pmin = pomin[o]
@@ -1649,16 +2359,10 @@ def serval(*argv):
 
             #if inst.name=='FEROS' and fib!='B':  # filter
                #hh = np.argsort(sp.f[o]); ii=hh[0:len(hh)*0.98]; pind=np.intersect1d(pind, ii)
-            b2[:pmin] |= flag.out
-            b2[pmax:] |= flag.out
-            b2[tellmask(w2)>0.01] |= flag.atm
-            b2[skymsk(w2)>0.01] |= flag.sky
-            b2[(tellmask(barshift(w2, -spt.berv+sp.berv+(tplrv-targrv)))>0.01)!=0] |= flag.badT   # flag for bad template
-            #pause()
             #if inst.name == 'HARPS':
                #b2[lstarmask(barshift(w2,sp.berv))>0.01] |= flag.lowQ
                #pause()
-            pind = x2[b2==0]
+            pind = orderpix(b2, pmin, pmax)
             if not pind.size: continue
 
             wmod = barshift(w2, np.nan_to_num(sp.berv))   # berv can be NaN, e.g. calibration FP, ...
@@ -1728,6 +2432,7 @@ def serval(*argv):
                   # first and second derivative from spline interpolation
                   # may overestimate gradients
                   # ringing may influence gradients
+                  from scipy import interpolate
                   kkk = interpolate.splrep(spt.w[o], spt.f[o])
                   dy = interpolate.splev(spt.w[o], kkk, der=1)
                   ddy = interpolate.splev(spt.w[o], kkk, der=2)
@@ -1763,67 +2468,14 @@ def serval(*argv):
                # pause()
                if o==41: pind=pind[:-9]   # @CARM_NIR?
                #par, f2mod, keep, stat, chi2mapo = fitspec((ww[o], ff[o], kk[o]), wmod, f2, e2, v=targrv-tplrv, clip=kapsig, nclip=nclip, keep=pind, indmod=np.s_[pmin:pmax], plot=o in lookssr, deg=deg, chi2map=True)
-               par, f2mod, keep, stat, chi2mapo = fitspec(TPL[o], wmod, f2, e2, v=targrv-tplrv, clip=kapsig, nclip=nclip, keep=pind, indmod=np.s_[pmin:pmax], plot=o in lookssr, deg=deg, chi2map=True)
+               fit = fitspec(TPL[o], wmod, f2, e2, v=targrv-tplrv, clip=kapsig, nclip=nclip, keep=pind, indmod=np.s_[pmin:pmax], plot=o in lookssr, deg=deg, chi2map=meas_chi2, vsolver=vsolver)
+               par, f2mod, keep, stat = fit[:4]
+               if meas_chi2: chi2mapo = fit[4]
 
                if diff_width:
-                  '''we need the model at the observation and oversampled since we need the second derivative including the polynomial'''
-                  #f2mod = calcspec(wmod, *par.params) #calcspec does not work when w < wtmin
-                  #ftmod_tmp = calcspec(ww[o], *par.params) #calcspec does not work when w < wtmin
-                  #wo = TPL[o]
-                  #i0 = np.searchsorted(dopshift(ww[o],par.params[0]), ww[o][0])
-                  #i1 = np.searchsorted(dopshift(ww[o],par.params[0]), ww[o][-1]) - 1
-                  #ftmod_tmp = 0*ww[o]
-                  #ftmod_tmp[i0:i1] = calcspec(ww[o][i0:i1], *par.params) #calcspec does not work when w < wtmin
-                  #ftmod_tmp[0:i0] = ftmod_tmp[i0]
-                  #ftmod_tmp[i1:] = ftmod_tmp[i1-1]
-                  poly = calcspec(wmod, *par.params, retpoly=True)
-
-
-                  '''estimate differential changes in line width ("FWHM")
-                     correlate the residuals with the second derivative
-                  We want to scale the residuals (without the poly) to the second derivative 
-                  f = p * t
-                  t = f/p
-                  a*ddt ~ y/p - t = (y-pt)/p = r/p
-                  r = p*a*ddt
-                  '''
-                  dy = poly * TPL[o](dopshift(wmod, par.params[0]), der=1)
-                  ddy = poly * TPL[o](dopshift(wmod, par.params[0]), der=2)
-
-                  if not def_wlog:
-                     dy *= wmod
-                     ddy *= wmod**2
-                  v = -c * np.dot(1/e2[keep]**2*dy[keep], (f2-f2mod)[keep]) / np.dot(1/e2[keep]**2*dy[keep], dy[keep])
-
-                  moon = 0
-                  if moon:
-                     # simple moon contamination
-                     a1, a0 = np.polyfit(f2mod[keep], f2[keep], 1)
-                     print a1, a0
-                     if 0:
-                        gplot(w2[keep], f2mod[keep],'w lp,',w2[keep], f2[keep], ' w lp')
-                        gplot(f2mod[keep], f2[keep], w2[keep],' palette , x, %s+%s*x' %(a0,a1) )
-                        gplot(w2[keep], f2mod[keep],'w lp,',w2[keep], f2[keep], ' w lp,',w2[keep], (f2[keep]-a0)/a1, ' w lp')
-                        # residuals
-                        gplot(w2[keep], f2[keep]-f2mod[keep], ' w lp, ', w2[keep], f2[keep]-a1*f2mod[keep]-a0, 'w lp lc 3')
-                     #pause(o)
-
-                     f2 = f2c = (f2-a0)/a1 # correct observation
-
-                     dlwo = c**2 * np.dot(1/e2[keep]**2*ddy[keep], (f2c-f2mod)[keep]) / np.dot(1/e2[keep]**2*ddy[keep], ddy[keep])
-                     e_dlwo = c**2 * np.sqrt(1 / np.dot(1/e2[keep]**2, ddy[keep]**2))
-                  else:
-                     dlwo = c**2 * np.dot(1/e2[keep]**2*ddy[keep], (f2-f2mod)[keep]) / np.dot(1/e2[keep]**2*ddy[keep], ddy[keep])
-                     e_dlwo = c**2 * np.sqrt(1 / np.dot(1/e2[keep]**2, ddy[keep]**2))
-                  drchi = rms(((f2-f2mod) - dlwo/c**2*ddy)[keep] / e2[keep])
-                  #print par.params[1],par.params[0], v, dlwo*1000, e_dlwo
-                  if np.isnan(dlwo) and not safemode: pause()
-                  dlw[i,o] = dlwo * 1000       # convert from (km/s) to m/s km/s
-                  e_dlw[i,o] = e_dlwo * 1000 * drchi
-                  if 0:
-                     gplot(wmod,(f2-f2mod),e2, 'us 1:2:3 w e,', wmod[keep],(f2-f2mod)[keep], 'us 1:2')
-                     ogplot(wmod,dlwo/c**2*ddy); #ogplot(wmod,f2, 'axis x1y2')
-                     pause(o, 'dLW', dlw[i,o])
+                  # estimate differential changes in line width ("FWHM")
+                  dlw[i,o], e_dlw[i,o] = difflw(TPL[o], wmod, f2, e2, f2mod, keep, par.params)
+                  if np.isnan(dlw[i,o]) and not safemode: pause()
 
             fmod[o] = f2mod
             if par.perror is None: par.perror = [0.,0.,0.,0.]
@@ -1833,7 +2485,7 @@ def serval(*argv):
             rchi[i,o] = stat['std']
             Nok[i,o] = len(keep)
 
-            if not diff_rv:
+            if meas_chi2:
                vgrid = chi2mapo[0]
                chi2map[o] = chi2mapo[1] # chi2mapo[1].min() - (a[0]+a[1]*v+a[2]*v**2)
                # pause(o, chi2map[o].min())
@@ -1883,48 +2535,25 @@ def serval(*argv):
          print i+1, '/', nspec, sp.timeid, sp.bjd, RV[i], e_RV[i]
 
          # Chromatic trend
-         if 1:
-            # scipy version
-            #np.polynomial.polyval(x,[a,b])
-            def func(x, a, b): return a + b*x #  np.polynomial.polyval(x,a)
-            #
-            # x = np.mean(np.exp(spt.w) if def_wlog else spt.w, axis=1)    # lambda
-            # x = 1/np.mean(np.exp(spt.w) if def_wlog else spt.w, axis=1)  # 1/lambda
-            x = np.mean(spt.w if def_wlog else np.log(spt.w), axis=1)  # ln(lambda)
-            xc = np.mean(x[ind])   # only to center the trend fit
-            # fit trend with curve_fit to get parameter error
-            pval, cov = curve_fit(func, x[ind]-xc, rv[i][ind], [0.0, 0.0], e_rv[i][ind])
-            perr = np.sqrt(np.diag(cov))
-            #print cov, pval
-            #pval, cov = np.polyfit(x[ind]-xc, rv[i][ind], 1, w=1/e_rv[i][ind], cov=True)
-            #print cov, pval
-
-            l_v = np.exp(-(pval[0]-RV[i])/pval[1]+xc)
-            CRX[i], e_CRX[i], xo[i] = pval[1], perr[1], x
-            tCRX[i] = CRX[i], e_CRX[i], pval[0], perr[0], l_v
-
-            # manual regression
-            lhs = np.array([1/e_rv[i][ind], (x[ind]-xc)/e_rv[i][ind]]).T
-            cov = np.linalg.inv(np.dot(lhs.T, lhs))
-            #e_CRX[i] = np.sqrt(cov[1,1])
-
-            # with scaling
-            scale = np.sqrt((lhs*lhs).sum(axis=0))
-            cov = np.linalg.inv(np.dot((lhs/scale).T, lhs/scale)) / np.outer(scale, scale)
-
-            #pause(e_CRX[i])
-
-            #coli,stat = polynomial.polyfit(arange(len(rv[i]))[ind],rv[i][ind], 1, w=1./e_rv[i][ind], full=True)
-            if 0:   # show trend in each order
-               gplot.log('x; set autoscale xfix; set xtic add (0'+(",%i"*10)%tuple((np.arange(10)+1)*1000)+')')
-               gplot(np.exp(x[ind]), rv[i][ind], e_rv[i][ind], ' us 1:2:3 w e pt 7, %f+%f*log(x/%f), %f' % (RV[i], pval[1],l_v,RV[i]))
-               pause()
-
-         if not diff_rv:
+         # x = np.mean(np.exp(spt.w) if def_wlog else spt.w, axis=1)    # lambda
+         # x = 1/np.mean(np.exp(spt.w) if def_wlog else spt.w, axis=1)  # 1/lambda
+         x = np.mean(spt.w if def_wlog else np.log(spt.w), axis=1)  # ln(lambda)
+         CRX[i], e_CRX[i], rvxc, e_rvxc, xc = crxfit(x[ind], rv[i][ind], e_rv[i][ind])
+         l_v = np.exp(-(rvxc-RV[i])/CRX[i]+xc)
+         xo[i] = x
+         tCRX[i] = CRX[i], e_CRX[i], rvxc, e_rvxc, l_v
+         if 0:   # show trend in each order
+            gplot.log('x; set autoscale xfix; set xtic add (0'+(",%i"*10)%tuple((np.arange(10)+1)*1000)+')')
+            gplot(np.exp(x[ind]), rv[i][ind], e_rv[i][ind], ' us 1:2:3 w e pt 7, %f+%f*log(x/%f), %f' % (RV[i], CRX[i], l_v, RV[i]))
+            pause()
+
+         if meas_chi2:
             # ML version of chromatic trend
             oo = ~np.isnan(chi2map[:,0]) & ~np.isnan(rchi[i]) 
 
-            gg = Chi2Map(chi2map, (v_lo, v_step), RV[i]/1000, e_RV[i]/1000, rv[i,oo]/1000, e_rv[i,oo]/1000, orders=oo, keytitle=obj+' ('+inst.name+')\\n'+sp.timeid, rchi=rchi[i], No=Nok[i], name='')
+            from chi2map import Chi2Map
+            with stages('Chi2Map'):
+               gg = Chi2Map(chi2map, (v_lo, v_step), RV[i]/1000, e_RV[i]/1000, rv[i,oo]/1000, e_rv[i,oo]/1000, orders=oo, keytitle=obj+' ('+inst.name+')\\n'+sp.timeid, rchi=rchi[i], No=Nok[i], name='')
             mlRV[i], e_mlRV[i] = gg.mlRV, gg.e_mlRV
 
             mlRVc[i] = mlRV[i] - np.nan_to_num(sp.drift) - np.nan_to_num(sp.sa)
@@ -1934,7 +2563,8 @@ def serval(*argv):
                gg.plot()
                pause(i, mlRV[i], e_mlRV[i])
 
-            mlCRX[i], e_mlCRX[i] = gg.mlcrx(x, xc, oo)
+            with stages('mlcrx'):
+               mlCRX[i], e_mlCRX[i] = gg.mlcrx(x, xc, oo)
 
             if lookmlCRX:
                gg.plot_fit()
@@ -1944,29 +2574,8 @@ def serval(*argv):
          # Line Indices
          vabs = tplrv + RV[i]/1000.
          kwargs = {'inst': inst.name, 'plot':looki}
-         if meas_index:
-            halpha += [getHalpha(vabs, 'Halpha', **kwargs)]
-            haleft += [getHalpha(vabs, 'Haleft', **kwargs)]
-            harigh += [getHalpha(vabs, 'Harigh', **kwargs)]
-            cai += [getHalpha(vabs, 'CaI', **kwargs)]
-            cak += [getHalpha(vabs, 'CaK', **kwargs)] if inst.name=='HARPS' else [(np.nan,np.nan)]
-            cah += [getHalpha(vabs, 'CaH', **kwargs)] if inst.name=='HARPS' else [(np.nan,np.nan)]
-         if meas_CaIRT:
-            irt1 +=  [getHalpha(vabs, 'CaIRT1', **kwargs)]
-            irt1a += [getHalpha(vabs, 'CaIRT1a', **kwargs)]
-            irt1b += [getHalpha(vabs, 'CaIRT1b', **kwargs)]
-            irt2 +=  [getHalpha(vabs, 'CaIRT2', **kwargs)]
-            irt2a += [getHalpha(vabs, 'CaIRT2a', **kwargs)]
-            irt2b += [getHalpha(vabs, 'CaIRT2b', **kwargs)]
-            irt3 +=  [getHalpha(vabs, 'CaIRT3', **kwargs)]
-            irt3a += [getHalpha(vabs, 'CaIRT3a', **kwargs)]
-            irt3b += [getHalpha(vabs, 'CaIRT3b', **kwargs)]
-         if meas_NaD:
-            nad1 += [getHalpha(vabs, 'NaD1', **kwargs)]
-            nad2 += [getHalpha(vabs, 'NaD2', **kwargs)]
-            nadr1 += [getHalpha(vabs, 'NaDref1', **kwargs)]
-            nadr2 += [getHalpha(vabs, 'NaDref2', **kwargs)]
-            nadr3 += [getHalpha(vabs, 'NaDref3', **kwargs)]
+         with stages('indices'):
+            lines = [getHalpha(vabs, name, **kwargs) if inst.name=='HARPS' or name not in ('CaK', 'CaH') else (np.nan,np.nan) for name in linenames]
 
          if diff_width:
             ind, = where(np.isfinite(e_dlw[i]))
@@ -2017,6 +2626,45 @@ def serval(*argv):
             hdr['CDELT2'] = 1
             write_fits(outdir+'res/'+outfile, chi2map, hdr+spt.header[10:])
 
+         return [a[i] for a in rows], lines
+
+      rows = [bjd, RV, e_RV, rvm, rvmerr, RVc, e_RVc, CRX, e_CRX, tCRX, xo, mlRV, e_mlRV, mlRVc, e_mlRVc, mlCRX, e_mlCRX,
+              snr, rchi, Nok, rv, e_rv, rvccf, e_rvccf, dLW, e_dLW, dlw, e_dlw]
+      rownames = ['bjd', 'RV', 'e_RV', 'rvm', 'rvmerr', 'RVc', 'e_RVc', 'CRX', 'e_CRX', 'tCRX', 'xo', 'mlRV', 'e_mlRV', 'mlRVc', 'e_mlRVc', 'mlCRX', 'e_mlCRX',
+              'snr', 'rchi', 'Nok', 'rv', 'e_rv', 'rvccf', 'e_rvccf', 'dLW', 'e_dLW', 'dlw', 'e_dlw']
+
+      todo = range(nspecok)
+      if incremental and last and iterate == niter:
+         # reuse the rows of unchanged spectra from the previous bundle
+         prev = np.load(outdir+obj+fibsuf+'.npz')
+         prev = dict((name, prev[name]) for name in prev.files)
+         if all(name in prev for name in rownames + ['line_'+name for name in linenames]) and prev['rv'].shape[1] == nord and str(prev.get('optkey')) == optkey:
+            jprev = dict(((os.path.abspath(f), t), j) for j,(f,t) in enumerate(zip(prev['filename'], prev['mtime'])))
+            reused = []
+            for i,sp in enumerate(spoklist):
+               j = jprev.get((os.path.abspath(sp.filename), os.path.getmtime(sp.filename)))
+               if j is not None:
+                  for name, a in zip(rownames, rows): a[i] = prev[name][j]
+                  for name in linenames: lineind[name][i] = tuple(prev['line_'+name][j])
+                  reused.append(i)
+            reused = set(reused)
+            todo = [i for i in todo if i not in reused]
+            print 'incremental: %s spectra reused, %s to fit' % (len(reused), len(todo))
+         else:
+            print 'incremental: previous products incompatible, fitting all spectra'
+
+      done = [(i, checkpoint.get('rv', iterate, i)) for i in todo]
+      done = [(i, res) for i,res in done if res is not None]
+      todo = set(todo) - set(i for i,res in done)
+      if done:
+         print 'resume: %s spectra from checkpoint, %s to fit' % (len(done), len(todo))
+
+      # the spectra are independent, the workers return their rows in order
+      for i,(row, lines) in chain(done, izip(sorted(todo), pmap(rvspec, [(i,) for i in sorted(todo)], nproc=nproc))):
+         if i in todo: checkpoint.put('rv', iterate, i, (row, lines))
+         for a, ai in zip(rows, row): a[i] = ai
+         for name, val in zip(linenames, lines): lineind[name][i] = val
+
          if i>0 and not safemode:
             # plot time series
             gplot(bjd-2450000, RV, e_RV, ' us 1:2:3 w e pt 7') # explicitly specify columns to deal with NaNs
@@ -2028,6 +2676,7 @@ def serval(*argv):
          np.savetxt(prefile, list(zip(bjd[:nspecok], RV[:nspecok], e_RV[:nspecok])), fmt="%s")
          continue
       # write final results
+      stages.start('output')
       rvfile = outdir+obj+fibsuf+'.dat'
       rvcfile = outdir+obj+'.rvc'+fibsuf+'.dat'
       crxfile = outdir+obj+'.crx'+fibsuf+'.dat'
@@ -2063,23 +2712,43 @@ def serval(*argv):
          print >>dlwunit[rvflag], sp.bjd, dLW[i], e_dLW[i], " ".join(map(str,dlw[i]))
          print >>snrunit[rvflag], sp.bjd, np.nansum(snr[i]**2)**0.5, " ".join(map(str,snr[i]))
          print >>chiunit[rvflag], sp.bjd, " ".join(map(str,rchi[i]))
+         li = dict((name, lineind[name][i]) for name in linenames)
          if meas_index:
-            print >>halunit[rvflag], sp.bjd, " ".join(map(str, lineindex(halpha[i],harigh[i],haleft[i]) + halpha[i] + haleft[i] + harigh[i] + lineindex(cai[i],harigh[i],haleft[i])))  #,cah[i][0],cah[i][1]
+            print >>halunit[rvflag], sp.bjd, " ".join(map(str, lineindex(li['Halpha'],li['Harigh'],li['Haleft']) + li['Halpha'] + li['Haleft'] + li['Harigh'] + lineindex(li['CaI'],li['Harigh'],li['Haleft'])))  #,cah[i][0],cah[i][1]
          if meas_CaIRT:
-            print >>irtunit[rvflag], sp.bjd, " ".join(map(str, lineindex(irt1[i], irt1a[i], irt1b[i]) + lineindex(irt2[i], irt2a[i], irt2b[i]) + lineindex(irt3[i], irt3a[i], irt3b[i])))
+            print >>irtunit[rvflag], sp.bjd, " ".join(map(str, lineindex(li['CaIRT1'], li['CaIRT1a'], li['CaIRT1b']) + lineindex(li['CaIRT2'], li['CaIRT2a'], li['CaIRT2b']) + lineindex(li['CaIRT3'], li['CaIRT3a'], li['CaIRT3b'])))
          if meas_NaD:
-            print >>nadunit[rvflag], sp.bjd, " ".join(map(str, lineindex(nad1[i],nadr1[i],nadr2[i]) + lineindex(nad2[i],nadr2[i],nadr3[i])))
+            print >>nadunit[rvflag], sp.bjd, " ".join(map(str, lineindex(li['NaD1'],li['NaDref1'],li['NaDref2']) + lineindex(li['NaD2'],li['NaDref2'],li['NaDref3'])))
       for ifile in rvunit + rvounit + rvcunit + snrunit + chiunit + mypfile + crxunit + srvunit + mlcunit + dlwunit:
          file.close(ifile)
 
+      # binary bundle with all products (also the bad ones, see rvflag)
+      products = dict((name, a[:nspecok]) for name, a in zip(rownames, rows))
+      products.update(drift=[sp.drift for sp in spoklist], e_drift=[sp.e_drift for sp in spoklist], berv=[sp.berv for sp in spoklist], sa=[sp.sa for sp in spoklist],
+         flag=[sp.flag for sp in spoklist], rvflag=[int((sp.flag&(sflag.eggs+sflag.iod+sflag.rvnan)) > 0) for sp in spoklist],
+         timeid=[sp.timeid for sp in spoklist], filename=[sp.filename for sp in spoklist],
+         mtime=[os.path.getmtime(sp.filename) for sp in spoklist], optkey=optkey)
+      for name in linenames:
+         products['line_'+name] = np.array(lineind[name], dtype=float).reshape(-1, 2)
+      np.savez(outdir+obj+fibsuf+'.npz', **products)
+
       t2 = time.time() - t0
       print
       print nspec, 'spectra processed', rvfile+"  (total %s, compu %s)\n" %(minsec(t2), minsec(t2-t1))
 
+      stages.stop('output')
+
    # end of iterate loop
+   checkpoint.clear()
+   if Spectrum.cache is not None:
+      Spectrum.cache.prune(splist)
+
+   if not driftref and nspec>1:
+      with stages('analyse_rv'):
+         x = analyse_rv(obj, postiter=postiter, fibsuf=fibsuf, safemode=safemode)
+   stages.write(outdir+'stages.json', obj=obj, argv=' '.join(argv), nspec=nspec, nord=nord, nproc=nproc)
 
    if not driftref and nspec>1:
-      x = analyse_rv(obj, postiter=postiter, fibsuf=fibsuf, safemode=safemode)
       if safemode<2: pause('TheEnd')
 
 
@@ -2126,8 +2795,8 @@ if __name__ == "__main__":
    argopt('-ccf',  help='mode ccf [with files]', nargs='?', const='th_mask_1kms.dat', type=str)
    argopt('-ccfmode', help='type for ccf template', nargs='?', default='box',
                       choices=['box', 'binless', 'gauss', 'trapeze'])
-   argopt('-coadd', help='coadd method'+default, default='post3',
-                   choices=['post3'])
+   argopt('-coadd', help='coadd method (stream: normal equations accumulated spectrum by spectrum, memory independent of the number of spectra)'+default, default='post3',
+                   choices=['post3', 'stream'])
    argopt('-coset', help='index for order in coadding (default: oset)', type=arg2slice)
    argopt('-co_excl', help='orders to exclude in coadding (default: o_excl)', type=arg2slice)
    argopt('-ckappa', help='kappa sigma (or lower and upper) clip value in coadding. Zero values for no clipping'+default, nargs='+', type=float, default=(4.,4.))
@@ -2139,6 +2808,7 @@ if __name__ == "__main__":
    argopt('-nset', '-iset', help='slice for file subset (e.g. 1:10, ::5)', default=':', type=arg2slice)
    argopt('-kapsig', help='kappa sigma clip value'+default, type=float, default=3.0)
    argopt('-last', help='use last template (-tpl <obj>/template.fits)', action='store_true')
+   argopt('-incremental', help='fit only new or changed spectra with the last template and reuse the other results from <obj>/<obj>.npz; a full run is done, when template or npz are missing (i.e. remove the template to declare it stale) or the npz was made with other options', action='store_true')
    argopt('-look', help='slice of orders to view the fit [:]', nargs='?', default=[], const=':', type=arg2slice)
    argopt('-looki', help='list of indices to watch', nargs='*', choices=['Halpha', 'Haleft', 'Haright', 'CaI', 'HK'], default=[]) #, const=['Halpha'])
    argopt('-lookt', help='slice of orders to view the coadd fit [:]', nargs='?', default=[], const=':', type=arg2slice)
@@ -2147,7 +2817,9 @@ if __name__ == "__main__":
    argopt('-lookmlRV', help='chi2map and master', nargs='?', default=[], const=':', type=arg2slice)
    argopt('-lookmlCRX', help='chi2map and CRX fit ', nargs='?', default=[], const=':', type=arg2slice)
    argopt('-nclip', help='max. number of clipping iterations'+default, type=int, default=2)
+   argopt('-mlcrx', help='compute the chi2 maps for ML RV and CRX (mlc.dat) also with -vsolver newton', action='store_true')
    argopt('-niter', help='number of RV iterations'+default, type=int, default=2)
+   argopt('-nproc', help='number of processes for coadding and RV measurement'+default, type=int, default=1)
    argopt('-oset', help='index for order subset (e.g. 1:10, ::5)', default={'HARPS':'10:71', 'HARPN':'10:', 'HPF':"[4,5,6,14,15,16,17,18]", 'CARM_VIS':'10:52', 'CARM_NIR': ':', 'FEROS':'10:', 'else':':'}, type=arg2slice)
    argopt('-o_excl', help='Orders to exclude (e.g. 1,10,3)', default={"CARM_NIR":"17,18,19,20,21,36,37,38,39,40,41,42", "else":[]}, type=arg2slice)
    #argopt('-outmod', help='output the modelling results for each spectrum into a fits file',  choices=['ratio', 'HARPN', 'CARM_VIS', 'CARM_NIR', 'FEROS', 'FTS'])
@@ -2162,7 +2834,13 @@ if __name__ == "__main__":
    argopt('-pmu', help='analog to GP mean. Default no GP penalty. Without the mean in each order. Otherwise this value.', nargs='?', const=True, type=float)
    argopt('-pe_mu', help='analog to GP mean deviation', default=5., type=float)
    argopt('-reana', help='flag reanalyse only', action='store_true')
+   argopt('-checkpoint', help='store the coadded orders and RVs as they are finished in <obj>/checkpoint/ (one small file per order and spectrum, removed at the end), so an interrupted run can be resumed', action='store_true', dest='ckpt')
+   argopt('-resume', help='resume an interrupted run (implies -checkpoint); coadded orders and RVs from <obj>/checkpoint/ are not computed again (same files and options required)', action='store_true')
    argopt('-rvwarn', help='[km/s] warning threshold in debug'+default, default=2., type=float)
+   argopt('-scanidx', help='persistent index for the header scan; files with unchanged size and mtime are not scanned again (default: <obj>/<obj>.scan.pkl)', nargs='?', const=True)
+   argopt('-ostore', help='order-major memory mapped store of the template spectra for coadding (in <obj>/ostore/)', action='store_true')
+   argopt('-cache', help='cache for the preprocessed spectra in memory; with a directory also a persistent .npy store (disk usage about the size of the input spectra; entries of spectra not in the run are removed). The memory cache is per process and does not help with -nproc>1, the disk store does.', nargs='?', const=True)
+   argopt('-cachemem', help='[MB] memory budget of the spectrum cache'+default, type=float, default=2000.)
    argopt('-safemode', help='does not pause or stop, optional level 1  2 (reana)', nargs='?', type=int, const=1, default=False)
    argopt('-skippre', help='Skip pre-RVs.', action='store_true')
    argopt('-skymsk', help='Sky emission line mask ('' for no masking)'+default, default='auto', dest='skyfile')
@@ -2173,6 +2851,7 @@ if __name__ == "__main__":
    argopt('-tplrv', help='[km/s] template RV (default auto, for index measures, for phoe tpl put 0 km/s, None => no measure, targ => from simbad, auto => first from header, second from targ else consider to adapt also rvguess))', default={'CARM_NIR':None, 'else':'auto'})
    argopt('-tset',  help="slice for file subset in template creation", default=':', type=arg2slice)
    argopt('-verb', help='verbose', action='store_true')
+   argopt('-vsolver', help='RV optimisation: grid scan with parabola or Gauss-Newton (grid as fallback)'+default, default='grid', choices=['grid', 'newton'])
    v_lo, v_hi, v_step = -5.5, 5.6, 0.1
    argopt('-vrange', help='[km/s] velocity grid around targrv (v_lo, v_hi, v_step)'+default, nargs='*', default=(v_lo, v_hi, v_step), type=float)
    argopt('-vtfix', help='fix RV in template creation', action='store_true')
@@ -2206,6 +2885,15 @@ if __name__ == "__main__":
    if skippre or vtfix:
       niter -= 1
 
+   if incremental:
+      # with the template and products of a previous run only new spectra are fitted,
+      # otherwise a full run
+      outdir, fibsuf = obj+'/', '_B' if inst=='FEROS' and fib=='B' else ''   # as in serval()
+      if os.path.exists(outdir+'template'+fibsuf+'.fits') and os.path.exists(outdir+obj+fibsuf+'.npz'):
+         last = True
+         niter = 1
+      if not scanidx: scanidx = True
+
    if dir_or_inputlist is None:
       ## execute last command
       #with open(obj+'/lastcmd.txt') as f:
@@ -2230,6 +2918,11 @@ if __name__ == "__main__":
    if outfmt == []:
       outfmt = ['fmod', 'err', 'res', 'wave']
 
+   if nproc > 1:
+      # the workers cannot interact with plots and pauses
+      if not safemode: safemode = 1
+      look = looki = lookt = lookssr = lookmlRV = lookmlCRX = []
+
    if cprofile:
       sys.argv.remove('-cprofile')
       os.system('python -m cProfile -s time -o speed.txt $SERVAL/src/serval.py '+" ".join(sys.argv[1:]))
@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+__author__ = 'Mathias Zechmeister'
+__version__ = '2019-04-08'
+
+description = '''
+SERVAL batch - run serval for many targets
+    the targets are scheduled on a common set of cores, largest first;
+    modules, instrument setup and masks are loaded once and inherited
+    by the forked serval runs
+'''
+
+import argparse
+import glob
+import importlib
+import multiprocessing
+import os
+import runpy
+import shlex
+import sys
+import time
+
+import numpy as np
+
+import serval   # preload numpy, scipy, read_spec, ... for all runs
+from servald import loadmasks
+from serval import servalsrc, minsec
+
+
+def readlist(filename):
+   '''Read the target list. Each line: obj dir_or_inputlist [serval options].'''
+   jobs = []
+   with open(filename) as f:
+      for line in f:
+         line = line.split('#')[0]
+         if line.strip():
+            args = shlex.split(line)
+            jobs.append((args[0], args[1], args[2:]))
+   return jobs
+
+def nfiles(dir_or_inputlist):
+   '''Rough job size, the number of input files.'''
+   if os.path.isdir(dir_or_inputlist):
+      return len(os.listdir(dir_or_inputlist))
+   elif os.path.isfile(dir_or_inputlist):
+      with open(dir_or_inputlist) as f:
+         return sum(1 for line in f if line.strip())
+   return 0
+
+def nspectra(obj, since=0.):
+   '''Number of processed spectra from the product bundle (0, when it was not written after since).'''
+   bundle = obj+'/'+obj+'.npz'
+   try:
+      if os.path.getmtime(bundle) < since: return 0   # from a previous run
+      return len(np.load(bundle)['bjd'])
+   except Exception:
+      return 0
+
+def runserval(argv):
+   '''Run serval.py as main in this (forked) process. The output goes to the serval log.'''
+   devnull = os.open(os.devnull, os.O_WRONLY)
+   os.dup2(devnull, 1)
+   os.dup2(devnull, 2)
+   sys.argv = [servalsrc+'serval.py'] + argv
+   try:
+      runpy.run_path(servalsrc+'serval.py', run_name='__main__')
+   except SystemExit as e:
+      if e.code: raise   # sys.exit(serval()) with None is a success
+
+
+if __name__ == "__main__":
+   default = " (default: %(default)s)."
+   epilog = """\
+   usage example:
+   %(prog)s targets.lis -inst HARPS -njobs 8 -nproc 2 -safemode -niter 2
+
+   targets.lis:
+   gj699  data/HARPS/gj699/ -targ gj699
+   gj588  data/HARPS/gj588/
+   """
+   insts = [os.path.basename(i)[5:-3] for i in glob.glob(servalsrc+'inst_*.py')]
+
+   parser = argparse.ArgumentParser(description=description, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
+   argopt = parser.add_argument   # function short cut
+   argopt('targlist', help='File with one target per line: obj dir_or_inputlist [serval options].')
+   argopt('-inst', help='instrument '+default, default='HARPS', choices=insts)
+   argopt('-njobs', help='number of targets processed at the same time'+default, type=int, default=multiprocessing.cpu_count())
+   argopt('-nproc', help='number of processes per target (serval -nproc)'+default, type=int, default=1)
+   args, opts = parser.parse_known_args()   # all other options are passed to serval
+
+   jobs = list(enumerate(readlist(args.targlist)))   # a target can be listed twice, the index identifies the job
+   jobs.sort(key=lambda job: -nfiles(job[1][1]))   # largest first, the small ones fill the gaps
+
+   # shared setup, inherited by the forked runs
+   inst = importlib.import_module('inst_'+args.inst)
+   for fib in ('', 'B'):
+      loadmasks(inst, fib=fib)
+
+   print 'batch: %s targets, %s jobs x %s processes' % (len(jobs), args.njobs, args.nproc)
+   t0 = time.time()
+   running = {}
+   failed = []
+   ntotal = 0
+   while jobs or running:
+      while jobs and len(running) < args.njobs:
+         j, (obj, data, targopts) = jobs.pop(0)
+         argv = [obj, data, '-inst', args.inst, '-nproc', str(args.nproc), '-safemode'] + opts + targopts
+         proc = multiprocessing.Process(target=runserval, args=(argv,))
+         proc.start()
+         running[j] = obj, proc, time.time()
+      time.sleep(0.2)
+      for j, (obj, proc, tj) in running.items():
+         if not proc.is_alive():
+            proc.join()
+            del running[j]
+            nsp = 0 if proc.exitcode else nspectra(obj, since=tj)
+            ntotal += nsp
+            if proc.exitcode: failed.append(obj)
+            dt = time.time() - t0
+            print '%-15s %5s spectra in %s %s  (total: %s spectra, %.2f spectra/s, %s targets left)' % (obj, nsp, minsec(time.time()-tj),
+                  'FAILED (exitcode %s)'%proc.exitcode if proc.exitcode else 'ok', ntotal, ntotal/dt, len(jobs)+len(running))
+
+   dt = time.time() - t0
+   print 'batch done: %s spectra in %s (%.2f spectra/s, %.1f s/spectrum per core)' % (ntotal, minsec(dt), ntotal/dt, dt*args.njobs*args.nproc/max(ntotal,1))
+   if failed:
+      print 'failed:', ' '.join(failed)
+   sys.exit(bool(failed))
@@ -0,0 +1,277 @@
+#! /usr/bin/env python
+__author__ = 'Mathias Zechmeister'
+__version__ = '2019-04-08'
+
+description = '''
+SERVAL daemon - quick-look RVs with resident templates
+    the templates (<obj>/template.fits from a previous serval run) and
+    the masks are loaded once, then spectra are fitted on request
+'''
+
+import argparse
+import glob
+import importlib
+import os
+import SocketServer
+import sys
+import time
+
+import numpy as np
+
+from wstat import wsem
+from read_spec import *   # flag, def_wlog, Spectrum, read_template, airtovac
+from calcspec import *
+from targ import Targ
+import cubicSpline
+import masktools
+import serval
+from serval import Tpl, read_knot_template, fitspec, orderpix, difflw, crxfit, secacc, lam2wave, nans, servallib, servalsrc
+
+
+def loadmasks(inst, fib='', atmfile='auto', skyfile='auto', msklist='', mskwd=4.):
+   '''Load the telluric and sky masks as in serval.'''
+   maskfile = servallib + getattr(inst, 'maskfile', 'telluric_mask_atlas_short.dat')
+   if inst.name in ('CARM_VIS', 'CARM_NIR'):
+      maskfile = servallib + 'telluric_mask_carm_short.dat'
+   elif inst.name == 'FEROS' and fib == 'B':
+      maskfile = servallib + 'feros_mask_short.dat'
+
+   if fib == 'B':
+      if atmfile == 'auto': atmfile = None
+      if skyfile == 'auto': skyfile = None
+
+   mask = None
+   masks = masktools.MaskSet()
+   if atmfile:
+      if atmfile != 'auto':
+         maskfile = atmfile
+      if 'mask_ne' in atmfile:
+         maskfile = servallib + atmfile
+      mask = masktools.loadmask(maskfile)
+      if 'telluric_mask_atlas_short.dat' in maskfile:
+         lcorr = 0.000009  # Guillems mask needs this shift of 2.7 km/s
+         mask[:,0] = airtovac(mask[:,0]) * (1-lcorr)
+      if 'th_mask' in maskfile:
+         mask[:,1] = mask[:,1] == 0
+
+   if skyfile:
+      if skyfile=='auto' and inst.name=='CARM_NIR':
+         sky = masktools.loadmask(servallib + 'sky_carm_nir')
+         masks.add(masktools.IntervalSet.from_mask(lam2wave(sky[:,0]), sky[:,1]), flag.sky)
+
+   msksky = [0] * inst.iomax
+   if inst.name=='CARM_VIS':
+      msksky = flag.atm * masktools.loadmask(servallib + 'carm_vis_tel_sky.fits')
+
+   if msklist:
+      mask = masktools.list2mask(msklist, wd=mskwd)
+      mask[:,1] = mask[:,1] == 0
+
+   if mask is not None:
+      atm = masktools.IntervalSet.from_mask(lam2wave(mask[:,0]), mask[:,1])
+      masks.add(atm, flag.atm)
+      masks.add(atm, flag.badT, frame='tpl')
+   print 'using telluric mask:', maskfile if mask is not None else 'NONE'
+   return masks, msksky
+
+
+class Target(object):
+   """
+   Template, orders and target info of one object, kept in memory.
+
+   The template is restored as with serval -last, i.e. the B-splines from
+   the knot sampled <obj>/<obj>.fits (else a spline through template.fits).
+   The secular acceleration is referred to the first spectrum of the
+   previous run (<obj>/<obj>.npz), if available.
+
+   """
+   def __init__(self, obj, oset=None):
+      self.obj = obj
+      ww, ff, head = read_template(obj+os.sep+'template.fits')
+      knotfile = obj+os.sep+obj+'.fits'
+      TPL = read_knot_template(knotfile) if os.path.exists(knotfile) else [None] * len(ff)
+      self.TPL = [Tpl(wo, fo, cubicSpline.spl_cf, cubicSpline.spl_evf) if to is None else to for to,wo,fo in zip(TPL,ww,ff)]
+      self.berv = head.get('HIERARCH SERVAL BERV', np.nan)   # of the template reference spectrum
+      omin = head.get('HIERARCH SERVAL COADD OMIN', 0)
+      omax = head.get('HIERARCH SERVAL COADD OMAX', len(ff)-1)
+      orders = np.arange(len(ff))[oset] if oset is not None else np.arange(omin, omax+1)
+      self.orders = [o for o in orders if np.isfinite(ff[o]).any() and np.any(ff[o]!=0)]
+      self.x = np.array([np.mean(wo[wo>0]) if def_wlog else np.log(np.mean(wo[wo>0])) for wo in ww])   # ln(lambda) for CRX
+
+      self.targ = None
+      cvs = obj+'/'+obj+'.targ.cvs'
+      if os.path.exists(cvs):
+         with open(cvs) as f:
+            name = f.read().split(';')[0]
+         self.targ = Targ(name, cvs=cvs)
+      else:
+         print 'WARNING: no %s, no barycentric correction for %s' % (cvs, obj)
+
+      self.bjd0, self.sa0 = np.nan, 0.
+      if os.path.exists(obj+'/'+obj+'.npz'):
+         prev = np.load(obj+'/'+obj+'.npz')
+         if len(prev['bjd']):
+            self.bjd0, self.sa0 = prev['bjd'][0], prev['sa'][0]
+      print 'template restored:', obj, len(self.orders), 'orders'
+
+
+class Service(object):
+   """
+   Resident RV measurement.
+
+   Instrument, masks and templates are loaded once. measure() fits a
+   single spectrum against the template of its target.
+
+   Examples
+   --------
+   >>> srvd = Service(['gj699'], inst='CARM_VIS')
+   >>> srvd.measure('gj699', 'car-20160218T03h52m39s-sci-gtoc-vis_A.fits')
+
+   """
+   def __init__(self, objs, inst='HARPS', fib='', drs=True, brvref='WE', oset=None, pmin=300, pmax=None,
+                kapsig=3.0, nclip=2, deg=3, vrange=(-5.5, 5.6, 0.1), vsolver='grid', **maskargs):
+      self.inst = importlib.import_module('inst_'+inst)
+      if fib == '' and self.inst.name in ('CARM_VIS', 'CARM_NIR', 'HARPS', 'HARPN', 'FEROS'): fib = 'A'
+      self.fib = fib
+      self.drs = drs
+      Spectrum.brvref = brvref
+      self.pmin = pmin
+      self.pmax = getattr(self.inst, 'pmax', pmax or (1800 if self.inst.name=='CARM_NIR' else 3800))
+      self.kapsig, self.nclip, self.deg, self.vsolver, self.vrange = kapsig, nclip, deg, vsolver, tuple(vrange)
+      self.masks, self.msksky = loadmasks(self.inst, fib=fib, **maskargs)
+      self.targets = dict((obj, Target(obj, oset=oset)) for obj in objs)
+
+   def measure(self, obj, filename):
+      '''Returns bjd, RVc, e_RVc, CRX, e_CRX, dLW, e_dLW for one spectrum.'''
+      tg = self.targets[obj]
+      pmin, pmax = self.pmin, self.pmax
+      sp = Spectrum(filename, inst=self.inst, pfits=True, orders=np.s_[:], drs=self.drs, fib=self.fib, targ=tg.targ)
+      nord = len(sp.w)
+      rv, e_rv, dlw, e_dlw = nans((4, nord))
+      bmask = self.masks(sp.w, tpl=(-tg.berv+np.nan_to_num(sp.berv), 0.) if np.isfinite(tg.berv) else None)
+      for o in tg.orders:
+         if o >= nord: continue
+         f2 = sp.f[o]
+         e2 = sp.e[o]
+         pind = orderpix(sp.bpmap[o] | self.msksky[o] | bmask[o], pmin, pmax)
+         if not pind.size: continue
+
+         wmod = barshift(sp.w[o], np.nan_to_num(sp.berv))
+         par, f2mod, keep, stat = fitspec(tg.TPL[o], wmod, f2, e2, v=0., clip=self.kapsig, nclip=self.nclip, keep=pind, indmod=np.s_[pmin:pmax], deg=self.deg, vsolver=self.vsolver, vrange=self.vrange)
+         if par.perror is None or len(keep) < 10: continue
+         rv[o] = par.params[0] * 1000.
+         e_rv[o] = par.perror[0] * stat['std'] * 1000
+         dlw[o], e_dlw[o] = difflw(tg.TPL[o], wmod, f2, e2, f2mod, keep, par.params)
+
+      ind, = np.where(np.isfinite(e_rv))
+      if not ind.size:
+         return sp.bjd, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan
+      RV, e_RV = wsem(rv[ind], e=e_rv[ind])
+      sa = np.nan_to_num(secacc(tg.targ, sp.bjd, tg.bjd0) + tg.sa0) if tg.targ else 0.
+      RVc = RV - np.nan_to_num(sp.drift) - sa
+      e_RVc = np.sqrt(e_RV**2 + np.nan_to_num(sp.e_drift)**2)
+
+      CRX = e_CRX = np.nan
+      if len(ind) > 2:
+         CRX, e_CRX = crxfit(tg.x[ind], rv[ind], e_rv[ind])[:2]
+
+      jnd, = np.where(np.isfinite(e_dlw))
+      dLW, e_dLW = wsem(dlw[jnd], e=e_dlw[jnd]) if jnd.size else (np.nan, np.nan)
+      return sp.bjd, RVc, e_RVc, CRX, e_CRX, dLW, e_dLW
+
+   def request(self, line):
+      '''Parse a request line "[obj] filename" and return the result line.'''
+      args = line.split()
+      if len(args) == 1 and len(self.targets) == 1:
+         args = self.targets.keys() + args
+      if len(args) != 2 or args[0] not in self.targets:
+         return 'ERROR bad request: %s' % line.strip()
+      obj, filename = args
+      t0 = time.time()
+      try:
+         res = self.measure(obj, filename)
+      except Exception as e:
+         return 'ERROR %s %s: %s' % (obj, filename, e)
+      print '%s %s  %.3fs' % (obj, filename, time.time()-t0)
+      return ' '.join([obj, filename] + map(str, res))
+
+   def spool(self, dirname, poll=1.):
+      '''
+      Serve request files (*.req) in a spool directory.
+
+      Each line of a request file is "[obj] filename". The results go to
+      a file with the suffix .rv (columns: obj filename bjd RVc e_RVc CRX
+      e_CRX dLW e_dLW) and the request file is removed.
+      '''
+      print 'spooling', dirname
+      while True:
+         for req in sorted(glob.glob(dirname+os.sep+'*.req'), key=os.path.getmtime):
+            with open(req) as f:
+               lines = [line for line in f if line.strip() and not line.startswith('#')]
+            results = [self.request(line) for line in lines]
+            out = req[:-4] + '.rv'
+            with open(out+'.tmp', 'w') as f:
+               for res in results:
+                  print >>f, res
+            os.rename(out+'.tmp', out)   # appears complete for the client
+            os.remove(req)
+         time.sleep(poll)
+
+   def serve(self, port):
+      '''Serve request lines on a local TCP port (one result line per request line).
+      The requests are handled one after the other (fitspec is not thread-safe).'''
+      service = self
+      class Handler(SocketServer.StreamRequestHandler):
+         def handle(self):
+            for line in self.rfile:
+               if line.strip():
+                  self.wfile.write(service.request(line) + '\n')
+                  self.wfile.flush()
+      server = SocketServer.TCPServer(('localhost', port), Handler)
+      print 'serving on localhost:%s' % port
+      server.serve_forever()
+
+
+if __name__ == "__main__":
+   default = " (default: %(default)s)."
+   epilog = """\
+   usage example:
+   %(prog)s gj699 gj1002 -inst CARM_VIS -spool spool/
+   echo gj699 /data/car-20160218T03h52m39s-sci-gtoc-vis_A.fits > spool/night.req
+   """
+   insts = [os.path.basename(i)[5:-3] for i in glob.glob(servalsrc+'inst_*.py')]
+
+   parser = argparse.ArgumentParser(description=description, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
+   argopt = parser.add_argument   # function short cut
+   argopt('obj', help='Tags with a template from a previous serval run (<obj>/template.fits).', nargs='+')
+   argopt('-inst', help='instrument '+default, default='HARPS', choices=insts)
+   argopt('-fib', help='fibre', choices=['', 'A', 'B', 'AB'], default='')
+   argopt('-brvref', help='Barycentric RV code reference'+default, default='WE')
+   argopt('-oset', help='index for order subset (default: coadded orders from template)', type=serval.arg2slice)
+   argopt('-pmin', help='Minimum pixel'+default, default=300, type=int)
+   argopt('-pmax', help='Maximum pixel (default: as in serval)', type=int)
+   argopt('-kapsig', help='kappa sigma clip value'+default, type=float, default=3.0)
+   argopt('-nclip', help='max. number of clipping iterations'+default, type=int, default=2)
+   argopt('-deg',  help='degree for background polynomial'+default, type=int, default=3)
+   argopt('-vrange', help='[km/s] velocity grid around the template (v_lo, v_hi, v_step)'+default, nargs=3, default=(-5.5, 5.6, 0.1), type=float)
+   argopt('-vsolver', help='RV optimisation'+default, default='grid', choices=['grid', 'newton'])
+   argopt('-atmmask', help='Telluric line mask ('' for no masking)'+default, default='auto', dest='atmfile')
+   argopt('-skymsk', help='Sky emission line mask ('' for no masking)'+default, default='auto', dest='skyfile')
+   argopt('-msklist', help='Ascii table with vacuum wavelengths to mask.', default='')
+   argopt('-mskwd', help='[km/s] Broadening width for msklist.', type=float, default=4.)
+   argopt('-spool', help='Spool directory for request files (*.req).')
+   argopt('-poll', help='[s] Polling interval for the spool directory'+default, type=float, default=1.)
+   argopt('-port', help='Local TCP port for request lines.', type=int)
+   args = parser.parse_args()
+
+   if bool(args.spool) == bool(args.port):
+      parser.error('either -spool or -port required')
+
+   srvd = Service(args.obj, inst=args.inst, fib=args.fib, brvref=args.brvref, oset=args.oset, pmin=args.pmin, pmax=args.pmax,
+                  kapsig=args.kapsig, nclip=args.nclip, deg=args.deg, vrange=args.vrange, vsolver=args.vsolver,
+                  atmfile=args.atmfile, skyfile=args.skyfile, msklist=args.msklist, mskwd=args.mskwd)
+
+   if args.port:
+      srvd.serve(args.port)
+   else:
+      srvd.spool(args.spool, poll=args.poll)
@@ -159,6 +159,40 @@ c         if (i .lt. 10) write(6,*) m,yy(i),xx(i),k(m),dx
  100  enddo
       END
 
+      SUBROUTINE SPL_EVfd(x,y,b,k,d,n,xx,nn,fa,fo,nv,yy,dy,ddy)
+C
+C     CALCULATE THE SPLINE AND ITS FIRST AND SECOND DERIVATIVE
+C     at fa(j)*xx+fo(j) for nv shifts (e.g. Doppler shifts)
+C
+C     must be sorted, fa > 0
+      INTEGER N,nn,nv
+      DOUBLE PRECISION x(N),y(N),b(N-1),k(N),d(N-1),xx(nn)
+      DOUBLE PRECISION fa(nv),fo(nv)
+      DOUBLE PRECISION yy(nn,nv),dy(nn,nv),ddy(nn,nv)
+      DOUBLE PRECISION dx
+Cf2py intent(in) x,y,b,k,d,n,xx,nn,fa,fo,nv
+Cf2py intent(out) yy,dy,ddy
+Cf2py depend(n) x,y,k, b,d
+Cf2py depend(nn) xx
+Cf2py depend(nv) fa,fo
+Cf2py depend(nn,nv) yy,dy,ddy
+      do 200 j=1,nv
+         m = 1
+         do 100 i=1,nn
+            dx = fa(j)*xx(i) + fo(j)
+            ! find the left knot x
+            do while (x(m+1) .lt. dx .and. m .lt. N-1)
+               m = m + 1
+            enddo
+            dx = dx - x(m)
+C           y = a + bx + k/2x**2 + dx**3, y' = b + kx + 3dx**2, y'' = k + 6dx
+            yy(i,j) = y(m) + dx * (b(m) + dx * (k(m)/2 + dx * d(m)))
+            dy(i,j) = b(m) + dx * (k(m) + dx * 3 * d(m))
+            ddy(i,j) = k(m) + dx * 6 * d(m)
+ 100     enddo
+ 200  enddo
+      END
+
       SUBROUTINE SPL_EQ_EV(x,y,k,n,xx,nn,yy)
 C
 C     CALCULATE THE SPLINE for equidistant grid
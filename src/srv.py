@@ -1,5 +1,6 @@
 #! /usr/bin/python
 
+import os
 import sys
 import argparse
 
@@ -35,91 +36,234 @@ SERVAL - SpEctrum Radial Velocity AnaLyser (%s)
 genfromtxt2d = lambda *x,**y: np.atleast_2d(np.genfromtxt(*x,**y))
 
 
-class srv:
+class lazy(object):
+   '''
+   Attribute computed on first access and then cached in the instance.
+   '''
+   def __init__(self, func):
+      self.func = func
+      self.__doc__ = func.__doc__
+
+   def __get__(self, obj, cls):
+      if obj is None:
+         return self
+      val = self.func(obj)
+      setattr(obj, self.func.__name__, val)   # shadows the descriptor from now on
+      return val
+
+
+class srv(object):
    '''
    Analysis of SERVAL products.
+
+   The products are loaded on first access, from the binary bundle
+   <tag>.npz if present or otherwise from the dat files.
    
    '''
 
    def __init__(self, obj, fibsuf='', oidx=None, safemode=False, pdf=False, plotrvo=True):
       '''
-      Load all SERVAL products into an object.
+      Object for the SERVAL products.
 
       obj : Folder with the SERVAL products.
       '''
       self.dir = obj
       self.tag = tag = obj.rstrip('/').split('/')[-1]
       self.pre = pre = obj+'/'+tag
+      self.fibsuf = fibsuf
+      self.oidx = oidx
       self.rms = np.nan
 
       print pre+'.rvc'+fibsuf+'.dat'
-      self.allrv = genfromtxt2d(pre+'.rvo'+fibsuf+'.dat')
-      self.allerr = genfromtxt2d(pre+'.rvo'+fibsuf+'.daterr')
-      sbjd = np.genfromtxt(pre+'.rvo'+fibsuf+'.dat', dtype=('|S33'), usecols=[0])   # as string
-      self.snr = genfromtxt2d(pre+'.snr'+fibsuf+'.dat')
-      self.dlw = genfromtxt2d(pre+'.dlw'+fibsuf+'.dat')
-      self.rchi = genfromtxt2d(pre+'.chi'+fibsuf+'.dat')
-      try:
-         self.halpha = genfromtxt2d(pre+'.halpha.dat')
-      except:
-         pass
+
+   @lazy
+   def bundle(self):
+      '''Good spectra from the binary bundle, if not older than the dat files.'''
+      name = self.pre + self.fibsuf + '.npz'
+      rvofile = self.pre + '.rvo' + self.fibsuf + '.dat'
+      if os.path.exists(name) and (not os.path.exists(rvofile) or os.path.getmtime(name) >= os.path.getmtime(rvofile)):
+         p = np.load(name)
+         good = p['rvflag'] == 0
+         return dict((key, p[key][good]) for key in p.files)
+
+   def columns(self, *names):
+      '''Stack bundle columns like in the dat files.'''
+      return np.column_stack([self.bundle[name] for name in names])
+
+   @lazy
+   def allrv(self):
+      if self.bundle: return self.columns('bjd', 'RV', 'e_RV', 'rvm', 'rvmerr', 'rv')
+      return genfromtxt2d(self.pre+'.rvo'+self.fibsuf+'.dat')
+
+   @lazy
+   def allerr(self):
+      if self.bundle: return self.columns('bjd', 'RV', 'e_RV', 'rvm', 'rvmerr', 'e_rv')
+      return genfromtxt2d(self.pre+'.rvo'+self.fibsuf+'.daterr')
+
+   @lazy
+   def snr(self):
+      if self.bundle:
+         snr = self.bundle['snr']
+         return np.column_stack((self.bundle['bjd'], np.nansum(snr**2, axis=1)**0.5, snr))
+      return genfromtxt2d(self.pre+'.snr'+self.fibsuf+'.dat')
+
+   @lazy
+   def dlw(self):
+      if self.bundle: return self.columns('bjd', 'dLW', 'e_dLW', 'dlw')
+      return genfromtxt2d(self.pre+'.dlw'+self.fibsuf+'.dat')
+
+   @lazy
+   def rchi(self):
+      if self.bundle: return self.columns('bjd', 'rchi')
+      return genfromtxt2d(self.pre+'.chi'+self.fibsuf+'.dat')
+
+   @lazy
+   def halpha(self):
       try:
-         self.tpre = genfromtxt2d(pre+'.pre'+fibsuf+'.dat')
-      except:
-         print('warning: %s not found' % pre+'.pre'+fibsuf+'.dat')
-      self.dLW, self.e_dLW = self.dlw.T[[1,2]]
+         return genfromtxt2d(self.pre+'.halpha.dat')
+      except IOError:
+         raise AttributeError('halpha')
 
+   @lazy
+   def tpre(self):
+      try:
+         return genfromtxt2d(self.pre+'.pre'+self.fibsuf+'.dat')
+      except IOError:
+         print('warning: %s not found' % self.pre+'.pre'+self.fibsuf+'.dat')
+         raise AttributeError('tpre')
+
+   @lazy
+   def dLW(self):
+      return self.dlw.T[1]
+
+   @lazy
+   def e_dLW(self):
+      return self.dlw.T[2]
+
+   @lazy
+   def info(self):
+      if self.bundle: return self.bundle['timeid']
       # info includes also flagged files; exclude them based on unpairable bjd
       # (due to different formatting use bjd from brv.dat not info.cvs.)
-      bjd = np.atleast_1d(np.genfromtxt(pre+'.brv.dat', usecols=[0]))
+      bjd = np.atleast_1d(np.genfromtxt(self.pre+'.brv.dat', usecols=[0]))
 
       nn = [n for (n,t) in enumerate(bjd) if t in self.allrv[:,0]]
-      self.info = np.atleast_1d(np.genfromtxt(pre+'.info.cvs', dtype=('S'), usecols=[0], delimiter=';'))[nn]
+      info = np.atleast_1d(np.genfromtxt(self.pre+'.info.cvs', dtype=('S'), usecols=[0], delimiter=';'))[nn]
 
-      if not self.info.ndim:
-         self.info = self.info[np.newaxis]
-      info = " ".join(self.info)
-      self.inst = ''
-      if '-vis.fits' in info: self.inst = 'CARM_VIS'
-      if '-nir.fits' in info: self.inst = 'CARM_NIR'
-      if '_e2ds' in info: self.inst = 'HARPS'
+      if not info.ndim:
+         info = info[np.newaxis]
+      return info
 
-      self.keytitle = self.tag
+   @lazy
+   def inst(self):
+      info = " ".join(self.info)
+      inst = ''
+      if '-vis.fits' in info: inst = 'CARM_VIS'
+      if '-nir.fits' in info: inst = 'CARM_NIR'
+      if '_e2ds' in info: inst = 'HARPS'
+      return inst
+
+   @lazy
+   def keytitle(self):
+      keytitle = self.tag
       if self.inst:
-         self.keytitle += ' (' + self.inst.replace('_', ' ') + ')'
-
-      self.tcrx = genfromtxt2d(pre+'.crx.dat', dtype=None).T
-
-      self.N = len(self.allrv)
-      #if self.N == 1:
-         #return   # just one line, e.g. drift
-
-      self.tsrv = genfromtxt2d(pre+'.srv.dat', dtype=None).T
-      self.trvc = self.bjd, RVc_old, e_RVc_old, RVd, e_RVd, RV_old, e_RV_old, BRV, RVsa \
-                = genfromtxt2d(pre+'.rvc'+fibsuf+'.dat', dtype=None).T
-      self.drs = genfromtxt2d(pre+'.drs.dat')
+         keytitle += ' (' + self.inst.replace('_', ' ') + ')'
+      return keytitle
+
+   @lazy
+   def tcrx(self):
+      if self.bundle:
+         tCRX = self.bundle['tCRX']
+         return np.column_stack([self.bundle['bjd']] + [tCRX[name] for name in tCRX.dtype.names] + [self.bundle['xo']]).T
+      return genfromtxt2d(self.pre+'.crx.dat', dtype=None).T
+
+   @lazy
+   def N(self):
+      return len(self.allrv)
+
+   @lazy
+   def tsrv(self):
+      if self.bundle: return self.columns('bjd', 'RVc', 'e_RVc', 'CRX', 'e_CRX', 'dLW', 'e_dLW').T
+      return genfromtxt2d(self.pre+'.srv.dat', dtype=None).T
+
+   @lazy
+   def trvc(self):
+      # bjd, RVc_old, e_RVc_old, RVd, e_RVd, RV_old, e_RV_old, BRV, RVsa
+      if self.bundle: return self.columns('bjd', 'RVc', 'e_RVc', 'drift', 'e_drift', 'RV', 'e_RV', 'berv', 'sa').T
+      return genfromtxt2d(self.pre+'.rvc'+self.fibsuf+'.dat', dtype=None).T
+
+   @lazy
+   def bjd(self):
+      return self.trvc[0]
+
+   @lazy
+   def drs(self):
+      return genfromtxt2d(self.pre+'.drs.dat')
+
+   @lazy
+   def tmlc(self):
+      if self.bundle: return self.columns('bjd', 'mlRVc', 'e_mlRVc', 'mlCRX', 'e_mlCRX', 'dLW', 'e_dLW')
       try:
-         self.tmlc = genfromtxt2d(pre+'.mlc'+fibsuf+'.dat')
-      except:
-         pass
+         return genfromtxt2d(self.pre+'.mlc'+self.fibsuf+'.dat')
+      except IOError:
+         raise AttributeError('tmlc')
 
+   @lazy
+   def orders(self):
       with np.errstate(invalid='ignore'):
          orders, = np.where(np.sum(self.allerr[:,5:]>0, 0))   # orders with all zero error values
-      self.orders = orders
-      if oidx is not None:
-         omiss = set(oidx) - set(orders)
+      return orders
+
+   @lazy
+   def oset(self):
+      '''orders used for rv (orders restricted to oidx)'''
+      orders = self.orders
+      if self.oidx is not None:
+         omiss = set(self.oidx) - set(orders)
          if omiss: pause('WARNING: orders', omiss,'missing')
-         else: orders = np.array(sorted(set(orders) & set(oidx)))
-
-      omap = orders[:,np.newaxis]
-      self.rv, self.e_rv = self.allrv[:,5+orders], self.allerr[:,5+orders]
-      self.RV, self.e_RV = nanwsem(self.rv, e=self.e_rv, axis=1)
-      self.has_d = ~np.isnan(RVd) * 1   # has a drift value, HARPS has no e_RVd
-
-      # drift corrected
-      self.rvc = self.rv - np.nan_to_num(RVd[:,np.newaxis]) - np.nan_to_num(RVsa[:,np.newaxis])
-      self.RVc = self.RV - np.nan_to_num(RVd) - np.nan_to_num(RVsa)
-      self.e_RVc = np.sqrt(self.e_RV**2 + np.nan_to_num(e_RVd)**2)
+         else: orders = np.array(sorted(set(orders) & set(self.oidx)))
+      return orders
+
+   @lazy
+   def rv(self):
+      return self.allrv[:,5+self.oset]
+
+   @lazy
+   def e_rv(self):
+      return self.allerr[:,5+self.oset]
+
+   @lazy
+   def tRV(self):
+      return nanwsem(self.rv, e=self.e_rv, axis=1)
+
+   @lazy
+   def RV(self):
+      return self.tRV[0]
+
+   @lazy
+   def e_RV(self):
+      return self.tRV[1]
+
+   @lazy
+   def has_d(self):
+      RVd = self.trvc[3]
+      return ~np.isnan(RVd) * 1   # has a drift value, HARPS has no e_RVd
+
+   # drift corrected
+   @lazy
+   def rvc(self):
+      RVd, RVsa = self.trvc[[3,8]]
+      return self.rv - np.nan_to_num(RVd[:,np.newaxis]) - np.nan_to_num(RVsa[:,np.newaxis])
+
+   @lazy
+   def RVc(self):
+      RVd, RVsa = self.trvc[[3,8]]
+      return self.RV - np.nan_to_num(RVd) - np.nan_to_num(RVsa)
+
+   @lazy
+   def e_RVc(self):
+      e_RVd = self.trvc[4]
+      return np.sqrt(self.e_RV**2 + np.nan_to_num(e_RVd)**2)
 
    def plot_dlw(self):
       '''Show RVs over order for each observation.'''